@@ -4,20 +4,73 @@
 
 
 from contextlib import contextmanager
+from pathlib import Path
 import argparse
 import configparser
+import json
 import logging
+import shlex
+import time
 
 
+from celery.utils.time import rate
 try:
     from flower.command import FlowerCommand
 except ImportError:
     FlowerCommand = None
-from stevedore import extension
 
 from extensible_celery_worker import DEFAULT_CONFIG, app
-from extensible_celery_worker.config_paths import config_paths
-
+from extensible_celery_worker.accounting import (
+    configure_task_accounting,
+    format_task_usage,
+    request_task_usage,
+)
+from extensible_celery_worker.async_tasks import DEFAULT_IN_FLIGHT_LIMIT, configure_async_tasks
+from extensible_celery_worker.autoscale import autoscale_worker_args, configure_adaptive_autoscaler
+from extensible_celery_worker.batches import configure_batch_tasks
+from extensible_celery_worker.blobs import BlobStore, configure_blob_store
+from extensible_celery_worker.bench import (
+    BENCHMARK_POOLS,
+    format_results,
+    run_benchmark,
+    task_full_name,
+)
+from extensible_celery_worker.cluster import Cluster, WorkerPool
+from extensible_celery_worker.config_paths import config_paths, user_cache_dir
+from extensible_celery_worker.dedup import DedupIndex, configure_message_dedup
+from extensible_celery_worker.events import (
+    configure_task_event_aggregation,
+    count_task_summaries_in_flower,
+)
+from extensible_celery_worker.fusion import configure_chain_fusion
+from extensible_celery_worker.limits import HostLimits, configure_host_limits
+from extensible_celery_worker.load import ArgumentTemplates, format_load_results, run_load
+from extensible_celery_worker.memory import current_rss
+from extensible_celery_worker.memo import MemoCache, configure_memo_cache
+from extensible_celery_worker.metrics import add_collector, install_metrics
+from extensible_celery_worker.plugins import (
+    PluginReloader,
+    import_plugins,
+    load_manifest,
+    register_lazy_tasks,
+    save_manifest,
+    scan_plugins,
+    scan_plugins_isolated,
+)
+from extensible_celery_worker.preload import preload_plugins
+from extensible_celery_worker.reload import configure_plugin_reload
+from extensible_celery_worker.result_buffer import configure_result_buffering
+from extensible_celery_worker.routing import configure_plugin_queues
+from extensible_celery_worker.startup_profile import phase, profiling
+from extensible_celery_worker.task_profile import configure_task_profiling, dump_task_profiles
+from extensible_celery_worker.tracing import SpanExporter, configure_task_tracing
+
+
+_PLUGIN_LOADING_MODES = ('eager', 'lazy', 'preload')
+
+_EVENT_MODES = ('all', 'aggregate')
+_RESULT_WRITE_MODES = ('immediate', 'buffered')
+_LOAD_RATES = [10, 20, 50, 100, 200, 500, 1000]
 
 _LOG_LEVEL_MAP = {
     logging.DEBUG: 'DEBUG',
@@ -40,6 +93,11 @@ class _StoreLogLevelAction(argparse.Action):
         setattr(namespace, self.dest, getattr(logging, values.upper()))
 
 
+def _comma_separated(value):
+    """Return the list of non-empty, comma-separated items of the given string."""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
 def _command_line_arguments():
     """Return command-line arguments passed to the worker."""
     parser = argparse.ArgumentParser(prog='excewo', description=(
@@ -53,6 +111,9 @@ def _command_line_arguments():
                         dest='celery_app_config')
     parser.add_argument('-a', '--app-config', help='Path to a configuration file for '
                         'extensible_celery_worker (INI-style).', dest='cli_config_path')
+    parser.add_argument('-p', '--plugins', help='Comma-separated names of the task plugins to '
+                        'load (default: all installed plugins)', type=_comma_separated,
+                        dest='plugin_names')
     parser.add_argument('-l', '--log-level', help='Log level. The worker process will also use '
                         'this log level (no need to specify `-l` again after `--`)',
                         choices=_LOG_LEVEL_MAP.values(), action=_StoreLogLevelAction)
@@ -65,6 +126,97 @@ def _command_line_arguments():
                                nargs=argparse.REMAINDER)
     if FlowerCommand is not None:
         subparsers.add_parser('flower', help='Start flower')
+    profile_parser = subparsers.add_parser('profile-startup', help='Set up the worker as `worker` '
+                                           'does, without starting it, and show where startup '
+                                           'time and memory go, by phase and by plugin')
+    profile_parser.add_argument('-f', '--format', help='Output format', choices=('text', 'json'),
+                                default='text', dest='output_format')
+    bench_parser = subparsers.add_parser('bench', help='Run plugin tasks with an embedded worker '
+                                         'and in-memory broker and result backend, and show '
+                                         'throughput and latency for each pool and concurrency')
+    bench_parser.add_argument('tasks', nargs='+', metavar='task', help='Name of a task to '
+                              'benchmark, with or without the application name prefix (for '
+                              'instance `examples.always_true`)')
+    bench_parser.add_argument('-m', '--messages', help='Number of messages to send for each task, '
+                              'pool and concurrency (default: 1000)', type=int, default=1000)
+    bench_parser.add_argument('-P', '--pool', help='Pool types to benchmark (default: solo '
+                              'prefork)', nargs='+', choices=BENCHMARK_POOLS,
+                              default=['solo', 'prefork'], dest='pools')
+    bench_parser.add_argument('-c', '--concurrency', help='Concurrency levels to benchmark '
+                              '(default: 1). The solo pool is only run with a concurrency of 1',
+                              nargs='+', type=int, default=[1], dest='concurrency_levels')
+    bench_parser.add_argument('--args', help='Positional arguments of tasks, as a JSON list',
+                              type=json.loads, default=[], dest='task_args')
+    bench_parser.add_argument('--kwargs', help='Keyword arguments of tasks, as a JSON object',
+                              type=json.loads, default={}, dest='task_kwargs')
+    bench_parser.add_argument('--trace', help='Run each benchmark again with all tasks traced, and '
+                              'show the overhead of tracing', action='store_true')
+    bench_parser.add_argument('-f', '--format', help='Output format', choices=('text', 'json'),
+                              default='text', dest='output_format')
+    load_parser = subparsers.add_parser('load', help='Publish synthetic messages of plugin tasks '
+                                        'at increasing rates or in bursts, and show throughput '
+                                        'and latency of workers at each step, and their '
+                                        'saturation throughput')
+    load_parser.add_argument('tasks', nargs='*', metavar='task', help='Name of a task to send '
+                             'messages of, with or without the application name prefix, if no '
+                             'templates are given')
+    load_parser.add_argument('-t', '--templates', help='JSON file of message templates: a list of '
+                             'objects with a `task` name, and optional `args`, `kwargs` and '
+                             '`weight`', dest='templates_path')
+    load_parser.add_argument('--args', help='Positional arguments of tasks, as a JSON list',
+                             type=json.loads, default=[], dest='task_args')
+    load_parser.add_argument('--kwargs', help='Keyword arguments of tasks, as a JSON object',
+                             type=json.loads, default={}, dest='task_kwargs')
+    load_steps = load_parser.add_mutually_exclusive_group()
+    load_steps.add_argument('-r', '--rate', help='Message rates of steps, in messages per second '
+                            '(default: {})'.format(' '.join(str(rate) for rate in _LOAD_RATES)),
+                            nargs='+', type=float, default=_LOAD_RATES, dest='rates')
+    load_steps.add_argument('-b', '--burst', help='Burst sizes of steps, instead of rates',
+                            nargs='+', type=int, dest='bursts')
+    load_parser.add_argument('-i', '--burst-interval', help='Number of seconds between bursts '
+                             '(default: 1)', type=float, default=1.0)
+    load_parser.add_argument('-d', '--duration', help='Number of seconds each step lasts '
+                             '(default: 10)', type=float, default=10.0)
+    load_parser.add_argument('--timeout', help='Number of seconds to wait for results after each '
+                             'step (default: 60)', type=float, default=60.0)
+    load_parser.add_argument('--all-steps', help='Run all steps, even once a step is saturated',
+                             action='store_true')
+    load_parser.add_argument('--broker', help='Broker URL, instead of the configured one. With '
+                             '`memory://`, tasks are run by an embedded worker', dest='broker_url')
+    load_parser.add_argument('--result-backend', help='Result backend URL, instead of the '
+                             'configured one', dest='result_backend_url')
+    load_parser.add_argument('-P', '--pool', help='Pool type of the embedded worker (default: '
+                             'solo)', choices=BENCHMARK_POOLS, default='solo')
+    load_parser.add_argument('-c', '--concurrency', help='Concurrency of the embedded worker '
+                             '(default: 1)', type=int, default=1)
+    load_parser.add_argument('--seed', help='Seed of the random generator picking templates and '
+                             'placeholder values', type=int)
+    load_parser.add_argument('-f', '--format', help='Output format', choices=('text', 'json'),
+                             default='text', dest='output_format')
+    memo_parser = subparsers.add_parser('memo-stats', help='Show hits, misses and size of cached '
+                                        'results of each pure task')
+    memo_parser.add_argument('--clear', help='Remove all cached results and statistics',
+                             action='store_true')
+    memo_parser.add_argument('-f', '--format', help='Output format', choices=('text', 'json'),
+                             default='text', dest='output_format')
+    usage_parser = subparsers.add_parser('task-usage', help='Show memory growth and CPU time of '
+                                         'tasks run by running workers, with tasks growing '
+                                         'memory the most first')
+    usage_parser.add_argument('-n', '--limit', help='Number of tasks to show (default: all)',
+                              type=int, default=None)
+    usage_parser.add_argument('-t', '--timeout', help='Number of seconds to wait for replies '
+                              'of workers (default: 1)', type=float, default=1.0)
+    usage_parser.add_argument('-f', '--format', help='Output format', choices=('text', 'json'),
+                              default='text', dest='output_format')
+    dump_parser = subparsers.add_parser('dump-task-profiles', help='Merge profiles of tasks '
+                                        'written by worker processes of this host, and write '
+                                        'them as text and pstats files')
+    dump_parser.add_argument('-o', '--output', help='Directory to write files to (default: a new '
+                             'timestamped subdirectory of the profile directory)',
+                             dest='output_directory')
+    subparsers.add_parser('cluster', help='Start and supervise a worker for each worker pool '
+                          'defined in the configuration, each with its own Celery worker '
+                          'arguments and plugins')
     return parser.parse_args()
 
 
@@ -76,38 +228,199 @@ def _celery_app_config(cli_config_path=None):
     On exit, it ensures that the config is cleared.
     """
     config = configparser.ConfigParser()
-    used_config_files = config.read(path.as_posix() for path in config_paths(cli_config_path))
+    with phase('config file discovery'):
+        possible_config_files = [path.as_posix() for path in config_paths(cli_config_path)]
+    with phase('config file parsing'):
+        used_config_files = config.read(possible_config_files)
     logging.info('Found and used configuration files (in override order, next overrides previous): '
                  '{}'.format(', '.join(used_config_files)))
     yield config
     config.clear()
 
 
+def _configure_logging(level):
+    """Initialize a basic logging system, unless logging is already configured."""
+    logging.basicConfig(
+        level=level or logging.WARNING,
+        format='[%(asctime)s: %(levelname)s/%(processName)s] %(message)s',
+    )
+
+
 @contextmanager
 def _log_app(level):
     """Context manager that initialize a basic logging system on startup and ensure it is shutdown
     on exit."""
-    level = level or logging.WARNING
-    logging.basicConfig(
-        level=level,
-        format='[%(asctime)s: %(levelname)s/%(processName)s] %(message)s',
-    )
+    _configure_logging(level)
     yield
     logging.shutdown()
 
 
-def _register_celery_app_tasks():
-    """Register all tasks found in installed plugins."""
-    plugin_mgr = extension.ExtensionManager(namespace='excewo.tasks')
-    installed_task_plugins = plugin_mgr.list_entry_points()
-    logging.info('Found task plugins: {}'.format(
-        ', '.join(plugin.name for plugin in installed_task_plugins)
-    ))
+def _prefixed_options(config, prefix):
+    """Return a mapping of names to values of options of the ``[excewo]`` section whose key is
+    ``<prefix>.<name>``."""
+    if not config.has_section('excewo'):
+        return {}
+    return {key[len(prefix) + 1:]: value for key, value in config.items('excewo')
+            if key.startswith(prefix + '.')}
+
+
+def _default_plugin_manifest_path():
+    """Return the default path of the plugin manifest file for the Celery application."""
+    return user_cache_dir() / 'plugins-{}.json'.format(app.main)
+
+
+def _memo_cache(config):
+    """Return the cache of results of pure tasks defined in the given configuration, or ``None``
+    if it is disabled."""
+    path = config.get('excewo', 'memo_cache',
+                      fallback=(user_cache_dir() / 'memo-{}.sqlite'.format(app.main)).as_posix())
+    if not path:
+        return None
+    ttl = config.getfloat('excewo', 'memo_ttl', fallback=0)
+    return MemoCache(path, config.getint('excewo', 'memo_max_bytes', fallback=64 * 2 ** 20),
+                     ttl or None)
+
+
+def _configure_memo_cache(config):
+    """Make pure tasks use the cache of their results, if it is configured or a pure task is
+    registered, and serve its statistics with task metrics.
+
+    Return whether the cache is configured (or disabled in the configuration), so that it is not
+    configured again.
+    """
+    if not config.has_option('excewo', 'memo_cache') and not any(
+        getattr(task, 'pure', False) for task in app.tasks.values()
+    ):
+        configure_memo_cache(None)
+        return False
+    cache = _memo_cache(config)
+    configure_memo_cache(cache)
+    if cache is not None:
+        add_collector('memo', cache.as_prometheus_text)
+    return True
+
+
+def _blob_store(config):
+    """Return the blob store large task arguments and results are offloaded to, defined in the
+    given configuration, or ``None`` if offloading is disabled."""
+    path = config.get('excewo', 'blob_store', fallback='')
+    if not path:
+        return None
+    return BlobStore(path, config.getint('excewo', 'blob_threshold', fallback=2 ** 20),
+                     config.getfloat('excewo', 'blob_ttl', fallback=86400))
+
+
+def _task_profile_dir(config):
+    """Return the path of the directory task profiles are written to."""
+    return config.get('excewo', 'profile_dir',
+                      fallback=(user_cache_dir() / 'profiles-{}'.format(app.main)).as_posix())
+
+
+def _dedup_index(config):
+    """Return the index of task messages defined in the given configuration, or ``None`` if
+    deduplication is disabled."""
+    if not config.getboolean('excewo', 'dedup', fallback=False):
+        return None
+    path = config.get('excewo', 'dedup_index',
+                      fallback=(user_cache_dir() / 'dedup-{}.sqlite'.format(app.main)).as_posix())
+    index = DedupIndex(path, config.getint('excewo', 'dedup_max_entries', fallback=100000),
+                       config.getfloat('excewo', 'dedup_ttl', fallback=86400))
+    add_collector('dedup', index.as_prometheus_text)
+    return index
+
+
+def _host_limits(config):
+    """Return the host limits defined in the given configuration, or ``None`` if there are
+    none."""
+    def limit_name(name):
+        # Task names have a dot, unlike plugin names
+        return task_full_name(app, name) if '.' in name else name
+
+    rates = {limit_name(name): rate(value)
+             for name, value in _prefixed_options(config, 'rate_limit').items()}
+    concurrency = {limit_name(name): int(value)
+                   for name, value in _prefixed_options(config, 'concurrency_limit').items()}
+    if not rates and not concurrency:
+        return None
+    bursts = {limit_name(name): float(value)
+              for name, value in _prefixed_options(config, 'rate_burst').items()}
+    path = config.get('excewo', 'limits_file',
+                      fallback=(user_cache_dir() / 'limits-{}'.format(app.main)).as_posix())
+    limits = HostLimits(path, rates, bursts, concurrency)
+    add_collector('limits', limits.as_prometheus_text)
+    return limits
+
+
+def _register_celery_app_tasks(plugin_loading='eager', plugin_manifest_path=None,
+                               plugin_names=None):
+    """Register all tasks found in installed plugins, or only in plugins whose name is in
+    ``plugin_names`` if given.
+
+    In ``lazy`` mode, plugins are only imported in a separate process to find out which tasks they
+    provide, and stand-in tasks importing the real plugin on first execution are registered
+    instead. In ``preload`` mode, plugins are imported as in ``eager`` mode, then warmed up and
+    prepared to be shared by pool processes.
+
+    If a plugin manifest path is given and the manifest is up to date, installed plugins are not
+    scanned. Otherwise, the manifest is written after scanning, unless only some plugins were
+    imported to scan them.
+
+    Return the records describing the registered plugins.
+    """
+    if plugin_loading not in _PLUGIN_LOADING_MODES:
+        raise ValueError('plugin_loading must be one of {}, not "{}"'.format(
+            ', '.join(_PLUGIN_LOADING_MODES), plugin_loading
+        ))
+    start = time.monotonic()
+    rss_before = current_rss()
+    records = load_manifest(plugin_manifest_path, app) if plugin_manifest_path else None
+    if records is None:
+        logging.debug('Scanning installed task plugins')
+        if plugin_loading == 'lazy':
+            records = scan_plugins_isolated(app)
+        else:
+            records = scan_plugins(app, plugin_names)
+        if plugin_manifest_path and (plugin_loading == 'lazy' or plugin_names is None):
+            save_manifest(plugin_manifest_path, app, records)
+        if plugin_names is not None:
+            records = [record for record in records if record['name'] in plugin_names]
+    else:
+        logging.info('Using plugin manifest {}'.format(plugin_manifest_path))
+        if plugin_names is not None:
+            records = [record for record in records if record['name'] in plugin_names]
+        if plugin_loading != 'lazy':
+            import_plugins(app, records)
+    logging.info('Found task plugins: {}'.format(', '.join(
+        record['name'] for record in records if not record.get('error')
+    )))
+    if plugin_loading == 'lazy':
+        with phase('lazy task registration'):
+            stand_ins = register_lazy_tasks(app, records)
+        logging.info('Lazily registered {} tasks in {:.3f}s, using {:.1f} MiB'.format(
+            len(stand_ins), time.monotonic() - start, (current_rss() - rss_before) / 2 ** 20
+        ))
+        logging.info('Deferring plugin imports saves {:.3f}s and {:.1f} MiB in each worker '
+                     'process until a plugin task is first executed'.format(
+                         sum(record['import_seconds'] for record in records),
+                         sum(record['rss_bytes'] for record in records) / 2 ** 20,
+                     ))
+    else:
+        logging.info('Registered task plugins in {:.3f}s, using {:.1f} MiB'.format(
+            time.monotonic() - start, (current_rss() - rss_before) / 2 ** 20
+        ))
+    if plugin_loading == 'preload':
+        with phase('plugin preloading'):
+            preload_plugins(app)
+    return records
 
 
 @contextmanager
-def set_up_worker(log_level=None, excewo_config_path=None, app_name=None, celery_app_config=None):
-    """Context manager that set up the Celery worker with correct name, config and tasks."""
+def set_up_worker(log_level=None, excewo_config_path=None, app_name=None, celery_app_config=None,
+                  plugin_names=None):
+    """Context manager that set up the Celery worker with correct name, config and tasks.
+
+    If ``plugin_names`` is given, only tasks of these plugins are registered.
+    """
     with _log_app(log_level), \
             _celery_app_config(excewo_config_path) as config:
         celery_app_name = (app_name or config.get('excewo', 'celery_app_name', fallback=None))
@@ -125,12 +438,125 @@ def set_up_worker(log_level=None, excewo_config_path=None, app_name=None, celery
         if celery_app_config:
             logging.debug('Reading Celery application configuration from '
                           '{}'.format(celery_app_config))
-            app.config_from_object(celery_app_config, force=True)
+            with phase('Celery configuration loading'):
+                app.config_from_object(celery_app_config, force=True)
         for section in config:
             if section not in ('DEFAULT', 'excewo'):
                 app.conf[section] = dict(config.items(section=section))
         logging.debug('Final Celery application configuration is: {}'.format(app.conf))
-        _register_celery_app_tasks()
+        if plugin_names is None and config.get('excewo', 'plugins', fallback=''):
+            plugin_names = _comma_separated(config.get('excewo', 'plugins'))
+        plugin_loading = config.get('excewo', 'plugin_loading', fallback='eager')
+        plugin_manifest_path = config.get('excewo', 'plugin_manifest',
+                                          fallback=_default_plugin_manifest_path().as_posix())
+        records = _register_celery_app_tasks(plugin_loading, plugin_manifest_path, plugin_names)
+        configure_async_tasks(config.getint('excewo', 'async_in_flight_limit',
+                                            fallback=DEFAULT_IN_FLIGHT_LIMIT))
+        memo_cache_configured = _configure_memo_cache(config)
+        configure_blob_store(_blob_store(config))
+        configure_message_dedup(app, _dedup_index(config))
+        configure_host_limits(app, _host_limits(config))
+        batch_sizes = {plugin: int(size)
+                       for plugin, size in _prefixed_options(config, 'batch_size').items()}
+        batch_flush_intervals = {
+            plugin: float(interval)
+            for plugin, interval in _prefixed_options(config, 'batch_flush_interval').items()
+        }
+        configure_batch_tasks(app, batch_sizes, batch_flush_intervals)
+        # Installed below, before plugins can be reloaded
+        accounting_installer = metrics_installer = None
+        if config.getboolean('excewo', 'plugin_reload', fallback=False):
+            def on_reload():
+                nonlocal memo_cache_configured
+                # Reloaded batch tasks get the configured batch sizes and intervals again
+                configure_batch_tasks(app, batch_sizes, batch_flush_intervals)
+                if not memo_cache_configured:
+                    memo_cache_configured = _configure_memo_cache(config)
+                # New tasks are accounted for and measured too
+                for installer in (accounting_installer, metrics_installer):
+                    if installer is not None:
+                        installer.add_registered_tasks()
+
+            configure_plugin_reload(
+                app,
+                PluginReloader(app, records, plugin_loading, plugin_names, plugin_manifest_path,
+                               on_reload=on_reload),
+                config.getfloat('excewo', 'plugin_watch_interval', fallback=0) or None,
+            )
+        event_mode = config.get('excewo', 'event_mode', fallback='all')
+        if event_mode not in _EVENT_MODES:
+            raise ValueError('event_mode must be one of {}, not "{}"'.format(
+                ', '.join(_EVENT_MODES), event_mode
+            ))
+        configure_task_event_aggregation(
+            config.getfloat('excewo', 'event_summary_interval', fallback=5.0)
+            if event_mode == 'aggregate' else None,
+            config.getfloat('excewo', 'event_sample_rate', fallback=0.0),
+        )
+        result_writes = config.get('excewo', 'result_writes', fallback='immediate')
+        if result_writes not in _RESULT_WRITE_MODES:
+            raise ValueError('result_writes must be one of {}, not "{}"'.format(
+                ', '.join(_RESULT_WRITE_MODES), result_writes
+            ))
+        if result_writes == 'buffered':
+            configure_result_buffering(
+                app,
+                config.getint('excewo', 'result_buffer_size', fallback=100),
+                config.getfloat('excewo', 'result_buffer_delay', fallback=0.1),
+                config.getboolean('excewo', 'result_coalesce', fallback=True),
+                config.getboolean('excewo', 'result_buffer_acks_late', fallback=False),
+            )
+        configure_chain_fusion(
+            config.getboolean('excewo', 'chain_fusion', fallback=False),
+            {plugin: config.getboolean('excewo', 'chain_fusion.' + plugin)
+             for plugin in _prefixed_options(config, 'chain_fusion')},
+        )
+        if config.getboolean('excewo', 'plugin_queues', fallback=False):
+            configure_plugin_queues(
+                app,
+                {queue: _comma_separated(plugins)
+                 for queue, plugins in _prefixed_options(config, 'plugin_queue').items()},
+                {queue: int(capacity)
+                 for queue, capacity in _prefixed_options(config, 'queue_capacity').items()},
+            )
+        memory_budgets = {
+            plugin: int(float(budget) * 2 ** 20)
+            for plugin, budget in _prefixed_options(config, 'memory_budget').items()
+        }
+        if config.getboolean('excewo', 'task_accounting', fallback=False) or memory_budgets:
+            accounting_installer = configure_task_accounting(app, memory_budgets)
+        trace_output = config.get('excewo', 'trace_output', fallback='')
+        if trace_output:
+            configure_task_tracing(
+                SpanExporter(trace_output, app.main,
+                             config.getint('excewo', 'trace_batch_size', fallback=512)),
+                config.getfloat('excewo', 'trace_sample_rate', fallback=1.0),
+            )
+        profile_tasks = _comma_separated(config.get('excewo', 'profile_tasks', fallback=''))
+        if profile_tasks:
+            configure_task_profiling(
+                [task_full_name(app, task_name) for task_name in profile_tasks],
+                config.getfloat('excewo', 'profile_sample_rate', fallback=0.01),
+                _task_profile_dir(config),
+            )
+        metrics_port = config.get('excewo', 'metrics_port', fallback='')
+        autoscale = config.getboolean('excewo', 'autoscale', fallback=False)
+        if metrics_port or autoscale:
+            # The autoscaler reads task metrics, even if they are not served
+            metrics_installer = install_metrics(
+                app, int(metrics_port) if metrics_port else None,
+                config.get('excewo', 'metrics_address', fallback='127.0.0.1'),
+            )
+        if autoscale:
+            configure_adaptive_autoscaler(
+                app, metrics_installer,
+                config.getint('excewo', 'autoscale_min_concurrency', fallback=1),
+                config.getint('excewo', 'autoscale_max_concurrency', fallback=0) or None,
+                config.getint('excewo', 'autoscale_min_prefetch', fallback=1),
+                config.getint('excewo', 'autoscale_max_prefetch', fallback=64),
+                config.getfloat('excewo', 'autoscale_queue_wait_target', fallback=1.0),
+                config.getfloat('excewo', 'autoscale_prefetch_seconds', fallback=1.0),
+            )
         yield
 
 
@@ -138,20 +564,54 @@ def start_daemon():
     """Start the right daemon, depending on command line argments."""
     cli_args = _command_line_arguments()
     command = cli_args.command
+    # Logging a message first would implicitly configure logging with default settings
+    _configure_logging(cli_args.log_level)
     logging.debug('Launching {}'.format(command))
     if command == 'worker':
         start_worker(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
-                     cli_args.celery_app_config, cli_args.worker_args[1:])
+                     cli_args.celery_app_config, cli_args.worker_args[1:], cli_args.plugin_names)
     elif command == 'flower':
         start_flower(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
-                     cli_args.celery_app_config)
-
-
-def start_worker(log_level, excewo_config_path, app_name, celery_app_config, worker_args):
+                     cli_args.celery_app_config, cli_args.plugin_names)
+    elif command == 'profile-startup':
+        profile_startup(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+                        cli_args.celery_app_config, cli_args.output_format, cli_args.plugin_names)
+    elif command == 'bench':
+        bench(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+              cli_args.celery_app_config, cli_args.tasks, cli_args.messages, cli_args.pools,
+              cli_args.concurrency_levels, cli_args.task_args, cli_args.task_kwargs,
+              cli_args.output_format, cli_args.plugin_names, cli_args.trace)
+    elif command == 'load':
+        load(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+             cli_args.celery_app_config, cli_args.tasks, cli_args.templates_path,
+             cli_args.task_args, cli_args.task_kwargs, cli_args.rates, cli_args.bursts,
+             cli_args.burst_interval, cli_args.duration, cli_args.timeout, cli_args.all_steps,
+             cli_args.broker_url, cli_args.result_backend_url, cli_args.pool,
+             cli_args.concurrency, cli_args.seed, cli_args.output_format, cli_args.plugin_names)
+    elif command == 'memo-stats':
+        memo_stats(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+                   cli_args.output_format, cli_args.clear)
+    elif command == 'task-usage':
+        task_usage(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+                   cli_args.celery_app_config, cli_args.output_format, cli_args.limit,
+                   cli_args.timeout, cli_args.plugin_names)
+    elif command == 'dump-task-profiles':
+        dump_profiles(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+                      cli_args.output_directory)
+    elif command == 'cluster':
+        start_cluster(cli_args.log_level, cli_args.cli_config_path, cli_args.celery_app_name,
+                      cli_args.celery_app_config)
+
+
+def start_worker(log_level, excewo_config_path, app_name, celery_app_config, worker_args,
+                 plugin_names=None):
     """Start the Celery worker."""
     with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
-                       app_name=app_name, celery_app_config=celery_app_config):
+                       app_name=app_name, celery_app_config=celery_app_config,
+                       plugin_names=plugin_names):
         worker_args = ['excewo'] + worker_args
+        if not any(arg.startswith('--autoscale') for arg in worker_args):
+            worker_args.extend(autoscale_worker_args())
         if log_level:
             worker_args.extend(['-l', _LOG_LEVEL_MAP[log_level]])
         logging.debug('Running Celery worker with arguments: {}'.format(
@@ -160,15 +620,229 @@ def start_worker(log_level, excewo_config_path, app_name, celery_app_config, wor
         app.worker_main(argv=worker_args)
 
 
-def start_flower(log_level, excewo_config_path, app_name, celery_app_config):
+def start_flower(log_level, excewo_config_path, app_name, celery_app_config, plugin_names=None):
     """Start the flower daemon."""
     with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
-                       app_name=app_name, celery_app_config=celery_app_config):
+                       app_name=app_name, celery_app_config=celery_app_config,
+                       plugin_names=plugin_names):
         logging.debug('Running Celery Flower')
+        # Workers may send summaries of task events instead of task events
+        count_task_summaries_in_flower()
         flower = FlowerCommand(app=app)
         flower.execute_from_commandline()
 
 
+def profile_startup(log_level, excewo_config_path, app_name, celery_app_config,
+                    output_format='text', plugin_names=None):
+    """Set up the worker without starting it, and print a profile of its startup."""
+    with profiling() as profile:
+        with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
+                           app_name=app_name, celery_app_config=celery_app_config,
+                           plugin_names=plugin_names):
+            pass
+    profile.app_name = app.main
+    print(profile.as_json() if output_format == 'json' else profile.as_text())
+
+
+def bench(log_level, excewo_config_path, app_name, celery_app_config, task_names, messages,
+          pools, concurrency_levels, task_args=(), task_kwargs=None, output_format='text',
+          plugin_names=None, trace=False):
+    """Benchmark the given plugin tasks for each pool and concurrency level, and print
+    results."""
+    results = []
+    with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
+                       app_name=app_name, celery_app_config=celery_app_config,
+                       plugin_names=plugin_names):
+        unknown_task_names = [task_name for task_name in task_names
+                              if task_full_name(app, task_name) not in app.tasks]
+        if unknown_task_names:
+            raise SystemExit('excewo bench: error: unknown tasks: {}'.format(
+                ', '.join(unknown_task_names)
+            ))
+        for task_name in task_names:
+            for pool in pools:
+                for concurrency in ([1] if pool == 'solo' else concurrency_levels):
+                    logging.info('Benchmarking {} with {} pool and concurrency {}'.format(
+                        task_name, pool, concurrency
+                    ))
+                    results.append(run_benchmark(app, task_name, messages, pool, concurrency,
+                                                 task_args, task_kwargs, trace=trace))
+    print(json.dumps(results, indent=2) if output_format == 'json' else format_results(results))
+
+
+def load(log_level, excewo_config_path, app_name, celery_app_config, task_names,
+         templates_path=None, task_args=(), task_kwargs=None, rates=_LOAD_RATES, bursts=None,
+         burst_interval=1.0, duration=10.0, timeout=60.0, all_steps=False, broker_url=None,
+         result_backend_url=None, pool='solo', concurrency=1, seed=None, output_format='text',
+         plugin_names=None):
+    """Publish synthetic messages of the given plugin tasks, or built from the templates file, at
+    each rate or in bursts of each size, and print throughput and latency of each step."""
+    if bursts:
+        steps = [{'burst': burst, 'interval': burst_interval, 'duration': duration}
+                 for burst in bursts]
+    else:
+        steps = [{'rate': rate, 'duration': duration} for rate in rates]
+    with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
+                       app_name=app_name, celery_app_config=celery_app_config,
+                       plugin_names=plugin_names):
+        if templates_path:
+            templates = ArgumentTemplates.from_file(templates_path)
+        elif task_names:
+            templates = ArgumentTemplates([
+                {'task': task_name, 'args': task_args, 'kwargs': task_kwargs or {}}
+                for task_name in task_names
+            ])
+        else:
+            raise SystemExit('excewo load: error: give task names or a templates file')
+        unknown_task_names = [task_name for task_name in templates.task_names
+                              if task_full_name(app, task_name) not in app.tasks]
+        if unknown_task_names:
+            raise SystemExit('excewo load: error: unknown tasks: {}'.format(
+                ', '.join(unknown_task_names)
+            ))
+        if broker_url:
+            app.conf.broker_url = broker_url
+        if result_backend_url:
+            app.conf.result_backend = result_backend_url
+            del app.backend  # Created again from the new configuration
+        results = run_load(app, templates, steps, timeout, not all_steps, pool, concurrency,
+                           seed)
+    print(json.dumps(results, indent=2) if output_format == 'json'
+          else format_load_results(results))
+
+
+def memo_stats(log_level, excewo_config_path, app_name, output_format='text', clear=False):
+    """Print statistics of the cache of results of pure tasks, and clear it if asked to."""
+    with _log_app(log_level), _celery_app_config(excewo_config_path) as config:
+        app.main = app_name or config.get('excewo', 'celery_app_name', fallback=app.main)
+        cache = _memo_cache(config)
+        if cache is None:
+            raise SystemExit('excewo memo-stats: error: the result cache is disabled')
+        stats = cache.stats()
+        if clear:
+            cache.clear()
+    if output_format == 'json':
+        print(json.dumps(stats, indent=2))
+        return
+    task_width = max([len('Task')] + [len(task) for task in stats])
+    print('{:<{}} {:>10} {:>10} {:>8} {:>10}'.format('Task', task_width, 'Hits', 'Misses',
+                                                     'Results', 'Bytes'))
+    for task, task_stats in stats.items():
+        print('{:<{}} {:>10} {:>10} {:>8} {:>10}'.format(
+            task, task_width, task_stats['hits'], task_stats['misses'], task_stats['entries'],
+            task_stats['bytes'],
+        ))
+
+
+def task_usage(log_level, excewo_config_path, app_name, celery_app_config, output_format='text',
+               limit=None, timeout=1.0, plugin_names=None):
+    """Print memory and CPU statistics of tasks run by running workers."""
+    with set_up_worker(log_level=log_level, excewo_config_path=excewo_config_path,
+                       app_name=app_name, celery_app_config=celery_app_config,
+                       plugin_names=plugin_names):
+        usage = request_task_usage(app, timeout)
+    if not any(usage.values()):
+        raise SystemExit('excewo task-usage: error: no running worker has task statistics (is '
+                         'task accounting enabled?)')
+    print(json.dumps(usage, indent=2) if output_format == 'json'
+          else format_task_usage(usage, limit))
+
+
+def dump_profiles(log_level, excewo_config_path, app_name, output_directory=None):
+    """Merge profiles of tasks written by worker processes, and print the directory dumps are
+    written to."""
+    with _log_app(log_level), _celery_app_config(excewo_config_path) as config:
+        app.main = app_name or config.get('excewo', 'celery_app_name', fallback=app.main)
+        directory = _task_profile_dir(config)
+    if not (Path(directory).expanduser() / 'raw').is_dir():
+        raise SystemExit('excewo dump-task-profiles: error: no task profile in {}'.format(
+            directory
+        ))
+    print(dump_task_profiles(directory, output_directory))
+
+
+def _cluster_worker_pools(config, app_name, records=()):
+    """Return worker pools defined in the ``[excewo]`` section of the given configuration.
+
+    When plugin queues are enabled, a pool given a list of plugins only consumes the queues of
+    these plugins, unless its worker arguments already select queues. Queues are named after the
+    module segment of the tasks each plugin registers (see ``routing.plugin_name()``), found in the
+    given plugin records, or after the plugin name if it has no record.
+    """
+    shared_queues = {plugin: queue
+                     for queue, plugins in _prefixed_options(config, 'plugin_queue').items()
+                     for plugin in _comma_separated(plugins)}
+    plugin_queues = config.getboolean('excewo', 'plugin_queues', fallback=False)
+    assigned_plugins = _prefixed_options(config, 'cluster_plugins')
+    prefix = app_name + '.'
+    # Task names are ``<application name>.<plugin>.<task>``, where ``<plugin>`` derives from the
+    # module of the task rather than from the entry point name
+    task_plugins = {
+        record['name']: {task_name[len(prefix):].partition('.')[0]
+                         for task_name in record['tasks']
+                         if task_name.startswith(prefix) and '.' in task_name[len(prefix):]}
+        for record in records
+    }
+    pools = []
+    for name, worker_args in sorted(_prefixed_options(config, 'cluster_pool').items()):
+        worker_args = shlex.split(worker_args)
+        plugin_names = (_comma_separated(assigned_plugins[name]) if name in assigned_plugins
+                        else None)
+        if plugin_queues and plugin_names and not any(
+            arg in ('-Q', '--queues') or arg.startswith('--queues=') for arg in worker_args
+        ):
+            worker_args.extend(['-Q', ','.join(sorted({
+                '{}.{}'.format(app_name, shared_queues.get(plugin, plugin))
+                for plugin_name in plugin_names
+                for plugin in task_plugins.get(plugin_name) or (plugin_name,)
+            }))])
+        pools.append(WorkerPool(name, worker_args, plugin_names))
+    return pools
+
+
+def _cluster_plugin_records(config):
+    """Return records of installed plugins, read from the plugin manifest if it is up to date, or
+    scanned in a separate process, so that plugins are not imported by the supervisor."""
+    plugin_manifest_path = config.get('excewo', 'plugin_manifest',
+                                      fallback=_default_plugin_manifest_path().as_posix())
+    records = load_manifest(plugin_manifest_path, app)
+    if records is None:
+        records = scan_plugins_isolated(app)
+        save_manifest(plugin_manifest_path, app, records)
+    return records
+
+
+def start_cluster(log_level, excewo_config_path, app_name, celery_app_config):
+    """Start a worker for each worker pool defined in the configuration, and supervise them."""
+    with _log_app(log_level), _celery_app_config(excewo_config_path) as config:
+        app_name = app_name or config.get('excewo', 'celery_app_name', fallback=app.main)
+        app.main = app_name
+        records = (_cluster_plugin_records(config)
+                   if config.getboolean('excewo', 'plugin_queues', fallback=False) else ())
+        pools = _cluster_worker_pools(config, app_name, records)
+        if not pools:
+            raise SystemExit('excewo cluster: error: no worker pool defined, add '
+                             '`cluster_pool.<name>` options to the [excewo] section')
+        excewo_args = ['-n', app_name]
+        if excewo_config_path:
+            excewo_args.extend(['-a', excewo_config_path])
+        if celery_app_config:
+            excewo_args.extend(['--config', celery_app_config])
+        if log_level:
+            excewo_args.extend(['-l', _LOG_LEVEL_MAP[log_level]])
+        cluster = Cluster(
+            {pool.name: pool.command(excewo_args) for pool in pools},
+            shutdown_timeout=config.getfloat('excewo', 'cluster_shutdown_timeout',
+                                             fallback=60.0),
+        )
+        logging.info('Starting worker pools: {}'.format(', '.join(
+            '{} ({})'.format(pool.name, ', '.join(pool.plugin_names)
+                             if pool.plugin_names is not None else 'all plugins')
+            for pool in pools
+        )))
+        cluster.run()
+
+
 main = start_daemon
 
 
@@ -0,0 +1,257 @@
+"""Per-task accounting of resident memory growth and CPU time, and recycling of pool processes
+exceeding the memory budget of a plugin.
+
+Each process running tasks measures its resident set size and the CPU time of the running thread
+before and after each task, and adds the differences to statistics of the task, stored in an
+anonymous shared memory map with one slot per process (as task metrics are, see ``metrics``). The
+worker main process sums all slots when asked with the ``task_usage`` remote control command (see
+``excewo task-usage``).
+
+Each pool process also sums the memory growth of tasks of each plugin since it started. When it
+exceeds the memory budget of the plugin, the process exits once its current task is done, and the
+pool replaces it with a fresh process (this requires the prefork pool). Other processes are not
+recycled, unlike with ``worker_max_tasks_per_child`` or ``worker_max_memory_per_child``.
+
+Memory growth (and CPU time, with Python < 3.7) is only attributed accurately to tasks when each
+process runs one task at a time (prefork and solo pools).
+"""
+
+
+__all__ = ('TaskUsage', 'configure_task_accounting', 'format_task_usage', 'request_task_usage')
+
+
+import logging
+import mmap
+import os
+import threading
+import time
+
+from billiard.process import current_process
+from celery import signals
+from celery.worker.control import inspect_command
+
+from extensible_celery_worker.memory import current_rss
+from extensible_celery_worker.routing import plugin_name
+
+
+#: Statistics of each task, by process
+FIELDS = ('tasks', 'cpu_seconds', 'rss_growth', 'max_rss_growth', 'recycles')
+
+_TASK_SIZE = len(FIELDS)
+
+_TASK_SIGNAL_UIDS = (
+    (signals.task_prerun, 'excewo_accounting_prerun'),
+    (signals.task_postrun, 'excewo_accounting_postrun'),
+)
+
+_usage = None
+
+# Python < 3.7 has no ``time.thread_time()``: the CPU time of the process is the same when it runs
+# one task at a time, as prefork and solo pool processes do
+_thread_time = getattr(time, 'thread_time', None) or time.process_time
+
+
+class TaskUsage:
+    """Memory and CPU statistics of the given tasks, for the given number of processes, and
+    memory budgets of plugins (mapping plugin names to a number of bytes).
+
+    Slot 0 is used by the process which creates the instance, slot ``n`` by the pool process with
+    index ``n - 1``.
+    """
+
+    def __init__(self, app, task_names, processes=1, budgets=None):
+        self.app = app
+        self.slots = processes + 1
+        self.budgets = budgets or {}
+        self._slot = 0
+        self._lock = threading.Lock()
+        self._started = {}
+        self._plugin_growth = {}
+        self._recycling = False
+        #: Tables of statistics replaced by ``add_tasks()``, still summed
+        self._retired = []
+        self._allocate(task_names)
+
+    def _allocate(self, task_names):
+        self.task_names = sorted(task_names)
+        self._task_indexes = {name: index for index, name in enumerate(self.task_names)}
+        self._slot_size = len(self.task_names) * _TASK_SIZE
+        self._map = mmap.mmap(-1, max(1, self.slots * self._slot_size) * 8)
+        self._values = memoryview(self._map).cast('d')
+        self._tables = self._retired + [(self._values, self._task_indexes, self._slot_size)]
+
+    def use_process_slot(self):
+        """Make the current process write to its own slot (from a pool process)."""
+        index = getattr(current_process(), 'index', None)
+        self._slot = index + 1 if index is not None else 0
+        self._lock = threading.Lock()
+        self._started = {}
+        self._plugin_growth = {}
+        self._recycling = False
+
+    def add_tasks(self, task_names):
+        """Account the given tasks too, from the worker main process before pool processes are
+        forked again (after plugins are reloaded).
+
+        Statistics are then written to a new memory map. The previous one is still summed, so
+        that statistics written to it by pool processes forked before are kept.
+        """
+        new_task_names = set(task_names) - set(self.task_names)
+        if not new_task_names:
+            return
+        with self._lock:
+            self._retired.append((self._values, self._task_indexes, self._slot_size))
+            self._allocate(self.task_names + sorted(new_task_names))
+
+    def on_task_prerun(self, task_id=None, task=None, **kwargs):
+        if task.name in self._task_indexes:
+            self._started[task_id] = (current_rss(), _thread_time())
+
+    def on_task_postrun(self, task_id=None, task=None, **kwargs):
+        started = self._started.pop(task_id, None)
+        if started is None:
+            return
+        rss_before, cpu_before = started
+        growth = current_rss() - rss_before
+        with self._lock:
+            values = self._values
+            offset = self._slot * self._slot_size + self._task_indexes[task.name] * _TASK_SIZE
+            values[offset] += 1
+            values[offset + 1] += _thread_time() - cpu_before
+            values[offset + 2] += growth
+            values[offset + 3] = max(values[offset + 3], growth)
+            plugin = plugin_name(self.app, task.name)
+            plugin_growth = self._plugin_growth.get(plugin, 0) + growth
+            self._plugin_growth[plugin] = plugin_growth
+            budget = self.budgets.get(plugin)
+            if budget is None or plugin_growth <= budget or self._recycling:
+                return
+            if self._recycle():
+                values[offset + 4] += 1
+        logging.warning('Recycling pool process {}: tasks of plugin {} grew its memory by '
+                        '{:.1f} MiB (budget: {:.1f} MiB)'.format(
+                            os.getpid(), plugin, plugin_growth / 2 ** 20, budget / 2 ** 20
+                        ))
+
+    def _recycle(self):
+        """Make the current pool process exit once its current task is done, and return whether
+        it will."""
+        # Event set by the pool to restart its processes (see ``worker_pool_restarts``)
+        shutdown = getattr(getattr(current_process(), '_target', None), '_shutdown', None)
+        if shutdown is None:
+            return False
+        shutdown.set()
+        self._recycling = True
+        return True
+
+    def totals(self):
+        """Return a mapping of task names to their statistics summed over all slots, for tasks
+        which ran."""
+        totals = {}
+        tables = self._tables
+        for name in self.task_names:
+            task_totals = dict.fromkeys(FIELDS, 0.0)
+            for values, task_indexes, slot_size in tables:
+                if name not in task_indexes:
+                    continue
+                for slot in range(self.slots):
+                    offset = slot * slot_size + task_indexes[name] * _TASK_SIZE
+                    for field, value in zip(FIELDS, values[offset:offset + _TASK_SIZE]):
+                        if field == 'max_rss_growth':
+                            task_totals[field] = max(task_totals[field], value)
+                        else:
+                            task_totals[field] += value
+            if task_totals['tasks']:
+                task_totals['plugin'] = plugin_name(self.app, name)
+                task_totals['budget'] = self.budgets.get(task_totals['plugin'])
+                totals[name] = task_totals
+        return totals
+
+
+class _AccountingInstaller:
+    """Signal handlers allocating task statistics for the worker."""
+
+    def __init__(self, app, budgets):
+        self.app = app
+        self.budgets = budgets
+
+    def on_worker_init(self, sender=None, **kwargs):
+        global _usage
+        # Autoscaled pools may grow up to their maximum concurrency
+        autoscale = getattr(sender, 'options', {}).get('autoscale')
+        if isinstance(autoscale, str):
+            autoscale = autoscale.split(',')
+        processes = max(sender.concurrency or 1, int(autoscale[0]) if autoscale else 0)
+        # Built-in Celery tasks are not tracked
+        task_names = [name for name in self.app.tasks if not name.startswith('celery.')]
+        _usage = TaskUsage(self.app, task_names, processes, self.budgets)
+        for signal, dispatch_uid in _TASK_SIGNAL_UIDS:
+            signal.disconnect(dispatch_uid=dispatch_uid)
+        signals.task_prerun.connect(_usage.on_task_prerun, weak=False,
+                                    dispatch_uid='excewo_accounting_prerun')
+        signals.task_postrun.connect(_usage.on_task_postrun, weak=False,
+                                     dispatch_uid='excewo_accounting_postrun')
+
+    def on_worker_process_init(self, **kwargs):
+        if _usage is not None:
+            _usage.use_process_slot()
+
+    def add_registered_tasks(self):
+        """Account tasks registered since the worker started, after plugins are reloaded."""
+        if _usage is not None:
+            _usage.add_tasks(name for name in self.app.tasks if not name.startswith('celery.'))
+
+
+def configure_task_accounting(app, budgets=None):
+    """Account memory growth and CPU time of plugin tasks of the given application in workers,
+    and recycle pool processes whose tasks of a plugin grew memory beyond the budget of the plugin.
+
+    ``budgets`` maps plugin names to a number of bytes.
+    """
+    installer = _AccountingInstaller(app, budgets or {})
+    if budgets:
+        # Pool processes are recycled as the pool restarts them
+        app.conf.worker_pool_restarts = True
+    signals.worker_init.connect(installer.on_worker_init, weak=False,
+                                dispatch_uid='excewo_accounting_worker_init')
+    signals.worker_process_init.connect(installer.on_worker_process_init, weak=False,
+                                        dispatch_uid='excewo_accounting_worker_process_init')
+    return installer
+
+
+@inspect_command()
+def task_usage(state, **kwargs):
+    """Return memory and CPU statistics of each task run by the worker."""
+    return _usage.totals() if _usage is not None else {}
+
+
+def request_task_usage(app, timeout=1.0):
+    """Return a mapping of names of running workers of the given application to their task
+    statistics."""
+    replies = app.control.broadcast('task_usage', reply=True, timeout=timeout)
+    return {hostname: usage for reply in replies or () for hostname, usage in reply.items()}
+
+
+def format_task_usage(usage, limit=None):
+    """Return a text table of the given task statistics by worker (as returned by
+    ``request_task_usage``), with tasks growing memory the most first."""
+    rows = sorted(((hostname, task, stats) for hostname, tasks in usage.items()
+                   for task, stats in tasks.items()),
+                  key=lambda row: row[2]['rss_growth'], reverse=True)[:limit]
+    task_width = max([len('Task')] + [len(task) for _, task, _ in rows])
+    plugin_width = max([len('Plugin')] + [len(str(stats['plugin'])) for _, _, stats in rows])
+    worker_width = max([len('Worker')] + [len(hostname) for hostname, _, _ in rows])
+    line = '{:<{}} {:<{}} {:<{}} {:>8} {:>12} {:>12} {:>12} {:>14} {:>8}'
+    lines = [line.format('Task', task_width, 'Plugin', plugin_width, 'Worker', worker_width,
+                         'Tasks', 'Avg CPU ms', 'Avg RSS KiB', 'Max RSS KiB', 'Total RSS MiB',
+                         'Recycles')]
+    for hostname, task, stats in rows:
+        tasks = stats['tasks']
+        lines.append(line.format(
+            task, task_width, str(stats['plugin']), plugin_width, hostname, worker_width,
+            int(tasks), '{:.2f}'.format(stats['cpu_seconds'] / tasks * 1000),
+            '{:.1f}'.format(stats['rss_growth'] / tasks / 2 ** 10),
+            '{:.1f}'.format(stats['max_rss_growth'] / 2 ** 10),
+            '{:.1f}'.format(stats['rss_growth'] / 2 ** 20), int(stats['recycles']),
+        ))
+    return '\n'.join(lines)
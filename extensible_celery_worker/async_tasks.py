@@ -0,0 +1,126 @@
+"""Tasks defined with ``async def``.
+
+Coroutines of these tasks run on a long-lived event loop of the process running the task (each
+pool process has its own), in a thread of its own. The thread executing the task waits for its
+coroutine to finish, so that the task is acknowledged and its result stored as for any other task.
+With the threads pool, the coroutines of all threads of a process are then run concurrently by the
+same event loop, and a single process can wait for hundreds of I/O-bound tasks at the same time.
+At most ``in_flight_limit`` coroutines run concurrently in each process, others wait for their
+turn.
+"""
+
+
+__all__ = ('DEFAULT_IN_FLIGHT_LIMIT', 'AsyncTask', 'configure_async_tasks', 'run_coroutine')
+
+
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+from celery import Task
+from celery.app.task import Context
+
+
+#: Default maximum number of coroutines of tasks running at the same time in a process
+DEFAULT_IN_FLIGHT_LIMIT = 100
+
+_in_flight_limit = DEFAULT_IN_FLIGHT_LIMIT
+
+_event_loop = None
+
+_event_loop_lock = threading.Lock()
+
+# Python < 3.7 has no ``asyncio.current_task()``
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class _EventLoopThread:
+    """Event loop running forever in a daemon thread, for the process which creates it."""
+
+    def __init__(self, in_flight_limit):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.in_flight_limit = in_flight_limit
+        self._semaphore = None
+        self.thread = threading.Thread(target=self._run, name='excewo-asyncio', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _limited(self, coro):
+        """Await the given coroutine once less than ``in_flight_limit`` coroutines run."""
+        if self._semaphore is None:  # Created in the loop thread, for Python < 3.10
+            self._semaphore = asyncio.Semaphore(self.in_flight_limit)
+        async with self._semaphore:
+            return await coro
+
+    def run(self, coro):
+        """Run the given coroutine on the event loop, wait for it and return its result."""
+        future = asyncio.run_coroutine_threadsafe(self._limited(coro), self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # For instance, the soft time limit of the task is exceeded
+            future.cancel()
+            raise
+
+
+def configure_async_tasks(in_flight_limit):
+    """Set the maximum number of coroutines of tasks running at the same time in a process (to
+    be called before the event loop of the process is started)."""
+    global _in_flight_limit
+    _in_flight_limit = in_flight_limit
+
+
+def run_coroutine(coro):
+    """Run the given coroutine on the event loop of the current process, wait for it and return
+    its result."""
+    global _event_loop
+    event_loop = _event_loop
+    # Threads do not survive forks: pool processes start their own event loop
+    if event_loop is None or event_loop.pid != os.getpid():
+        with _event_loop_lock:
+            if _event_loop is None or _event_loop.pid != os.getpid():
+                _event_loop = _EventLoopThread(_in_flight_limit)
+                logging.debug('Started event loop for async tasks in process {}'.format(
+                    os.getpid()
+                ))
+            event_loop = _event_loop
+    return event_loop.run(coro)
+
+
+class AsyncTask(Task):
+    """Base class of tasks whose ``run()`` method is a coroutine function.
+
+    In the coroutine, ``self.request`` is the request of the task, as for other tasks.
+    """
+
+    # Requests of coroutines running on the event loop, by ``asyncio`` task
+    _async_requests = weakref.WeakKeyDictionary()
+
+    def __call__(self, *args, **kwargs):
+        request = self.request_stack.top or Context(args=args, kwargs=kwargs)
+        return run_coroutine(self._run_with_request(request, args, kwargs))
+
+    async def _run_with_request(self, request, args, kwargs):
+        """Run the task coroutine, making ``request`` its request."""
+        current_task = _current_task()
+        self._async_requests[current_task] = request
+        try:
+            return await self.run(*args, **kwargs)
+        finally:
+            self._async_requests.pop(current_task, None)
+
+    def _get_request(self):
+        try:
+            current_task = _current_task()
+        except RuntimeError:  # No event loop in this thread
+            current_task = None
+        request = self._async_requests.get(current_task) if current_task is not None else None
+        return request if request is not None else super()._get_request()
+
+    request = property(_get_request)
@@ -0,0 +1,205 @@
+"""Pool size and prefetch count adapted to observed task runtimes and queue wait times.
+
+The autoscaler reads task metrics (see ``metrics``) collected by all pool processes, and keeps
+exponential moving averages of the runtime and queue wait time of each task, and of the number of
+tasks completed between updates. Averages of all tasks are weighted by these completion rates.
+
+The pool grows when more messages are reserved than there are processes and they waited longer
+than the queue wait target on average, and shrinks when fewer messages are reserved and they
+waited less than half the target, or hardly any task ran lately (Celery waits for
+``AUTOSCALE_KEEPALIVE`` seconds after growing before it shrinks the pool). Only pools which can be
+resized (prefork, eventlet and gevent) are scaled, the prefetch count of other pools is adapted
+all the same.
+
+The prefetch multiplier is set so that each process has messages for about ``prefetch_seconds``
+seconds of work reserved: a high multiplier for short tasks saves broker round-trips, while a long
+task does not hold messages other processes could run.
+"""
+
+
+__all__ = ('AdaptiveAutoscaler', 'autoscale_worker_args', 'configure_adaptive_autoscaler')
+
+
+import logging
+import os
+import time
+
+from celery.worker.autoscale import Autoscaler
+
+from extensible_celery_worker.metrics import BUCKETS, histogram_offset
+
+
+#: Weight of the latest observations in moving averages
+SMOOTHING = 0.3
+
+_settings = None
+
+# Offsets in task totals of the sum and count of histograms
+_RUNTIME = histogram_offset('runtime')
+_QUEUE_WAIT = histogram_offset('queue_wait')
+_BUCKET_COUNT = len(BUCKETS) + 1
+
+
+class _Settings:
+    """Bounds and targets of the adaptive autoscaler, and installer of the metrics it reads."""
+
+    def __init__(self, metrics_installer, min_concurrency, max_concurrency, min_prefetch,
+                 max_prefetch, queue_wait_target, prefetch_seconds, update_interval):
+        self.metrics_installer = metrics_installer
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_prefetch = min_prefetch
+        self.max_prefetch = max_prefetch
+        self.queue_wait_target = queue_wait_target
+        self.prefetch_seconds = prefetch_seconds
+        self.update_interval = update_interval
+
+
+def configure_adaptive_autoscaler(app, metrics_installer, min_concurrency=1, max_concurrency=None,
+                                  min_prefetch=1, max_prefetch=64, queue_wait_target=1.0,
+                                  prefetch_seconds=1.0, update_interval=1.0):
+    """Make workers of the given application use the adaptive autoscaler, within the given bounds.
+
+    ``metrics_installer`` is the object returned by ``install_metrics()``. ``max_concurrency``
+    defaults to the number of CPUs. The autoscaler is only enabled if the worker is started with
+    the arguments returned by ``autoscale_worker_args()``, or with its own ``--autoscale``
+    argument.
+    """
+    global _settings
+    _settings = _Settings(metrics_installer, min_concurrency,
+                          max_concurrency or os.cpu_count() or 2, min_prefetch, max_prefetch,
+                          queue_wait_target, prefetch_seconds, update_interval)
+    app.conf.worker_autoscaler = 'extensible_celery_worker.autoscale:AdaptiveAutoscaler'
+
+
+def autoscale_worker_args():
+    """Return Celery worker arguments enabling the configured autoscaler, if any."""
+    if _settings is None:
+        return []
+    return ['--autoscale', '{},{}'.format(_settings.max_concurrency, _settings.min_concurrency)]
+
+
+def _weighted_mean(averages, weights):
+    """Return the mean of the given averages by task, weighted by the given weights by task, or
+    ``None`` if there is no average."""
+    total_weight = sum(weights.get(task_name, 0.0) for task_name in averages)
+    if not total_weight:
+        return None
+    return sum(average * weights.get(task_name, 0.0)
+               for task_name, average in averages.items()) / total_weight
+
+
+def _update_average(averages, task_name, value):
+    """Add a value to the moving average of the given task."""
+    averages[task_name] = (value if task_name not in averages else
+                           SMOOTHING * value + (1 - SMOOTHING) * averages[task_name])
+
+
+class AdaptiveAutoscaler(Autoscaler):
+    """Autoscaler adapting pool size and prefetch count to moving averages of task runtimes and
+    queue wait times."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settings = _settings
+        #: Moving averages of runtimes, queue wait times and completed tasks by update, by task
+        self.runtimes = {}
+        self.queue_waits = {}
+        self.rates = {}
+        self._previous_totals = {}
+        self._last_update = None
+        self.prefetch_multiplier = None
+
+    def _observe(self):
+        """Update moving averages with task metrics collected since the previous update."""
+        metrics = self.settings.metrics_installer.metrics
+        if metrics is None:
+            return
+        for task_name in metrics.task_names:
+            totals = metrics.totals(task_name)
+            previous = self._previous_totals.get(task_name)
+            self._previous_totals[task_name] = totals
+            if previous is None:
+                continue
+            counts = {}
+            for averages, offset in ((self.runtimes, _RUNTIME), (self.queue_waits, _QUEUE_WAIT)):
+                counts[offset] = count = (sum(totals[offset + 1:offset + 1 + _BUCKET_COUNT]) -
+                                          sum(previous[offset + 1:offset + 1 + _BUCKET_COUNT]))
+                if count:
+                    mean = (totals[offset] - previous[offset]) / count
+                    _update_average(averages, task_name, mean)
+            _update_average(self.rates, task_name, counts[_RUNTIME])
+
+    def _maybe_scale(self, req=None):
+        # Also called for each received message: averages are updated at most once per interval
+        now = time.monotonic()
+        if self._last_update is not None and \
+                now - self._last_update < self.settings.update_interval:
+            return False
+        self._last_update = now
+        self._observe()
+        scaled = self._scale_pool()
+        self._update_prefetch()
+        return scaled
+
+    def _scale_pool(self):
+        """Grow or shrink the pool, return whether it was resized."""
+        queue_wait = _weighted_mean(self.queue_waits, self.rates)
+        # Solo and threads pools cannot be resized
+        if queue_wait is None or not hasattr(self.pool, 'grow'):
+            return False
+        procs = self.processes
+        qty = self.qty
+        target = self.settings.queue_wait_target
+        if qty > procs and queue_wait > target and procs < self.max_concurrency:
+            n = min(qty, self.max_concurrency) - procs
+            logging.info('Growing pool by {} processes: {} messages reserved for {} processes, '
+                         'waiting {:.3f}s on average (target: {:.3f}s)'.format(
+                             n, qty, procs, queue_wait, target
+                         ))
+            self.scale_up(n)
+            return True
+        # Idle processes, and messages did not wait or hardly any task ran lately
+        if qty < procs and procs > self.min_concurrency and (
+            queue_wait < target / 2 or sum(self.rates.values()) < 1
+        ):
+            n = procs - max(qty, self.min_concurrency)
+            if self._last_scale_up and time.monotonic() - self._last_scale_up > self.keepalive:
+                logging.info('Shrinking pool by {} processes: {} messages reserved for {} '
+                             'processes, waiting {:.3f}s on average (target: {:.3f}s)'.format(
+                                 n, qty, procs, queue_wait, target
+                             ))
+                self.scale_down(n)
+                return True
+        return False
+
+    def _update_prefetch(self):
+        """Set the prefetch multiplier of the consumer after the average task runtime."""
+        runtime = _weighted_mean(self.runtimes, self.rates)
+        consumer = getattr(self.worker, 'consumer', None)
+        if runtime is None or consumer is None or not consumer.initial_prefetch_count:
+            return  # No task ran yet, or prefetch is disabled (unlimited)
+        multiplier = max(self.settings.min_prefetch, min(
+            self.settings.max_prefetch, round(self.settings.prefetch_seconds / max(runtime, 1e-6))
+        ))
+        prefetch_count = self.processes * multiplier
+        diff = prefetch_count - consumer.initial_prefetch_count
+        if multiplier != self.prefetch_multiplier:
+            logging.info('Setting prefetch multiplier to {}: tasks run for {:.3f}s on '
+                         'average'.format(multiplier, runtime))
+            self.prefetch_multiplier = multiplier
+        if not diff:
+            return
+        consumer.prefetch_multiplier = multiplier
+        consumer.initial_prefetch_count = prefetch_count
+        # Applied by the consumer, which also accounts for messages of tasks with an ETA
+        if diff > 0:
+            consumer.qos.increment_eventually(diff)
+        else:
+            consumer.qos.decrement_eventually(-diff)
+
+    def info(self):
+        info = super().info()
+        info.update(prefetch_multiplier=self.prefetch_multiplier, runtimes=dict(self.runtimes),
+                    queue_waits=dict(self.queue_waits))
+        return info
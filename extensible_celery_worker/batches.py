@@ -0,0 +1,192 @@
+"""Batch tasks, processing messages in chunks instead of one at a time.
+
+The worker buffers messages of a batch task until ``batch_size`` messages are buffered or
+``batch_flush_interval`` seconds elapsed, then runs the task once in the pool with the list of
+argument tuples of all buffered messages. The task returns the list of results, in the same order,
+and each result is stored for its own message. If the task raises an exception, all messages of the
+batch fail with it. Messages are acknowledged once results are stored.
+
+Messages are only buffered by the worker: applied locally (or in lazy plugin loading mode, which
+does not know tasks are batch tasks before they are imported), a batch task is run with a batch of
+one message. Keyword arguments are not supported, and neither are task callbacks (``link``).
+"""
+
+
+__all__ = ('BatchTask', 'configure_batch_tasks')
+
+
+import logging
+import threading
+import time
+import traceback
+
+from celery import Task, current_app
+from celery.app.task import Context
+from celery.utils.imports import symbol_by_name
+from celery.worker.state import task_accepted, task_ready, task_reserved
+from celery.worker.strategy import hybrid_to_proto2, proto1_to_proto2
+from kombu.five import buffer_t
+
+from extensible_celery_worker.blobs import remove_references, resolve_arguments
+from extensible_celery_worker.routing import plugin_name
+
+
+class BatchTask(Task):
+    """Base class of batch tasks, whose function is called with a list of argument tuples and
+    returns the list of results."""
+
+    #: Maximum number of messages in a batch
+    batch_size = 100
+
+    #: Maximum number of seconds a message is buffered before its batch is run
+    batch_flush_interval = 1.0
+
+    def __call__(self, *args, **kwargs):
+        if kwargs:
+            raise TypeError('Batch task {} does not accept keyword arguments'.format(self.name))
+        return self.run([args])[0]
+
+    def Strategy(self, task, app, consumer):
+        return _BatchBuffer(task, app, consumer).on_message
+
+
+def _run_batch(task_name, requests):
+    """Run a batch task with the arguments of the given requests and store each result, in a pool
+    process.
+
+    Return whether the batch succeeded, and the run time or the formatted exception.
+    """
+    task = current_app.tasks[task_name]
+    start = time.monotonic()
+    try:
+        batch, references = [], []
+        for request in requests:
+            args, _, request_references = resolve_arguments(request['args'], {},
+                                                            getattr(task, 'zero_copy', False))
+            batch.append(args)
+            references.extend(request_references)
+        results = list(task.run(batch))
+        if len(results) != len(requests):
+            raise ValueError('Batch task {} returned {} results for {} messages'.format(
+                task_name, len(results), len(requests)
+            ))
+    except Exception as exc:
+        formatted_traceback = traceback.format_exc()
+        logging.error('Batch of {} messages of task {} failed: {!r}'.format(
+            len(requests), task_name, exc
+        ))
+        for request in requests:
+            task.backend.mark_as_failure(request['id'], exc, formatted_traceback,
+                                         request=Context(request))
+        return False, '{!r}\n{}'.format(exc, formatted_traceback)
+    runtime = time.monotonic() - start
+    remove_references(references)
+    if not task.ignore_result:
+        for request, result in zip(requests, results):
+            task.backend.mark_as_done(request['id'], result, request=Context(request))
+    return True, runtime
+
+
+class _BatchBuffer:
+    """Messages of a batch task buffered by the worker consumer."""
+
+    def __init__(self, task, app, consumer):
+        self.task = task
+        self.app = app
+        self.consumer = consumer
+        self.requests = []
+        self._lock = threading.Lock()
+        self._request_cls = symbol_by_name(task.Request)
+        consumer.timer.call_repeatedly(task.batch_flush_interval, self.flush)
+
+    def on_message(self, message, body, ack, reject, callbacks, **kwargs):
+        if body is None and 'args' not in message.payload:
+            body, headers, decoded, utc = (message.body, message.headers, False,
+                                           self.app.uses_utc_timezone())
+            if not self.consumer.pool.body_can_be_buffer and isinstance(body, buffer_t):
+                body = bytes(body)
+        elif 'args' in message.payload:
+            body, headers, decoded, utc = hybrid_to_proto2(message, message.payload)
+        else:
+            body, headers, decoded, utc = proto1_to_proto2(message, body)
+        request = self._request_cls(
+            message, on_ack=ack, on_reject=reject, app=self.app, hostname=self.consumer.hostname,
+            eventer=self.consumer.event_dispatcher, task=self.task,
+            connection_errors=self.consumer.connection_errors, body=body, headers=headers,
+            decoded=decoded, utc=utc,
+        )
+        if (request.expires or request.id in self.consumer.controller.state.revoked) and \
+                request.revoked():
+            return
+        task_reserved(request)
+        if callbacks:
+            for callback in callbacks:
+                callback(request)
+        # Buffered messages do not prevent the worker from receiving other messages
+        self.consumer.qos.increment_eventually()
+        with self._lock:
+            self.requests.append(request)
+            full = len(self.requests) >= self.task.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Run buffered messages as a batch in the pool."""
+        with self._lock:
+            requests, self.requests = self.requests, []
+        if not requests:
+            return
+        payload_requests = []
+        for request in requests:
+            _, _, embed = request._payload
+            payload_requests.append(dict(request.request_dict, **(embed or {})))
+
+        def on_accepted(pid, time_accepted):
+            for request in requests:
+                task_accepted(request)
+                request.send_event('task-started')
+
+        def on_done(retval):
+            succeeded, runtime_or_error = retval
+            self._on_batch_done(requests, succeeded, runtime_or_error)
+
+        def on_error(exc_info):
+            # The batch did not run or its process was lost: results were not stored
+            for request in requests:
+                self.task.backend.mark_as_failure(request.id, exc_info.exception,
+                                                  exc_info.traceback, request=request._context)
+            self._on_batch_done(requests, False, repr(exc_info.exception))
+
+        self.consumer.pool.apply_async(
+            _run_batch, args=(self.task.name, payload_requests), accept_callback=on_accepted,
+            callback=on_done, error_callback=on_error,
+        )
+
+    def _on_batch_done(self, requests, succeeded, runtime_or_error):
+        """Acknowledge messages of a batch which ran, and report their outcome."""
+        for request in requests:
+            task_ready(request)
+            request.acknowledge()
+            if succeeded:
+                request.send_event('task-succeeded', result=None, runtime=runtime_or_error)
+            else:
+                request.send_event('task-failed', exception=runtime_or_error)
+        self.consumer.qos.decrement_eventually(len(requests))
+
+
+def configure_batch_tasks(app, sizes=None, flush_intervals=None):
+    """Change the batch size and flush interval of batch tasks of some plugins.
+
+    ``sizes`` and ``flush_intervals`` map plugin names to the batch size and flush interval of all
+    batch tasks of the plugin.
+    """
+    sizes = sizes or {}
+    flush_intervals = flush_intervals or {}
+    for task in app.tasks.values():
+        if not isinstance(task, BatchTask):
+            continue
+        plugin = plugin_name(app, task.name)
+        if plugin in sizes:
+            task.batch_size = sizes[plugin]
+        if plugin in flush_intervals:
+            task.batch_flush_interval = flush_intervals[plugin]
@@ -0,0 +1,204 @@
+"""Benchmark of plugin tasks run through an in-memory broker by an embedded worker.
+
+No external broker is needed: messages go through the ``memory://`` transport, and results are
+stored in memory with the ``cache+memory://`` result backend. Since pool processes of the prefork
+pool cannot share memory with the main process, results are stored in a temporary directory with
+the ``file://`` result backend when benchmarking this pool.
+
+Tasks are not traced during benchmarks, unless the overhead of tracing is measured: each benchmark
+then runs again with all tasks traced to a temporary file (see ``tracing``).
+"""
+
+
+__all__ = ('BENCHMARK_POOLS', 'format_results', 'run_benchmark', 'task_full_name')
+
+
+from contextlib import contextmanager
+from datetime import datetime
+import math
+import pathlib
+import tempfile
+import time
+
+from celery.contrib.testing.worker import start_worker
+from celery.exceptions import NotRegistered
+from celery.result import ResultSet
+
+from extensible_celery_worker.tracing import SpanExporter, configure_task_tracing
+
+
+BENCHMARK_POOLS = ('solo', 'threads', 'prefork')
+
+_EPOCH = datetime(1970, 1, 1)
+
+_POLLING_INTERVAL = 0.001
+
+
+def _percentile(sorted_values, percent):
+    """Return the given percentile of already sorted values (nearest-rank method)."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _utc_timestamp(date_done):
+    """Return the POSIX timestamp of a ``date_done`` value from a result backend."""
+    if isinstance(date_done, str):
+        date_done = datetime.strptime(date_done, '%Y-%m-%dT%H:%M:%S.%f'
+                                      if '.' in date_done else '%Y-%m-%dT%H:%M:%S')
+    return (date_done.replace(tzinfo=None) - _EPOCH).total_seconds()
+
+
+@contextmanager
+def _result_backend_url(pool):
+    """Context manager returning the URL of a result backend suitable for the given pool."""
+    if pool != 'prefork':
+        yield 'cache+memory://'
+        return
+    with tempfile.TemporaryDirectory(prefix='excewo-bench-') as results_dir:
+        yield 'file://{}'.format(pathlib.Path(results_dir).as_posix())
+
+
+def _pool_worker_options(pool):
+    """Return worker options needed to benchmark the given pool with the memory transport.
+
+    The memory transport has no event loop, so the worker consumes messages with a blocking loop
+    which only performs message acknowledgements made by pool threads after waiting up to 2 seconds
+    for new messages. Once the prefetch limit is reached, the threads pool would then spend most of
+    its time waiting for its own acknowledgements, so prefetching is not limited for this pool.
+    """
+    return {'prefetch_multiplier': 0} if pool == 'threads' else {}
+
+
+def task_full_name(app, task_name):
+    """Return the registered name of a task, given with or without the application name."""
+    if task_name in app.tasks:
+        return task_name
+    return '{}.{}'.format(app.main, task_name)
+
+
+def _send_and_wait(app, task_name, count, args, kwargs, timeout):
+    """Send ``count`` messages for the given task, wait for all results and return the time
+    sending started, and mappings of each task id to the time it was sent and done."""
+    sent_at = {}
+    results = []
+    start = time.time()
+    for _ in range(count):
+        result = app.send_task(task_name, args=args, kwargs=kwargs)
+        sent_at[result.id] = time.time()
+        results.append(result)
+    ResultSet(results, app=app).join(timeout=timeout, interval=0.01, disable_sync_subtasks=False)
+    return start, sent_at, {result.id: _utc_timestamp(result.date_done) for result in results}
+
+
+@contextmanager
+def _benchmark_config(app, pool):
+    """Context manager changing the Celery application configuration to use in-memory broker and
+    result backend, and restoring it on exit."""
+    with _result_backend_url(pool) as result_backend_url:
+        changes = {
+            'broker_url': 'memory://',
+            'result_backend': result_backend_url,
+            'task_ignore_result': False,
+            # The memory transport polls queues, every second by default
+            'broker_transport_options': {'polling_interval': _POLLING_INTERVAL},
+        }
+        saved = {key: app.conf.changes[key] for key in changes if key in app.conf.changes}
+        app.conf.update(changes)
+        del app.backend  # Created again from the new configuration
+        try:
+            yield
+        finally:
+            for key in changes:
+                app.conf.changes.pop(key, None)
+            app.conf.update(saved)
+            del app.backend
+
+
+@contextmanager
+def _tracing(enabled):
+    """Context manager tracing all tasks to a temporary file if enabled, or disabling tracing
+    otherwise, and restoring the previous tracing configuration on exit."""
+    with tempfile.TemporaryDirectory(prefix='excewo-bench-') as spans_dir:
+        exporter = SpanExporter((pathlib.Path(spans_dir) / 'spans.jsonl').as_posix()) \
+            if enabled else None
+        previous = configure_task_tracing(exporter)
+        try:
+            yield
+        finally:
+            configure_task_tracing(*previous)
+
+
+def run_benchmark(app, task_name, count=1000, pool='solo', concurrency=1, args=(), kwargs=None,
+                  timeout=60.0, trace=False):
+    """Send ``count`` messages for the given task to an embedded worker and return a dictionary
+    with the measured throughput (messages per second) and end-to-end latency percentiles (in
+    seconds, from publishing to result storage).
+
+    If ``trace`` is true, the benchmark runs again with all tasks traced, and the relative increase
+    of its duration is returned as ``tracing_overhead``.
+
+    The Celery application uses in-memory broker and result backend during the benchmark. Raise
+    ``NotRegistered`` if the task is unknown.
+    """
+    task_name = task_full_name(app, task_name)
+    if task_name not in app.tasks:
+        raise NotRegistered(task_name)
+    result = _run_benchmark(app, task_name, count, pool, concurrency, args, kwargs, timeout)
+    if trace:
+        traced = _run_benchmark(app, task_name, count, pool, concurrency, args, kwargs, timeout,
+                                trace=True)
+        result['tracing_overhead'] = traced['seconds'] / result['seconds'] - 1 \
+            if result['seconds'] > 0 else None
+    return result
+
+
+def _run_benchmark(app, task_name, count, pool, concurrency, args, kwargs, timeout, trace=False):
+    """Run a benchmark with all tasks traced or none, and return its results."""
+    with _benchmark_config(app, pool), _tracing(trace):
+        error = None
+        with start_worker(app, pool=pool, concurrency=concurrency, perform_ping_check=False,
+                          **_pool_worker_options(pool)):
+            # The embedded worker is only stopped if no exception is raised in this block
+            try:
+                start, sent_at, done_at = _send_and_wait(app, task_name, count, args, kwargs,
+                                                         timeout)
+            except Exception as exc:
+                error = exc
+        if error is not None:
+            raise error
+    latencies = sorted(done_at[result_id] - sent_at[result_id] for result_id in sent_at)
+    elapsed = max(done_at.values()) - start
+    return {
+        'task': task_name,
+        'pool': pool,
+        'concurrency': concurrency,
+        'messages': count,
+        'seconds': elapsed,
+        'throughput': count / elapsed if elapsed > 0 else None,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'latency_p99': _percentile(latencies, 99),
+    }
+
+
+def format_results(results):
+    """Return benchmark results as a human-readable table."""
+    task_width = max([len('Task')] + [len(result['task']) for result in results])
+    traced = any('tracing_overhead' in result for result in results)
+    lines = ['{:<{}} {:<8} {:>5} {:>8} {:>10} {:>9} {:>9} {:>9}'.format(
+        'Task', task_width, 'Pool', 'Conc.', 'Messages', 'Msg/s', 'p50 (ms)', 'p95 (ms)',
+        'p99 (ms)'
+    ) + (' {:>10}'.format('Tracing') if traced else '')]
+    for result in results:
+        line = '{:<{}} {:<8} {:>5} {:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            result['task'], task_width, result['pool'], result['concurrency'],
+            result['messages'], result['throughput'] or 0, result['latency_p50'] * 1000,
+            result['latency_p95'] * 1000, result['latency_p99'] * 1000,
+        )
+        if traced:
+            overhead = result.get('tracing_overhead')
+            line += ' {:>10}'.format('{:+.1%}'.format(overhead) if overhead is not None else '')
+        lines.append(line)
+    return '\n'.join(lines)
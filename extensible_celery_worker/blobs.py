@@ -0,0 +1,270 @@
+"""Claim-check offloading of large task arguments and results to a local blob store.
+
+Arguments of sent tasks (positional arguments and keyword argument values) and task results which
+are strings or bytes-like objects larger than a threshold are written to a content-addressed
+directory shared by clients and workers of the host, and only a reference to them goes through the
+broker and the result backend. Items of list and tuple arguments are offloaded the same way (for
+instance, results of chord header tasks passed to the chord callback).
+
+References are resolved in the process running the task, just before it runs, as ``bytes`` or
+``str`` objects. Tasks registered with the ``zero_copy=True`` option get read-only ``memoryview``
+objects over a memory map of the blob instead of ``bytes``, so that the blob is only paged in as it
+is read. Argument blobs are removed once the task succeeded, and result blobs once the result is
+read with ``AsyncResult.get()``. Blobs of failed or lost tasks are removed after a time to live.
+
+Blobs are stored once per content (SHA-256) and each reference is a hard link to it: the content is
+removed with its last reference.
+"""
+
+
+__all__ = ('BlobNotFound', 'BlobStore', 'ClaimCheckResult', 'claim_check', 'configure_blob_store',
+           'offload', 'offload_arguments', 'remove_references', 'resolve', 'resolve_arguments')
+
+
+import functools
+import hashlib
+import inspect
+import logging
+import mmap
+import os
+import pathlib
+import tempfile
+import time
+import uuid
+
+from celery.result import AsyncResult
+
+from extensible_celery_worker.tracing import task_phase
+
+
+REFERENCE_KEY = '__excewo_blob__'
+
+# Minimum number of seconds between two sweeps of expired blobs by a process
+_SWEEP_INTERVAL = 600
+
+_store = None
+
+
+class BlobNotFound(LookupError):
+    """A referenced blob does not exist (any longer), or no blob store is configured."""
+
+
+class BlobStore:
+    """Blob store in the directory at the given path, created when first used.
+
+    Values larger than ``threshold`` bytes are offloaded. References which were not removed
+    after ``ttl`` seconds are removed when blobs are swept.
+    """
+
+    def __init__(self, path, threshold=2 ** 20, ttl=86400):
+        self.path = pathlib.Path(path).expanduser()
+        self.threshold = threshold
+        self.ttl = ttl
+        self._last_sweep = None
+
+    def _blob_path(self, name):
+        """Return the path of the blob or reference with the given name."""
+        return self.path / name[:2] / name
+
+    def put(self, value):
+        """Store the given string or bytes-like object, and return a reference to it."""
+        data = value.encode('utf-8') if isinstance(value, str) else memoryview(value).cast('B')
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        name = '{}.{}'.format(digest, uuid.uuid4().hex)
+        while True:
+            if not blob_path.exists():
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=blob_path.parent.as_posix(), prefix='.tmp')
+                with open(fd, 'wb') as blob_file:
+                    blob_file.write(data)
+                os.replace(tmp_path, blob_path.as_posix())
+            try:
+                os.link(blob_path.as_posix(), self._blob_path(name).as_posix())
+                break
+            except FileNotFoundError:  # Its last reference was removed meanwhile
+                continue
+        self._maybe_sweep()
+        return {REFERENCE_KEY: name, 'type': 'str' if isinstance(value, str) else 'bytes',
+                'size': len(data)}
+
+    def get(self, reference, zero_copy=False):
+        """Return the value the given reference refers to, as a read-only ``memoryview`` of a
+        memory map for bytes blobs if ``zero_copy`` is true."""
+        path = self._blob_path(reference[REFERENCE_KEY])
+        try:
+            with open(path.as_posix(), 'rb') as blob_file:
+                if zero_copy and reference['type'] == 'bytes' and reference['size']:
+                    return memoryview(mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ))
+                data = blob_file.read()
+        except FileNotFoundError:
+            raise BlobNotFound('Blob {} does not exist in {}'.format(
+                reference[REFERENCE_KEY], self.path
+            )) from None
+        return data.decode('utf-8') if reference['type'] == 'str' else data
+
+    def remove(self, reference):
+        """Remove the given reference, and the blob it refers to if it was the last one."""
+        name = reference[REFERENCE_KEY]
+        try:
+            self._blob_path(name).unlink()
+        except FileNotFoundError:
+            pass
+        self._remove_unreferenced(self._blob_path(name.partition('.')[0]))
+
+    @staticmethod
+    def _remove_unreferenced(blob_path):
+        """Remove the given blob if no reference links to it."""
+        try:
+            if blob_path.stat().st_nlink == 1:
+                blob_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Remove references older than the time to live, and unreferenced blobs."""
+        self._last_sweep = time.monotonic()
+        if not self.path.is_dir():
+            return
+        expired_before = time.time() - self.ttl
+        removed = 0
+        for path in self.path.glob('*/*.*'):
+            try:
+                if path.name.startswith('.tmp') or path.stat().st_mtime >= expired_before:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+            self._remove_unreferenced(path.with_name(path.name.partition('.')[0]))
+        if removed:
+            logging.info('Removed {} expired blob references from {}'.format(removed, self.path))
+
+    def _maybe_sweep(self):
+        """Sweep expired blobs if it was not done lately by this process."""
+        if self._last_sweep is None or time.monotonic() - self._last_sweep > _SWEEP_INTERVAL:
+            self.sweep()
+
+
+def configure_blob_store(store):
+    """Offload large task arguments and results to the given blob store (``None`` to disable
+    offloading)."""
+    global _store
+    _store = store
+
+
+def _is_reference(value):
+    return type(value) is dict and REFERENCE_KEY in value
+
+
+def offload(value):
+    """Return a reference to the given value stored in the blob store if it is a large string or
+    bytes-like object, or the value itself."""
+    if _store is None:
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        size = memoryview(value).nbytes
+    elif isinstance(value, str):
+        size = len(value)  # At least its size in UTF-8
+    else:
+        return value
+    return _store.put(value) if size > _store.threshold else value
+
+
+def _offload_item(value):
+    """Offload the given argument, or items of the given list or tuple argument."""
+    if type(value) in (list, tuple):
+        items = [offload(item) for item in value]
+        return value if all(x is y for x, y in zip(items, value)) else type(value)(items)
+    return offload(value)
+
+
+def offload_arguments(args, kwargs):
+    """Return the given task arguments, with large ones offloaded to the blob store."""
+    if _store is None:
+        return args, kwargs
+    return (tuple(_offload_item(arg) for arg in args) if args else args,
+            {key: _offload_item(value) for key, value in kwargs.items()} if kwargs else kwargs)
+
+
+def _resolve_reference(reference, zero_copy, references):
+    """Return the value of the given reference, and add it to the given list."""
+    if _store is None:
+        raise BlobNotFound('Cannot resolve blob {}: no blob store is configured'.format(
+            reference[REFERENCE_KEY]
+        ))
+    references.append(reference)
+    return _store.get(reference, zero_copy)
+
+
+def _resolve_item(value, zero_copy, references):
+    """Resolve the given argument, or items of the given list or tuple argument."""
+    if _is_reference(value):
+        return _resolve_reference(value, zero_copy, references)
+    if type(value) in (list, tuple) and any(_is_reference(item) for item in value):
+        return type(value)(_resolve_reference(item, zero_copy, references)
+                           if _is_reference(item) else item for item in value)
+    return value
+
+
+def resolve(value, zero_copy=False, remove=False):
+    """Return the given value, or items of the given list or tuple, with blob references replaced
+    with blobs, and remove these references if ``remove`` is true."""
+    references = []
+    value = _resolve_item(value, zero_copy, references)
+    if remove:
+        remove_references(references)
+    return value
+
+
+def resolve_arguments(args, kwargs, zero_copy=False):
+    """Return the given task arguments with blob references replaced with blobs, and the list of
+    these references."""
+    references = []
+    args = tuple(_resolve_item(arg, zero_copy, references) for arg in args)
+    kwargs = {key: _resolve_item(value, zero_copy, references) for key, value in kwargs.items()}
+    return args, kwargs, references
+
+
+def remove_references(references):
+    """Remove the given blob references from the blob store."""
+    for reference in references:
+        _store.remove(reference)
+
+
+def claim_check(task, zero_copy=False):
+    """Make the given task resolve blob references of its arguments, remove them once it succeeded,
+    and offload its result if it is large."""
+    if getattr(task, '_claim_check_run', None) is not None:
+        return
+    run = task._claim_check_run = task.run
+    if inspect.iscoroutinefunction(run):
+        @functools.wraps(run)
+        async def claim_check_run(*args, **kwargs):
+            args, kwargs, references = resolve_arguments(args, kwargs, zero_copy)
+            retval = await run(*args, **kwargs)
+            remove_references(references)
+            return offload(retval)
+    else:
+        @functools.wraps(run)
+        def claim_check_run(*args, **kwargs):
+            with task_phase('arguments'):
+                args, kwargs, references = resolve_arguments(args, kwargs, zero_copy)
+            with task_phase('body'):
+                retval = run(*args, **kwargs)
+            remove_references(references)
+            return offload(retval)
+    task.run = claim_check_run
+
+
+class ClaimCheckResult(AsyncResult):
+    """Task result whose value is resolved from the blob store, and removed from it, if it was
+    offloaded."""
+
+    _resolved = False
+
+    def get(self, *args, **kwargs):
+        if not self._resolved:
+            self._value = resolve(super().get(*args, **kwargs), remove=True)
+            self._resolved = True
+        return self._value
@@ -0,0 +1,142 @@
+"""Supervision of several workers on the same host, each with its own pool type and plugins.
+
+Each worker pool runs in an ``excewo worker`` process of its own, started with its own Celery worker
+arguments and loading only its assigned plugins. Workers which exit while the cluster is running
+are started again, waiting longer after each failure of a worker which did not run for long. On
+SIGTERM or SIGINT, all workers are asked to finish their current tasks and exit (Celery warm
+shutdown), and are killed if they do not exit in time.
+"""
+
+
+__all__ = ('Cluster', 'WorkerPool')
+
+
+import logging
+import signal
+import subprocess
+import sys
+import time
+
+
+_POLL_INTERVAL = 0.2
+
+
+class WorkerPool:
+    """Definition of a worker pool: arguments of its Celery worker, and names of the plugins it
+    loads (``None`` for all installed plugins)."""
+
+    def __init__(self, name, worker_args=(), plugin_names=None):
+        self.name = name
+        self.worker_args = list(worker_args)
+        self.plugin_names = plugin_names
+
+    def __repr__(self):
+        return '<WorkerPool {}>'.format(self.name)
+
+    def command(self, excewo_args=()):
+        """Return the command line starting the worker of this pool, with the given options of
+        ``excewo`` (application name, configuration files, log level)."""
+        command = [sys.executable, '-m', 'extensible_celery_worker'] + list(excewo_args)
+        if self.plugin_names is not None:
+            command.extend(['--plugins', ','.join(self.plugin_names)])
+        worker_args = list(self.worker_args)
+        # Workers of the same host need different node names
+        if not any(arg in ('-n', '--hostname') or arg.startswith('--hostname=')
+                   for arg in worker_args):
+            worker_args.extend(['-n', '{}@%h'.format(self.name)])
+        return command + ['worker', '--'] + worker_args
+
+
+class Cluster:
+    """Supervisor of processes started with the given commands (mapping names to command lines).
+
+    A process which exits is started again after ``restart_delay`` seconds. The delay doubles each
+    time the process exits after running for less than ``max_restart_delay`` seconds, up to this
+    maximum, and is reset otherwise. On stop, processes are terminated and killed if they are still
+    running after ``shutdown_timeout`` seconds.
+    """
+
+    def __init__(self, commands, restart_delay=1.0, max_restart_delay=60.0, shutdown_timeout=60.0):
+        self.commands = dict(commands)
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.processes = {}
+        self.restart_counts = {name: 0 for name in self.commands}
+        self._started_at = {}
+        self._restart_at = {}
+        self._delays = {name: restart_delay for name in self.commands}
+        self._stopping = False
+
+    def _start(self, name):
+        """Start the process with the given name."""
+        self.processes[name] = subprocess.Popen(self.commands[name])
+        self._started_at[name] = time.monotonic()
+        logging.info('Started worker pool {} (pid {})'.format(name, self.processes[name].pid))
+
+    def start(self):
+        """Start all processes."""
+        for name in self.commands:
+            self._start(name)
+
+    def poll(self):
+        """Start again processes which exited, once their restart delay is over."""
+        now = time.monotonic()
+        for name, process in self.processes.items():
+            if name in self._restart_at:
+                if now >= self._restart_at[name]:
+                    del self._restart_at[name]
+                    self.restart_counts[name] += 1
+                    self._start(name)
+                continue
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            if now - self._started_at[name] >= self.max_restart_delay:
+                self._delays[name] = self.restart_delay
+            delay = self._delays[name]
+            self._delays[name] = min(delay * 2, self.max_restart_delay)
+            self._restart_at[name] = now + delay
+            logging.warning('Worker pool {} exited with code {}, restarting it in {:.1f}s'.format(
+                name, returncode, delay
+            ))
+
+    def stop(self):
+        """Ask all processes to exit, wait for them and kill those which do not exit in time."""
+        self._stopping = True
+        self._restart_at.clear()
+        running = [process for process in self.processes.values() if process.poll() is None]
+        logging.info('Stopping {} worker pools'.format(len(running)))
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for name, process in self.processes.items():
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning('Worker pool {} did not exit in {:.0f}s, killing it'.format(
+                    name, self.shutdown_timeout
+                ))
+                process.kill()
+                process.wait()
+
+    def _on_stop_signal(self, signum, frame):
+        logging.info('Received signal {}, stopping the cluster'.format(
+            signal.Signals(signum).name
+        ))
+        self._stopping = True
+
+    def run(self):
+        """Start all processes and supervise them until SIGTERM or SIGINT is received, then stop
+        them."""
+        previous_handlers = {signum: signal.signal(signum, self._on_stop_signal)
+                             for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            self.start()
+            while not self._stopping:
+                self.poll()
+                time.sleep(_POLL_INTERVAL)
+        finally:
+            self.stop()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
@@ -1,10 +1,11 @@
-"""Function to yield each path to possible configuration files, depending on the platform.
+"""Functions to yield each path to possible configuration files, and to return the cache
+directory, depending on the platform.
 
 Inspired by and simplified from https://github.com/barry-scott/config-path.
 """
 
 
-__all__ = ('config_paths')
+__all__ = ('config_paths', 'user_cache_dir')
 
 
 import os
@@ -58,6 +59,24 @@ def _win_home_config_paths():
     yield pathlib.Path(buf.value) / _WORKER_NAME / _CONF_FILENAME
 
 
+def _mac_user_cache_dir():
+    """Return the path to user's cache directory on Mac OS X platforms."""
+    return (pathlib.Path(os.environ['HOME']) / 'Library' / 'Caches' /
+            'org.ygversil.{worker_name}'.format(worker_name=_WORKER_NAME))
+
+
+def _xdg_user_cache_dir():
+    """Return the path to user's cache directory on XDG compatible platforms."""
+    return (pathlib.Path(os.environ.get('XDG_CACHE_HOME',
+                                        pathlib.Path(os.environ['HOME']) / '.cache')) /
+            _WORKER_NAME)
+
+
+def _win_user_cache_dir():
+    """Return the path to user's cache directory on Windows platforms."""
+    return pathlib.Path(os.environ['LOCALAPPDATA']) / _WORKER_NAME / 'Cache'
+
+
 def _global_config_paths():
     """Yield each path to a global configuration files."""
     if platform.mac_ver()[0] != '':
@@ -87,3 +106,13 @@ def config_paths(cli_config_path=None):
         yield pathlib.Path(env_config_path)
     if cli_config_path:
         yield pathlib.Path(cli_config_path)
+
+
+def user_cache_dir():
+    """Return the path to user's cache directory (which may not exist yet)."""
+    if platform.mac_ver()[0] != '':
+        return _mac_user_cache_dir()
+    elif platform.win32_ver()[0] != '':
+        return _win_user_cache_dir()
+    else:
+        return _xdg_user_cache_dir()
@@ -0,0 +1,270 @@
+"""Deduplication of task messages delivered more than once, shared by all workers of a host.
+
+With late acknowledgement, brokers deliver a message again when it was not acknowledged in time
+(lost connection, visibility timeout...), although the task may already be running or done. The
+worker records in an SQLite index the task id (and retry number) of each message whose task
+starts, with the pool process running it, and marks the message as done once the task succeeded
+(failed tasks are removed from the index). When a message is received, it is a duplicate if the
+index holds its task id, done or still running in a live process: the message is acknowledged and
+dropped without running the task.
+
+Tasks registered with the ``idempotent=True`` option are also deduplicated on their arguments:
+a message with the same task name and arguments (in their canonical JSON form, as pure task
+results are cached) as a task done or running is dropped too, whatever its task id. No result is
+stored for dropped messages.
+
+Index entries expire after a time to live, and the oldest entries are evicted beyond a maximum
+number of entries. Messages received before their first delivery started are not detected as
+duplicates, and neither are messages of the task message protocol version 1.
+"""
+
+
+__all__ = ('DedupIndex', 'configure_message_dedup')
+
+
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from celery import bootsteps, signals
+from celery.states import SUCCESS
+from celery.utils.log import get_logger
+
+from extensible_celery_worker.memo import MemoCache, _Transaction
+
+
+_SCHEMA = '''
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS seen (
+    key TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    pid INTEGER,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS seen_seen_at ON seen (seen_at);
+CREATE TABLE IF NOT EXISTS entries (count INTEGER NOT NULL);
+INSERT INTO entries SELECT 0 WHERE NOT EXISTS (SELECT * FROM entries);
+CREATE TRIGGER IF NOT EXISTS seen_insert AFTER INSERT ON seen BEGIN
+    UPDATE entries SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS seen_delete AFTER DELETE ON seen BEGIN
+    UPDATE entries SET count = count - 1;
+END;
+CREATE TABLE IF NOT EXISTS stats (
+    task TEXT PRIMARY KEY,
+    ids INTEGER NOT NULL DEFAULT 0,
+    arguments INTEGER NOT NULL DEFAULT 0
+);
+COMMIT;
+'''
+
+logger = get_logger(__name__)
+
+_index = None
+
+
+def _is_alive(pid):
+    """Return whether a process with the given id runs on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DedupIndex:
+    """Index of recently started task messages in the SQLite database at the given path, created
+    when first used.
+
+    Entries are kept for ``ttl`` seconds, up to ``max_entries`` entries.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=86400):
+        self.path = pathlib.Path(path).expanduser()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return the database connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        # Connections must not be shared by pool processes forked after it was opened
+        if connection is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path.as_posix(), timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transaction(self):
+        """Return a context manager running statements in a write transaction, and returning the
+        connection."""
+        return _Transaction(self._connection())
+
+    @staticmethod
+    def keys(task, task_id, retries, args=None, kwargs=None):
+        """Return the index keys of a message of the given task: its task id and retry number,
+        and its arguments if the task is idempotent and they can be serialized in JSON."""
+        keys = ['id:{}:{}'.format(task_id, retries or 0)]
+        if getattr(task, 'idempotent', False) and args is not None:
+            arguments_key = MemoCache.key(task.name, args, kwargs)
+            if arguments_key is not None:
+                keys.append('args:' + arguments_key)
+        return keys
+
+    def duplicate(self, task_name, keys):
+        """Return the key of the given message keys found in the index, done or running, or
+        ``None`` if the message is not a duplicate. Duplicates are counted."""
+        connection = self._connection()
+        oldest = time.time() - self.ttl
+        for key in keys:
+            row = connection.execute('SELECT pid, seen_at FROM seen WHERE key = ?',
+                                     (key,)).fetchone()
+            # Tasks whose process died before they were done may run again
+            if row is None or row[1] <= oldest or (row[0] is not None and not _is_alive(row[0])):
+                continue
+            with self._transaction() as connection:
+                connection.execute('INSERT OR IGNORE INTO stats (task) VALUES (?)', (task_name,))
+                connection.execute('UPDATE stats SET {0} = {0} + 1 WHERE task = ?'.format(
+                    'ids' if key.startswith('id:') else 'arguments'
+                ), (task_name,))
+            return key
+        return None
+
+    def start(self, task_name, keys, pid=None):
+        """Record that a task with the given message keys started in the given process (the
+        current one by default), evicting the oldest entries if needed."""
+        now = time.time()
+        with self._transaction() as connection:
+            for key in keys:
+                connection.execute('DELETE FROM seen WHERE key = ?', (key,))
+                connection.execute('INSERT INTO seen (key, task, pid, seen_at) VALUES (?, ?, ?, ?)',
+                                   (key, task_name, pid or os.getpid(), now))
+            if connection.execute('SELECT count FROM entries').fetchone()[0] > self.max_entries:
+                connection.execute('DELETE FROM seen WHERE seen_at <= ?', (now - self.ttl,))
+            excess = connection.execute('SELECT count FROM entries').fetchone()[0] - \
+                self.max_entries
+            if excess > 0:
+                connection.execute('DELETE FROM seen WHERE key IN (SELECT key FROM seen '
+                                   'ORDER BY seen_at LIMIT ?)', (excess,))
+
+    def finish(self, keys, succeeded):
+        """Record that a task with the given message keys is done: keep it in the index if it
+        succeeded, or remove it so that it can run again."""
+        with self._transaction() as connection:
+            for key in keys:
+                if succeeded:
+                    connection.execute('UPDATE seen SET pid = NULL WHERE key = ?', (key,))
+                else:
+                    connection.execute('DELETE FROM seen WHERE key = ?', (key,))
+
+    def stats(self):
+        """Return a mapping of task names to their number of messages dropped as duplicates of a
+        task id and of arguments."""
+        with self._transaction() as connection:
+            return {task: {'ids': ids, 'arguments': arguments}
+                    for task, ids, arguments in connection.execute(
+                        'SELECT task, ids, arguments FROM stats ORDER BY task'
+                    )}
+
+    def as_prometheus_text(self):
+        """Return deduplication statistics in the Prometheus text exposition format."""
+        metric = 'excewo_dedup_duplicates_total'
+        lines = ['# HELP {} Number of task messages dropped as duplicates'.format(metric),
+                 '# TYPE {} counter'.format(metric)]
+        for task, task_stats in self.stats().items():
+            for kind in ('ids', 'arguments'):
+                lines.append('{}{{task="{}",of="{}"}} {}'.format(
+                    metric, task.replace('"', '\\"'), kind[:-1], task_stats[kind]
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+class _DedupStep(bootsteps.Step):
+    """Consumer bootstep dropping duplicate task messages before they are handled."""
+
+    requires = ('celery.worker.consumer.tasks:Tasks',)
+
+    def __init__(self, c, **kwargs):
+        super().__init__(c, **kwargs)
+        create_task_handler = c.create_task_handler
+
+        # Task handlers are created when the consumer (re)starts consuming
+        def create_dedup_task_handler(*args, **kwargs):
+            return self._task_handler(c, create_task_handler(*args, **kwargs))
+
+        c.create_task_handler = create_dedup_task_handler
+
+    def _task_handler(self, c, on_task_received):
+        def on_dedup_task_received(message):
+            headers = message.headers
+            task = None
+            if isinstance(headers, dict) and 'id' in headers:
+                task = c.app.tasks.get(headers.get('task'))
+            if task is None or _index is None or not self._is_duplicate(task, message):
+                return on_task_received(message)
+            message.ack_log_error(logger, c.connection_errors)
+
+        return on_dedup_task_received
+
+    def _is_duplicate(self, task, message):
+        headers = message.headers
+        args = kwargs = None
+        if getattr(task, 'idempotent', False):
+            try:
+                args, kwargs = message.decode()[:2]
+            except Exception:
+                pass
+        keys = _index.keys(task, headers['id'], headers.get('retries'), args, kwargs)
+        try:
+            key = _index.duplicate(task.name, keys)
+        except sqlite3.Error as exc:
+            logging.warning('Could not read task deduplication index {}: {}'.format(
+                _index.path, exc
+            ))
+            return False
+        if key is None:
+            return False
+        logging.info('Dropped duplicate message of task {}[{}] ({})'.format(
+            task.name, headers['id'], 'same task id' if key.startswith('id:') else 'same arguments'
+        ))
+        return True
+
+
+def _on_task_prerun(task_id=None, task=None, args=None, kwargs=None, **other):
+    if _index is None:
+        return
+    try:
+        _index.start(task.name, _index.keys(task, task_id, task.request.retries, args, kwargs))
+    except sqlite3.Error as exc:
+        logging.warning('Could not write task deduplication index {}: {}'.format(_index.path, exc))
+
+
+def _on_task_postrun(task_id=None, task=None, args=None, kwargs=None, state=None, **other):
+    if _index is None:
+        return
+    try:
+        _index.finish(_index.keys(task, task_id, task.request.retries, args, kwargs),
+                      state == SUCCESS)
+    except sqlite3.Error as exc:
+        logging.warning('Could not write task deduplication index {}: {}'.format(_index.path, exc))
+
+
+def configure_message_dedup(app, index):
+    """Make workers of the given application drop duplicate task messages, recorded in the given
+    index (``None`` to disable deduplication)."""
+    global _index
+    _index = index
+    if index is None:
+        return
+    signals.task_prerun.connect(_on_task_prerun, dispatch_uid='excewo_dedup_prerun')
+    signals.task_postrun.connect(_on_task_postrun, dispatch_uid='excewo_dedup_postrun')
+    app.steps['consumer'].add(_DedupStep)
@@ -0,0 +1,155 @@
+"""Aggregation of task events sent by the worker into periodic summaries.
+
+In aggregation mode, the worker does not send an event for each step of each task
+(``task-received``, ``task-started``, ``task-succeeded``...), which may cost more than the tasks
+themselves at high rates. It counts them by task name instead, and sends a ``worker-task-summary``
+event every ``interval`` seconds::
+
+    {'type': 'worker-task-summary', 'hostname': 'celery@host', 'interval': 5.0, 'tasks': {
+        'my_worker.plugin.task': {'received': 12000, 'started': 12000, 'succeeded': 11990,
+                                  'failed': 10, 'runtime': 31.2},
+    }, ...}
+
+where ``runtime`` is the total runtime of succeeded tasks. Events of a ``sample_rate`` fraction of
+tasks (chosen from their id, so that all events of a task are sent or none) are still sent
+individually, and are not counted in summaries: totals are the sum of both.
+
+Worker events (heartbeats...) and ``task-sent`` events (published by the sender of the task, not
+through the dispatcher) are sent as usual. Being worker events, summaries keep the worker
+alive in monitors, as heartbeats do.
+"""
+
+
+__all__ = ('SUMMARY_EVENT', 'Events', 'TaskEventDispatcher', 'configure_task_event_aggregation',
+           'count_task_summary', 'count_task_summaries_in_flower')
+
+
+import functools
+import threading
+import time
+import zlib
+
+from celery.app.events import Events as CeleryEvents
+from celery.events.dispatcher import EventDispatcher
+from celery.events.event import Event
+from celery.utils.time import utcoffset
+
+
+SUMMARY_EVENT = 'worker-task-summary'
+
+# Task events ending a task
+_LAST_EVENTS = ('task-succeeded', 'task-failed', 'task-rejected', 'task-revoked')
+
+_settings = None
+
+
+class _Settings:
+    """Interval of task event summaries, and fraction of tasks whose events are still sent."""
+
+    def __init__(self, interval, sample_rate):
+        self.interval = interval
+        self.sample_rate = sample_rate
+
+
+def configure_task_event_aggregation(interval=5.0, sample_rate=0.0):
+    """Make workers send summaries of task events every ``interval`` seconds instead of task
+    events, except for a ``sample_rate`` fraction of tasks (``interval=None`` to send all task
+    events)."""
+    global _settings
+    _settings = _Settings(interval, sample_rate) if interval is not None else None
+
+
+def _sampled(task_id, sample_rate):
+    """Return whether events of the task with the given id are sent."""
+    return zlib.crc32(task_id.encode('utf-8')) < sample_rate * 2 ** 32
+
+
+class TaskEventDispatcher(EventDispatcher):
+    """Event dispatcher aggregating task events, when aggregation is configured."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._summary_lock = threading.Lock()
+        self._summary = {}
+        self._summary_started = time.monotonic()
+        # Names of running tasks which are not sampled, by id (only some task events have it)
+        self._task_names = {}
+
+    def send(self, type, blind=False, utcoffset=utcoffset, retry=False, retry_policy=None,
+             Event=Event, **fields):
+        settings = _settings
+        if settings is not None and self.enabled:
+            if type.startswith('task-') and 'uuid' in fields and \
+                    not _sampled(fields['uuid'], settings.sample_rate):
+                self._count(type, fields)
+                self._maybe_send_summary(settings.interval)
+                return None
+            self._maybe_send_summary(settings.interval)
+        return super().send(type, blind=blind, utcoffset=utcoffset, retry=retry,
+                            retry_policy=retry_policy, Event=Event, **fields)
+
+    def _count(self, type, fields):
+        """Count the given task event in the summary."""
+        task_id = fields['uuid']
+        with self._summary_lock:
+            if 'name' in fields:
+                self._task_names[task_id] = fields['name']
+            name = (self._task_names.pop(task_id, None) if type in _LAST_EVENTS
+                    else self._task_names.get(task_id)) or fields.get('name', 'unknown')
+            counts = self._summary.setdefault(name, {})
+            kind = type[len('task-'):]
+            counts[kind] = counts.get(kind, 0) + 1
+            if type == 'task-succeeded' and fields.get('runtime'):
+                counts['runtime'] = counts.get('runtime', 0.0) + fields['runtime']
+
+    def _maybe_send_summary(self, interval):
+        """Send the summary of task events if it was started at least ``interval`` seconds ago."""
+        if time.monotonic() - self._summary_started >= interval:
+            self.send_summary()
+
+    def send_summary(self):
+        """Send the summary of task events counted since the previous one, if any."""
+        now = time.monotonic()
+        with self._summary_lock:
+            summary, self._summary = self._summary, {}
+            interval, self._summary_started = now - self._summary_started, now
+        if summary:
+            super().send(SUMMARY_EVENT, interval=interval, tasks=summary)
+
+    def close(self):
+        if _settings is not None and self.enabled and self.producer is not None:
+            self.send_summary()
+        super().close()
+
+
+class Events(CeleryEvents):
+    """``app.events`` creating event dispatchers which may aggregate task events."""
+
+    dispatcher_cls = 'extensible_celery_worker.events:TaskEventDispatcher'
+
+
+def count_task_summary(counter, event):
+    """Add counts of a task event summary to the given counter of events by worker name and
+    event type, as Flower counts task events."""
+    for counts in event['tasks'].values():
+        for kind, count in counts.items():
+            if kind != 'runtime':
+                counter[event['hostname']]['task-' + kind] += count
+
+
+def count_task_summaries_in_flower():
+    """Make Flower count tasks of task event summaries in its dashboard, as if it received their
+    task events."""
+    from flower.events import EventsState
+    event = EventsState.event
+    if getattr(event, 'counts_task_summaries', False):
+        return
+
+    @functools.wraps(event)
+    def summary_counting_event(self, received_event):
+        if received_event['type'] == SUMMARY_EVENT:
+            count_task_summary(self.counter, received_event)
+        return event(self, received_event)
+
+    summary_counting_event.counts_task_summaries = True
+    EventsState.event = summary_counting_event
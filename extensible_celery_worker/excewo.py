@@ -1,12 +1,102 @@
 """Custom Celery class for extensible_celery_worker."""
 
 
-from celery import Celery
+import inspect
+
+from celery import Celery, signals
+from kombu.utils.objects import cached_property
+
+from extensible_celery_worker.async_tasks import AsyncTask
+from extensible_celery_worker.batches import BatchTask
+from extensible_celery_worker.blobs import claim_check, offload_arguments
+from extensible_celery_worker.fusion import fusable, run_fused_chain
+from extensible_celery_worker.memo import PureTask
+from extensible_celery_worker.metrics import stamp_publish_time
+from extensible_celery_worker.resources import Resource, manage_resources
+from extensible_celery_worker.streams import StreamTask
 
 
 class ExtensibleCeleryWorkerCelery(Celery):
     """Custom Celery class to generate task names without ``.tasks.`` and with application name
-    as prefix."""
+    as prefix.
+
+    Plugins can also declare warm-up functions with the ``warm_up`` decorator, to be called in the
+    worker main process when plugins are preloaded, resources managed in each worker process with
+    the ``resource`` decorator, and batch tasks with the ``batch_task`` decorator. Functions
+    defined with ``async def`` are registered as ``AsyncTask`` tasks, generator functions as
+    ``StreamTask`` tasks, and tasks registered with the ``pure=True`` option as ``PureTask``
+    tasks.
+
+    Next steps of chains are run in the worker process instead of being sent, when possible and
+    enabled (see ``fusion``), and large task arguments and results are offloaded to the blob store
+    when it is configured (see ``blobs``).
+    """
+
+    # Task lookups wait for on-demand plugin imports to finish
+    registry_cls = 'extensible_celery_worker.plugins:PluginTaskRegistry'
+
+    # Task events may be aggregated
+    events_cls = 'extensible_celery_worker.events:Events'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.warm_ups = []
+        self.resources = {}
+        manage_resources()
+        # Publish time is needed to measure how long tasks wait in queues
+        signals.before_task_publish.connect(stamp_publish_time,
+                                            dispatch_uid='excewo_stamp_publish_time')
+
+    def warm_up(self, fun):
+        """Decorator registering a function to call without arguments when plugins are preloaded,
+        before pool processes are started."""
+        self.warm_ups.append(fun)
+        return fun
+
+    def resource(self, fun=None, name=None):
+        """Decorator registering a resource, set up in each worker process by the decorated
+        function (see ``Resource``), and returning the resource, whose ``get()`` method returns
+        the value of the resource in the current process.
+
+        Resources are named after their function, unless a ``name`` is given.
+        """
+        def register(fun):
+            resource = Resource(fun, name)
+            self.resources[resource.name] = resource
+            return resource
+        return register(fun) if fun is not None else register
+
+    def batch_task(self, *args, **options):
+        """Decorator registering a batch task, called by the worker with a list of argument tuples
+        of up to ``batch_size`` messages, and returning the list of their results.
+
+        Takes the same options as ``task``, including ``batch_size`` and ``batch_flush_interval``
+        (see ``BatchTask``).
+        """
+        options.setdefault('base', BatchTask)
+        return self.task(*args, **options)
+
+    def _task_from_fun(self, fun, name=None, base=None, bind=False, **options):
+        base = base or self.Task
+        mixins = tuple(mixin for mixin, needed in ((PureTask, options.get('pure')),
+                                                   (AsyncTask, inspect.iscoroutinefunction(fun)),
+                                                   (StreamTask, inspect.isgeneratorfunction(fun)))
+                       if needed and not issubclass(base, mixin))
+        if mixins:
+            base = type(base.__name__, mixins + (base,), {'__module__': base.__module__})
+        task = super()._task_from_fun(fun, name=name, base=base, bind=bind, **options)
+        claim_check(task, options.get('zero_copy', False))
+        return task
+
+    def send_task(self, name, args=None, kwargs=None, **options):
+        if fusable(self, name, options):
+            return run_fused_chain(self, name, args, kwargs, options)
+        args, kwargs = offload_arguments(args, kwargs)
+        return super().send_task(name, args, kwargs, **options)
+
+    @cached_property
+    def AsyncResult(self):
+        return self.subclass_with_self('extensible_celery_worker.streams:StreamResult')
 
     def gen_task_name(self, name, module):
         modules = module.split('.')
@@ -0,0 +1,90 @@
+"""In-process fusion of consecutive steps of task chains.
+
+When a task which is a step of a chain (``task1.s() | task2.s() | ...``) succeeds, the worker
+normally sends the next step to the broker, and stores the result of the finished step. When the
+next step is a task registered in the same worker, and chain fusion is enabled for its plugin, it
+is run right away in the same process instead: its argument is the result of the previous step as
+is, without serialization nor broker round-trip. Following steps are fused the same way, and only
+the result of the last fused step is stored, or the error of the step which failed. The first
+step which cannot be fused is sent to the broker as usual, as the continuation of the chain.
+
+Steps are not fused when they are delayed (``countdown``, ``eta``), have callbacks or errbacks,
+are part of a group or chord, or are sent to an explicitly given queue. Fused steps run in the
+time limits of the task which started the chain in the worker, and do not emit task events.
+"""
+
+
+__all__ = ('configure_chain_fusion', 'fusable', 'run_fused_chain')
+
+
+import logging
+
+from celery import states
+from celery._state import get_current_worker_task
+from celery.canvas import signature
+from celery.utils import uuid
+
+from extensible_celery_worker.routing import plugin_name
+
+
+# Options of steps which must be sent to the broker
+_UNFUSABLE_OPTIONS = ('countdown', 'eta', 'link', 'link_error', 'chord', 'group_id', 'queue',
+                      'exchange', 'routing_key')
+
+_enabled = False
+
+_plugins = {}
+
+
+def configure_chain_fusion(enabled=False, plugins=None):
+    """Enable or disable chain fusion for tasks of all plugins, and override this setting for
+    some plugins with ``plugins``, mapping plugin names to whether tasks of the plugin are
+    fused."""
+    global _enabled, _plugins
+    _enabled = enabled
+    _plugins = dict(plugins or {})
+
+
+def _fusable_step(app, name, options):
+    """Return whether the given chain step, sent with the given options, can run in the current
+    process."""
+    if options.get('chain') is None or any(options.get(option) for option in _UNFUSABLE_OPTIONS):
+        return False
+    return _plugins.get(plugin_name(app, name), _enabled) and name in app.tasks
+
+
+def fusable(app, name, options):
+    """Return whether the given task, sent with the given options by the worker as the next step of
+    the chain of the task it is executing, can run in the current process."""
+    current_task = get_current_worker_task()
+    return (current_task is not None and options.get('parent_id') == current_task.request.id and
+            _fusable_step(app, name, options))
+
+
+def run_fused_chain(app, name, args, kwargs, options):
+    """Run the given chain step and following fusable steps in the current process, send the
+    first step which cannot be fused to the broker, and return the result of the given step."""
+    chain = options['chain']
+    root_id = options.get('root_id')
+    task_id = options.get('task_id') or uuid()
+    first_result = app.AsyncResult(task_id)
+    while True:
+        task = app.tasks[name]
+        logging.debug('Running chain step {}[{}] in process'.format(name, task_id))
+        result = task.apply(args, kwargs, task_id=task_id, throw=False,
+                            headers=options.get('headers'))
+        if result.state != states.SUCCESS:
+            task.backend.mark_as_failure(task_id, result.result, result.traceback)
+            return first_result
+        if not chain:
+            if not task.ignore_result:
+                task.backend.mark_as_done(task_id, result.result)
+            return first_result
+        next_step = signature(chain.pop(), app=app)
+        step_options = {'chain': chain, 'parent_id': task_id, 'root_id': root_id}
+        args, kwargs, options = next_step._merge((result.result,), {}, step_options)
+        name = next_step.task
+        if not _fusable_step(app, name, options):
+            next_step.apply_async((result.result,), **step_options)
+            return first_result
+        task_id = options.get('task_id') or uuid()
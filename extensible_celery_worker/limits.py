@@ -0,0 +1,369 @@
+"""Rate limits and concurrency limits of tasks shared by all workers of a host.
+
+Celery rate limits apply to each worker separately. Host limits apply to all workers of a host
+together (all pools of ``excewo cluster`` for instance), to the tasks of a plugin or to a task:
+
+* a rate limit is a token bucket, refilled at the given rate (in tasks per second, minute or hour,
+  as Celery rate limits) up to a number of tokens (the burst size, 1 by default): each task takes
+  a token before it starts;
+* a concurrency limit is the maximum number of tasks running at the same time.
+
+Limits are stored in a memory-mapped file, which all workers update under a file lock. Tasks run
+by each worker are counted separately, so that tasks of a worker which died are no longer counted.
+
+Limits are checked by the worker main process before it sends a task to the pool: a task over a
+limit waits in the main process, without taking a pool slot, and without counting against the
+prefetch limit of the worker, so that tasks of other plugins still run. Waiting tasks of the same
+limits start in the order they were received.
+"""
+
+
+__all__ = ('HostLimits', 'configure_host_limits')
+
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+
+from celery import bootsteps
+from celery.exceptions import TaskRevokedError
+
+from extensible_celery_worker.dedup import _is_alive
+from extensible_celery_worker.routing import plugin_name
+
+
+#: Maximum number of limits in a limits file
+MAX_LIMITS = 256
+
+#: Maximum number of workers running tasks of a limit at the same time
+MAX_HOLDERS = 64
+
+# Seconds between checks of a concurrency limit reached
+_CONCURRENCY_POLL_INTERVAL = 0.05
+
+# Limit slot: key (digest of the name), tokens, last refill time, then (pid, count) of each worker
+# running tasks of the limit
+_HEADER = struct.Struct('=16sdd')
+_HOLDER = struct.Struct('=qq')
+_SLOT_SIZE = _HEADER.size + MAX_HOLDERS * _HOLDER.size
+_MAP_SIZE = MAX_LIMITS * _SLOT_SIZE
+
+_EMPTY_KEY = bytes(16)
+
+_limits = None
+
+
+def _key(name):
+    return hashlib.blake2b(name.encode('utf-8'), digest_size=16).digest()
+
+
+class HostLimits:
+    """Limits stored in the file at the given path, created when first used, given as mappings
+    of limit names (plugin or task names) to rates (tasks per second), burst sizes and maximum
+    numbers of running tasks."""
+
+    def __init__(self, path, rates=None, bursts=None, concurrency=None):
+        self.path = pathlib.Path(path).expanduser()
+        self.rates = dict(rates or {})
+        self.bursts = dict(bursts or {})
+        self.concurrency = dict(concurrency or {})
+        self.names = frozenset(self.rates) | frozenset(self.concurrency)
+        self._pid = None
+
+    def _open(self):
+        """Map the limits file, once in each process."""
+        if self._pid == os.getpid():
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path.as_posix(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < _MAP_SIZE:
+                    os.ftruncate(fd, _MAP_SIZE)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, _MAP_SIZE)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._lock = threading.Lock()
+        self._offsets = {}
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        """Return a context manager holding the lock of the limits file, and returning its map."""
+        self._open()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, limits_map, name):
+        """Return the offset of the slot of the given limit, added if needed, or ``None`` if the
+        limits file is full."""
+        offset = self._offsets.get(name)
+        if offset is not None:
+            return offset
+        key = _key(name)
+        for offset in range(0, _MAP_SIZE, _SLOT_SIZE):
+            slot_key = limits_map[offset:offset + 16]
+            if slot_key == key:
+                break
+            # Slots are never freed: the first empty slot ends the used ones
+            if slot_key == _EMPTY_KEY:
+                _HEADER.pack_into(limits_map, offset, key, self.bursts.get(name, 1), time.time())
+                break
+        else:
+            logging.warning('Limit {} is not applied: limits file {} is full'.format(
+                name, self.path
+            ))
+            return None
+        self._offsets[name] = offset
+        return offset
+
+    def _tokens(self, limits_map, name, offset, now):
+        """Return the tokens of the given rate limit at the given time."""
+        _, tokens, refilled_at = _HEADER.unpack_from(limits_map, offset)
+        return min(self.bursts.get(name, 1), tokens + (now - refilled_at) * self.rates[name])
+
+    def _running(self, limits_map, offset):
+        """Return the number of running tasks of the limit at the given offset, forgetting
+        workers which died."""
+        running = 0
+        for holder in range(MAX_HOLDERS):
+            holder_offset = offset + _HEADER.size + holder * _HOLDER.size
+            pid, count = _HOLDER.unpack_from(limits_map, holder_offset)
+            if not pid:
+                continue
+            if pid != os.getpid() and not _is_alive(pid):
+                _HOLDER.pack_into(limits_map, holder_offset, 0, 0)
+                continue
+            running += count
+        return running
+
+    def _add_running(self, limits_map, offset, count):
+        """Add to the number of running tasks of the limit at the given offset, for the current
+        process."""
+        free = None
+        pid = os.getpid()
+        for holder in range(MAX_HOLDERS):
+            holder_offset = offset + _HEADER.size + holder * _HOLDER.size
+            holder_pid, holder_count = _HOLDER.unpack_from(limits_map, holder_offset)
+            if holder_pid == pid:
+                count = max(0, holder_count + count)
+                _HOLDER.pack_into(limits_map, holder_offset, pid if count else 0, count)
+                return
+            if free is None and (not holder_pid or not holder_count):
+                free = holder_offset
+        if free is not None and count > 0:
+            _HOLDER.pack_into(limits_map, free, pid, count)
+
+    def acquire(self, names):
+        """Take a token of each given rate limit and a slot of each given concurrency limit if all
+        are available, and return 0, or return the number of seconds to wait before trying
+        again."""
+        wait = 0
+        now = time.time()
+        with self._locked() as limits_map:
+            offsets = []
+            for name in names:
+                offset = self._offset(limits_map, name)
+                if offset is None:
+                    continue
+                offsets.append((name, offset))
+                if name in self.rates:
+                    tokens = self._tokens(limits_map, name, offset, now)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) / self.rates[name])
+                if name in self.concurrency and \
+                        self._running(limits_map, offset) >= self.concurrency[name]:
+                    wait = max(wait, _CONCURRENCY_POLL_INTERVAL)
+            if wait:
+                return wait
+            for name, offset in offsets:
+                if name in self.rates:
+                    _HEADER.pack_into(limits_map, offset, _key(name),
+                                      self._tokens(limits_map, name, offset, now) - 1, now)
+                if name in self.concurrency:
+                    self._add_running(limits_map, offset, 1)
+        return 0
+
+    def release(self, names):
+        """Release a slot of each given concurrency limit."""
+        with self._locked() as limits_map:
+            for name in names:
+                if name in self.concurrency:
+                    offset = self._offset(limits_map, name)
+                    if offset is not None:
+                        self._add_running(limits_map, offset, -1)
+
+    def stats(self):
+        """Return a mapping of limit names to their current number of tokens (for rate limits)
+        and of running tasks (for concurrency limits)."""
+        now = time.time()
+        stats = {}
+        with self._locked() as limits_map:
+            for name in sorted(self.names):
+                offset = self._offset(limits_map, name)
+                if offset is None:
+                    continue
+                stats[name] = {}
+                if name in self.rates:
+                    stats[name]['tokens'] = self._tokens(limits_map, name, offset, now)
+                if name in self.concurrency:
+                    stats[name]['running'] = self._running(limits_map, offset)
+        return stats
+
+    def as_prometheus_text(self):
+        """Return limit statistics in the Prometheus text exposition format."""
+        lines = []
+        for stat, help_text in (('tokens', 'Number of tokens of host rate limits'),
+                                ('running', 'Number of running tasks of host concurrency limits')):
+            metric = 'excewo_limit_{}'.format(stat)
+            lines.extend(['# HELP {} {}'.format(metric, help_text),
+                          '# TYPE {} gauge'.format(metric)])
+            for name, limit_stats in self.stats().items():
+                if stat in limit_stats:
+                    lines.append('{}{{limit="{}"}} {}'.format(
+                        metric, name.replace('"', '\\"'), limit_stats[stat]
+                    ))
+        return '\n'.join(lines) + '\n'
+
+
+def _task_limits(app, task_name):
+    """Return the names of the limits applying to the given task."""
+    return [name for name in (plugin_name(app, task_name), task_name)
+            if name is not None and name in _limits.names]
+
+
+class _LimitsStep(bootsteps.Step):
+    """Consumer bootstep making tasks wait in the main process until host limits allow them to
+    run."""
+
+    requires = ('celery.worker.consumer.tasks:Tasks',)
+
+    def __init__(self, c, **kwargs):
+        super().__init__(c, **kwargs)
+        self._reset()
+        on_task_request = c.on_task_request
+
+        # Task strategies send requests to the pool with the handler the consumer has when they
+        # are created, once the consumer started
+        def on_limited_task_request(request):
+            return self._on_task_request(c, on_task_request, request)
+
+        c.on_task_request = on_limited_task_request
+
+    def _reset(self):
+        #: Queue of (request, limit names) tuples
+        self._waiting = deque()
+        self._waiting_limits = Counter()
+        self._retry_scheduled = False
+
+    def stop(self, c):
+        # Messages of waiting requests are delivered again once the consumer reconnects
+        self._reset()
+
+    def _on_task_request(self, c, on_task_request, request):
+        names = _task_limits(c.app, request.name) if _limits is not None else ()
+        if not names:
+            return on_task_request(request)
+        wait = 0
+        # Tasks wait behind tasks of the same limits received before them
+        if not any(self._waiting_limits[name] for name in names):
+            wait = _limits.acquire(names)
+            if not wait:
+                return self._start(on_task_request, request, names)
+        # Waiting requests must not prevent the worker from receiving other messages
+        c.qos.increment_eventually()
+        self._waiting.append((request, names))
+        self._waiting_limits.update(names)
+        self._schedule_retry(c, on_task_request, wait or _CONCURRENCY_POLL_INTERVAL)
+
+    def _schedule_retry(self, c, on_task_request, wait):
+        if not self._retry_scheduled:
+            self._retry_scheduled = True
+            c.timer.call_after(wait, self._retry, (c, on_task_request))
+
+    def _retry(self, c, on_task_request):
+        """Start waiting requests which limits allow to run, in order."""
+        self._retry_scheduled = False
+        waiting, self._waiting = self._waiting, deque()
+        blocked = set()
+        waits = []
+        for request, names in waiting:
+            if blocked.isdisjoint(names):
+                wait = _limits.acquire(names)
+                if not wait:
+                    self._waiting_limits.subtract(names)
+                    c.qos.decrement_eventually()
+                    self._start(on_task_request, request, names)
+                    continue
+                waits.append(wait)
+            blocked.update(names)
+            self._waiting.append((request, names))
+        if waits:
+            self._schedule_retry(c, on_task_request, min(waits))
+
+    def _start(self, on_task_request, request, names):
+        """Send a request to the pool, releasing its concurrency limits once it is done."""
+        names = [name for name in names if name in _limits.concurrency]
+        if names:
+            _release_when_done(_limits, request, names)
+        return on_task_request(request)
+
+
+def _release_when_done(limits, request, names):
+    """Release the given concurrency limits once the given request is done, failed or revoked."""
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            limits.release(names)
+
+    def wrap(callback):
+        def release_after(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                release()
+
+        return release_after
+
+    execute_using_pool = request.execute_using_pool
+
+    def execute_or_release(*args, **kwargs):
+        try:
+            return execute_using_pool(*args, **kwargs)
+        except TaskRevokedError:
+            release()
+            raise
+
+    # The request gives its bound methods as callbacks to the pool when it is executed
+    request.on_success = wrap(request.on_success)
+    request.on_failure = wrap(request.on_failure)
+    request.execute_using_pool = execute_or_release
+
+
+def configure_host_limits(app, limits):
+    """Make workers of the given application apply the given host limits (``None`` to disable
+    them)."""
+    global _limits
+    _limits = limits
+    if limits is None:
+        return
+    app.steps['consumer'].add(_LimitsStep)
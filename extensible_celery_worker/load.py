@@ -0,0 +1,252 @@
+"""Synthetic load of plugin tasks, to measure how throughput and latency of workers evolve with
+the rate of messages.
+
+Messages are published in steps of increasing load, each for a given duration: at a steady rate, or
+in bursts of messages sent at once at regular intervals. Publishing is open-loop: messages are sent
+on schedule, whether previous ones are done or not, as independent clients would send them. After
+each step, the generator waits for all results and measures end-to-end latencies (from publishing
+to result storage, so clocks of clients and workers must agree), and the throughput of completed
+tasks. A step is saturated when workers complete less than 90% of the offered rate, or do not
+complete all tasks in time: the saturation throughput is the highest throughput of all steps.
+
+Messages are built from templates, picked at random according to their weights, whose string
+arguments may hold placeholders (see ``ArgumentTemplates``).
+
+Messages go through the configured broker to running workers. With the ``memory://`` transport,
+which only connects publishers and workers of the same process, tasks are run by an embedded worker
+with in-memory results instead (see ``bench``).
+"""
+
+
+__all__ = ('ArgumentTemplates', 'format_load_results', 'run_load')
+
+
+from itertools import count
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+from celery.contrib.testing.worker import start_worker
+from celery.exceptions import NotRegistered
+from celery.states import SUCCESS
+
+from extensible_celery_worker.bench import (
+    _benchmark_config,
+    _percentile,
+    _pool_worker_options,
+    _utc_timestamp,
+    task_full_name,
+)
+
+
+#: Fraction of the offered rate below which a step is saturated
+SATURATION_RATIO = 0.9
+
+_PLACEHOLDER = re.compile(r'\{(n|uuid|random|randint:(-?\d+):(-?\d+))\}')
+
+_RESULT_POLLING_INTERVAL = 0.05
+
+
+class ArgumentTemplates:
+    """Templates of task messages, as a list of dictionaries with a ``task`` name (with or without
+    the application name prefix), and optional ``args`` list, ``kwargs`` dictionary and
+    ``weight`` (``1`` by default).
+
+    Placeholders in strings of arguments are replaced for each message: ``{n}`` with the number of
+    the message, ``{uuid}`` with a random UUID, ``{random}`` with a random number between 0 and 1,
+    and ``{randint:A:B}`` with a random integer between ``A`` and ``B``. A string which is a single
+    placeholder is replaced with its value, otherwise with a string.
+    """
+
+    def __init__(self, templates):
+        if not templates:
+            raise ValueError('No message templates')
+        self.templates = [(template['task'], template.get('args', []), template.get('kwargs', {}))
+                          for template in templates]
+        self.weights = [template.get('weight', 1) for template in templates]
+
+    @classmethod
+    def from_file(cls, path):
+        """Return templates read from the JSON file at the given path."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def task_names(self):
+        return sorted({task_name for task_name, _, _ in self.templates})
+
+    def message(self, number, rng=random):
+        """Return the task name, positional and keyword arguments of the message with the given
+        number, built from a template picked with the given random generator."""
+        task_name, args, kwargs = rng.choices(self.templates, self.weights)[0]
+        return task_name, _render(args, number, rng), _render(kwargs, number, rng)
+
+
+def _placeholder_value(match, number, rng):
+    if match.group(1) == 'n':
+        return number
+    if match.group(1) == 'uuid':
+        return str(uuid.uuid4())
+    if match.group(1) == 'random':
+        return rng.random()
+    return rng.randint(int(match.group(2)), int(match.group(3)))
+
+
+def _render(value, number, rng):
+    """Return the given argument, with placeholders of its strings replaced."""
+    if isinstance(value, str):
+        match = _PLACEHOLDER.fullmatch(value)
+        if match:
+            return _placeholder_value(match, number, rng)
+        return _PLACEHOLDER.sub(lambda match: str(_placeholder_value(match, number, rng)), value)
+    if isinstance(value, list):
+        return [_render(item, number, rng) for item in value]
+    if isinstance(value, dict):
+        return {key: _render(item, number, rng) for key, item in value.items()}
+    return value
+
+
+def _step_name(step):
+    if 'burst' in step:
+        return 'burst {}/{:g}s'.format(step['burst'], step['interval'])
+    return 'rate {:g}/s'.format(step['rate'])
+
+
+def _schedule(step):
+    """Return the times messages of the given step are sent at, in seconds from its start."""
+    if 'burst' in step:
+        return [index * step['interval']
+                for index in range(max(1, math.ceil(step['duration'] / step['interval'])))
+                for _ in range(step['burst'])]
+    return [index / step['rate'] for index in range(max(1, round(step['rate'] * step['duration'])))]
+
+
+def _send_step(app, templates, task_names, step, numbers, rng):
+    """Send the messages of the given step on schedule, and return a list of their result and the
+    time they were sent."""
+    sent = []
+    start = time.monotonic()
+    for offset in _schedule(step):
+        # Late messages are sent right away: the load does not depend on how fast tasks run
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        task_name, args, kwargs = templates.message(next(numbers), rng)
+        result = app.send_task(task_names[task_name], args=args, kwargs=kwargs)
+        sent.append((result, time.time()))
+    return sent
+
+
+def _wait(sent, timeout):
+    """Wait up to ``timeout`` seconds for the given results, and return the results done."""
+    pending = [result for result, _ in sent]
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        pending = [result for result in pending if not result.ready()]
+        if pending:
+            time.sleep(_RESULT_POLLING_INTERVAL)
+    pending_ids = {result.id for result in pending}
+    return [result for result, _ in sent if result.id not in pending_ids]
+
+
+def _step_result(step, sent, done):
+    sent_at = {result.id: sent_time for result, sent_time in sent}
+    first_sent_at = min(sent_at.values())
+    send_seconds = max(sent_at.values()) - first_sent_at
+    succeeded = [result for result in done if result.state == SUCCESS]
+    done_at = {result.id: _utc_timestamp(result.date_done) for result in succeeded}
+    latencies = sorted(done_at[result_id] - sent_at[result_id] for result_id in done_at)
+    elapsed = max(done_at.values()) - first_sent_at if done_at else 0
+    offered_rate = len(sent) / max(step['duration'], send_seconds)
+    throughput = len(done_at) / elapsed if elapsed > 0 else None
+    return {
+        'step': _step_name(step),
+        'sent': len(sent),
+        'succeeded': len(succeeded),
+        'failed': len(done) - len(succeeded),
+        'timed_out': len(sent) - len(done),
+        'offered_rate': offered_rate,
+        'throughput': throughput,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'latency_p99': _percentile(latencies, 99),
+        'saturated': len(done) < len(sent) or
+        (throughput or 0) < SATURATION_RATIO * offered_rate,
+    }
+
+
+def run_load(app, templates, steps, timeout=60.0, stop_at_saturation=True, pool='solo',
+             concurrency=1, seed=None):
+    """Send messages built from the given templates in the given steps, and return a list of
+    results of each step: numbers of messages, offered rate and throughput (messages per second),
+    end-to-end latency percentiles (in seconds) and whether the step is saturated.
+
+    Each step is a dictionary with a ``duration`` (in seconds), and a ``rate`` (messages per
+    second) or a ``burst`` size and an ``interval`` (in seconds) between bursts. Results of a step
+    are waited for ``timeout`` seconds before the next step starts. Following steps are skipped
+    once a step is saturated, if ``stop_at_saturation`` is true.
+
+    With the ``memory://`` broker, tasks are run by an embedded worker with the given pool and
+    concurrency. Raise ``NotRegistered`` if a task of the templates is unknown.
+    """
+    task_names = {task_name: task_full_name(app, task_name) for task_name in templates.task_names}
+    for task_name in task_names.values():
+        if task_name not in app.tasks:
+            raise NotRegistered(task_name)
+    rng = random.Random(seed)
+    numbers = count()
+    if not (app.conf.broker_url or '').startswith('memory://'):
+        return _run_steps(app, templates, task_names, steps, timeout, stop_at_saturation,
+                          numbers, rng)
+    with _benchmark_config(app, pool):
+        error = None
+        with start_worker(app, pool=pool, concurrency=concurrency, perform_ping_check=False,
+                          **_pool_worker_options(pool)):
+            # The embedded worker is only stopped if no exception is raised in this block
+            try:
+                results = _run_steps(app, templates, task_names, steps, timeout,
+                                     stop_at_saturation, numbers, rng)
+            except Exception as exc:
+                error = exc
+        if error is not None:
+            raise error
+    return results
+
+
+def _run_steps(app, templates, task_names, steps, timeout, stop_at_saturation, numbers, rng):
+    results = []
+    for step in steps:
+        sent = _send_step(app, templates, task_names, step, numbers, rng)
+        results.append(_step_result(step, sent, _wait(sent, timeout)))
+        if stop_at_saturation and results[-1]['saturated']:
+            break
+    return results
+
+
+def format_load_results(results):
+    """Return load results as a human-readable table, followed by the saturation throughput."""
+    step_width = max([len('Step')] + [len(result['step']) for result in results])
+    lines = ['{:<{}} {:>7} {:>7} {:>7} {:>7} {:>10} {:>10} {:>9} {:>9} {:>9}'.format(
+        'Step', step_width, 'Sent', 'Done', 'Failed', 'Late', 'Offered/s', 'Done/s', 'p50 (ms)',
+        'p95 (ms)', 'p99 (ms)'
+    )]
+    for result in results:
+        latencies = ['{:>9.2f}'.format(result[key] * 1000) if result[key] is not None
+                     else '{:>9}'.format('-')
+                     for key in ('latency_p50', 'latency_p95', 'latency_p99')]
+        lines.append('{:<{}} {:>7} {:>7} {:>7} {:>7} {:>10.1f} {:>10.1f} {}{}'.format(
+            result['step'], step_width, result['sent'], result['succeeded'], result['failed'],
+            result['timed_out'], result['offered_rate'], result['throughput'] or 0,
+            ' '.join(latencies), ' (saturated)' if result['saturated'] else '',
+        ))
+    throughputs = [result['throughput'] for result in results if result['throughput']]
+    if throughputs:
+        lines.append('')
+        lines.append('Saturation throughput: {:.1f} messages/s{}'.format(
+            max(throughputs), '' if any(result['saturated'] for result in results)
+            else ' (not reached)'
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,316 @@
+"""Memoization of results of pure plugin tasks, shared by all worker processes of a host.
+
+Tasks registered with the ``pure=True`` option always return the same result for the same
+arguments. Their results are cached in an SQLite database, keyed on the task name and a hash of the
+canonical JSON form of the arguments: when a cached result is found, the task is not executed. Only
+results of tasks whose arguments and result can be serialized in JSON are cached, and cached
+results are returned as decoded from JSON (tuples become lists).
+
+Cached results expire after a time to live, and least recently used results are evicted once the
+total size of cached results exceeds a limit. The number of hits and misses of each task is
+counted in the database too. Lookups only read the database: hit and miss counts and uses of
+cached results are kept in memory by each process, and written with the next cached result, or at
+most ``stats_flush_interval`` seconds later.
+"""
+
+
+__all__ = ('MemoCache', 'PureTask', 'configure_memo_cache')
+
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from celery import Task, signals
+
+
+_SCHEMA = '''
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    task TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+CREATE TABLE IF NOT EXISTS total_size (bytes INTEGER NOT NULL);
+INSERT INTO total_size SELECT 0 WHERE NOT EXISTS (SELECT * FROM total_size);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN
+    UPDATE total_size SET bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN
+    UPDATE total_size SET bytes = bytes - OLD.size;
+END;
+CREATE TABLE IF NOT EXISTS stats (
+    task TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+COMMIT;
+'''
+
+_cache = None
+
+
+class MemoCache:
+    """Cache of task results in the SQLite database at the given path, created when first used.
+
+    ``max_bytes`` is the maximum total size of cached results (in their JSON form), ``default_ttl``
+    the number of seconds results are kept unless a task has a ``cache_ttl`` of its own (``None``
+    to keep them until they are evicted).
+    """
+
+    #: Maximum number of seconds hit and miss counts and uses of results are kept in memory
+    stats_flush_interval = 1.0
+
+    def __init__(self, path, max_bytes=64 * 2 ** 20, default_ttl=None):
+        self.path = pathlib.Path(path).expanduser()
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._local = threading.local()
+        self._pending_lock = threading.Lock()
+        self._reset_pending()
+
+    def _reset_pending(self):
+        #: Mapping of task names to their hit and miss counts not written yet
+        self._pending_stats = {}
+        #: Mapping of keys of results used to the time they were last used
+        self._pending_uses = {}
+        #: Keys of expired results found
+        self._pending_expired = set()
+        self._pending_since = None
+        self._pending_pid = os.getpid()
+
+    def _connection(self):
+        """Return the database connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        # Connections must not be shared by pool processes forked after it was opened
+        if connection is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path.as_posix(), timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transaction(self):
+        """Return a context manager running statements in a write transaction, and returning the
+        connection."""
+        return _Transaction(self._connection())
+
+    @staticmethod
+    def key(task_name, args, kwargs):
+        """Return the cache key of a task called with the given arguments, or ``None`` if they
+        cannot be serialized in JSON."""
+        try:
+            canonical = json.dumps([task_name, list(args), kwargs or {}], sort_keys=True,
+                                   separators=(',', ':'), allow_nan=False)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, task_name, key):
+        """Return whether a result is cached for the given key, and the cached result."""
+        now = time.time()
+        row = self._connection().execute('SELECT value, expires FROM results WHERE key = ?',
+                                         (key,)).fetchone()
+        hit = row is not None and (row[1] is None or row[1] > now)
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():  # Counts of the parent process are its own
+                self._reset_pending()
+            counts = self._pending_stats.setdefault(task_name, [0, 0])
+            counts[0 if hit else 1] += 1
+            if hit:
+                self._pending_uses[key] = now
+            elif row is not None:
+                self._pending_expired.add(key)
+            if self._pending_since is None:
+                self._pending_since = now
+            flush = now - self._pending_since >= self.stats_flush_interval
+        if flush:
+            self.flush()
+        return hit, json.loads(row[0]) if hit else None
+
+    def _write_pending(self, connection):
+        """Write hit and miss counts and uses of results kept in memory, within the current
+        transaction of the given connection."""
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():
+                self._reset_pending()
+            stats, uses, expired = (self._pending_stats, self._pending_uses,
+                                    self._pending_expired)
+            self._reset_pending()
+        for task_name, (hits, misses) in stats.items():
+            connection.execute('INSERT OR IGNORE INTO stats (task) VALUES (?)', (task_name,))
+            connection.execute('UPDATE stats SET hits = hits + ?, misses = misses + ? '
+                               'WHERE task = ?', (hits, misses, task_name))
+        connection.executemany('UPDATE results SET last_used = MAX(last_used, ?) WHERE key = ?',
+                               [(used, key) for key, used in uses.items()])
+        connection.executemany('DELETE FROM results WHERE key = ? AND expires <= ?',
+                               [(key, time.time()) for key in expired])
+
+    def flush(self):
+        """Write hit and miss counts and uses of results kept in memory."""
+        if self._pending_since is None or self._pending_pid != os.getpid():
+            return
+        with self._transaction() as connection:
+            self._write_pending(connection)
+
+    def set(self, task_name, key, value, ttl=None):
+        """Cache the result of a task for the given key, evicting least recently used results if
+        needed. Results which cannot be serialized in JSON are not cached."""
+        try:
+            serialized = json.dumps(value, separators=(',', ':'), allow_nan=False)
+        except (TypeError, ValueError):
+            logging.debug('Not caching result of {}: it cannot be serialized in JSON'.format(
+                task_name
+            ))
+            return
+        size = len(serialized.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        with self._transaction() as connection:
+            self._write_pending(connection)
+            connection.execute('DELETE FROM results WHERE key = ?', (key,))
+            connection.execute(
+                'INSERT INTO results (key, task, value, size, expires, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, task_name, serialized, size, now + ttl if ttl else None, now),
+            )
+            if connection.execute('SELECT bytes FROM total_size').fetchone()[0] > self.max_bytes:
+                connection.execute('DELETE FROM results WHERE expires <= ?', (now,))
+            while connection.execute('SELECT bytes FROM total_size').fetchone()[0] > \
+                    self.max_bytes:
+                connection.execute('DELETE FROM results WHERE key = (SELECT key FROM results '
+                                   'ORDER BY last_used LIMIT 1)')
+
+    def stats(self):
+        """Return a mapping of task names to their number of cache hits and misses, and the number
+        and total size of their cached results."""
+        with self._transaction() as connection:
+            self._write_pending(connection)
+            stats = {task: {'hits': hits, 'misses': misses, 'entries': 0, 'bytes': 0}
+                     for task, hits, misses in connection.execute(
+                         'SELECT task, hits, misses FROM stats ORDER BY task'
+                     )}
+            for task, entries, size in connection.execute(
+                'SELECT task, COUNT(*), SUM(size) FROM results '
+                'WHERE expires IS NULL OR expires > ? GROUP BY task', (time.time(),)
+            ):
+                stats.setdefault(task, {'hits': 0, 'misses': 0})
+                stats[task].update(entries=entries, bytes=size)
+        return stats
+
+    def clear(self):
+        """Remove all cached results and statistics."""
+        with self._pending_lock:
+            self._reset_pending()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM results')
+            connection.execute('DELETE FROM stats')
+
+    def as_prometheus_text(self):
+        """Return cache statistics in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = []
+        for name, metric_type, help_text in (
+            ('hits', 'counter', 'Number of results of pure tasks found in the cache'),
+            ('misses', 'counter', 'Number of results of pure tasks not found in the cache'),
+            ('entries', 'gauge', 'Number of cached results'),
+            ('bytes', 'gauge', 'Size of cached results'),
+        ):
+            metric = 'excewo_memo_{}{}'.format(name, '_total' if metric_type == 'counter' else '')
+            lines.extend(['# HELP {} {}'.format(metric, help_text),
+                          '# TYPE {} {}'.format(metric, metric_type)])
+            for task, task_stats in stats.items():
+                lines.append('{}{{task="{}"}} {}'.format(metric, task.replace('"', '\\"'),
+                                                         task_stats[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class _Transaction:
+    """Context manager running statements of a connection in a write transaction."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def _flush(**kwargs):
+    cache = _cache
+    if cache is None:
+        return
+    try:
+        cache.flush()
+    except sqlite3.Error as exc:
+        logging.warning('Could not write task result cache statistics {}: {}'.format(
+            cache.path, exc
+        ))
+
+
+def configure_memo_cache(cache):
+    """Make pure tasks use the given cache (``None`` to disable caching)."""
+    global _cache
+    _cache = cache
+    if cache is not None:
+        signals.worker_process_shutdown.connect(_flush,
+                                                dispatch_uid='excewo_memo_process_shutdown')
+        signals.worker_shutdown.connect(_flush, dispatch_uid='excewo_memo_worker_shutdown')
+
+
+class PureTask(Task):
+    """Base class of pure tasks, whose results are cached by the worker."""
+
+    pure = True
+
+    #: Number of seconds results are cached (the cache default if ``None``)
+    cache_ttl = None
+
+    def __call__(self, *args, **kwargs):
+        cache = _cache
+        key = cache.key(self.name, args, kwargs) if cache is not None else None
+        if key is None:
+            return self._execute(args, kwargs)
+        try:
+            hit, value = cache.get(self.name, key)
+        except sqlite3.Error as exc:
+            logging.warning('Could not read task result cache {}: {}'.format(cache.path, exc))
+            return self._execute(args, kwargs)
+        if hit:
+            return value
+        value = self._execute(args, kwargs)
+        try:
+            cache.set(self.name, key, value, self.cache_ttl)
+        except sqlite3.Error as exc:
+            logging.warning('Could not write task result cache {}: {}'.format(cache.path, exc))
+        return value
+
+    def _execute(self, args, kwargs):
+        """Execute the task."""
+        call = super().__call__
+        # As the worker does for tasks without a custom ``__call__()``: ``Task.__call__()`` would
+        # replace the request of the worker with one only holding arguments
+        if getattr(call, '__func__', None) is Task.__call__ and self.request_stack.top is not None:
+            return self.run(*args, **kwargs)
+        return call(*args, **kwargs)
+
+
+atexit.register(_flush)
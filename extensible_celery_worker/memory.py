@@ -0,0 +1,66 @@
+"""Functions to measure memory used by worker processes."""
+
+
+__all__ = ('current_rss', 'memory_usage')
+
+
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def current_rss():
+    """Return the resident set size of the current process, in bytes.
+
+    Falls back to the peak resident set size where ``/proc`` is not available, and to ``0`` where
+    it cannot be measured at all.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X reports bytes, other platforms kilobytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _smaps_totals(pid):
+    """Return a mapping of each ``smaps`` field to its total, in bytes, for the given process."""
+    totals = {}
+    try:
+        smaps = open('/proc/{}/smaps_rollup'.format(pid))
+    except OSError:
+        smaps = open('/proc/{}/smaps'.format(pid))
+    with smaps:
+        for line in smaps:
+            field, _, value = line.partition(':')
+            value = value.split()
+            if len(value) == 2 and value[1] == 'kB':
+                totals[field] = totals.get(field, 0) + int(value[0]) * 1024
+    return totals
+
+
+def memory_usage(pid='self'):
+    """Return a dictionary with the resident (``rss``), proportional (``pss``), unique (``uss``)
+    and shared (``shared``) memory of the given process, in bytes.
+
+    Unique memory is what would be freed if the process exited, shared memory is resident memory
+    also used by other processes (for instance pages inherited from a parent process and not
+    written since). Return ``None`` where this cannot be measured (no ``/proc`` file system).
+    """
+    try:
+        totals = _smaps_totals(pid)
+    except OSError:
+        return None
+    return {
+        'rss': totals.get('Rss', 0),
+        'pss': totals.get('Pss', 0),
+        'uss': totals.get('Private_Clean', 0) + totals.get('Private_Dirty', 0),
+        'shared': totals.get('Shared_Clean', 0) + totals.get('Shared_Dirty', 0),
+    }
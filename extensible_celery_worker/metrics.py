@@ -0,0 +1,326 @@
+"""Per-task counters and latency histograms, served in the Prometheus text format.
+
+Metrics are updated from Celery task signals, in whichever process runs the task. They are stored
+in an anonymous shared memory map allocated before pool processes are forked, with one slot per
+process, so that processes never write to the same memory. The worker main process sums all slots
+when metrics are scraped from its HTTP listener.
+
+Queue wait time is the time between publishing a task and starting it. It is only known for tasks
+published with a ``excewo_published_at`` header, which is added by applications created with the
+``Celery`` class of this package.
+"""
+
+
+__all__ = ('TaskMetrics', 'add_collector', 'histogram_offset', 'install_metrics',
+           'stamp_publish_time')
+
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import mmap
+import socketserver
+import threading
+import time
+
+from billiard.process import current_process
+from celery import signals
+
+
+PUBLISHED_AT_HEADER = 'excewo_published_at'
+
+#: Upper bounds of histogram buckets, in seconds (a last, infinite bound is implied)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_COUNTERS = ('started', 'succeeded', 'failed', 'retried')
+_HISTOGRAMS = ('runtime', 'queue_wait')
+
+# Offsets of values of a task in a slot: counters, then for each histogram its sum and the count of
+# each bucket (including the infinite one)
+_HISTOGRAM_SIZE = 1 + len(BUCKETS) + 1
+_TASK_SIZE = len(_COUNTERS) + len(_HISTOGRAMS) * _HISTOGRAM_SIZE
+
+_TASK_SIGNAL_UIDS = (
+    (signals.task_prerun, 'excewo_metrics_prerun'),
+    (signals.task_postrun, 'excewo_metrics_postrun'),
+    (signals.task_failure, 'excewo_metrics_failure'),
+)
+
+_HELP = {
+    'started': 'Number of started tasks',
+    'succeeded': 'Number of tasks which succeeded',
+    'failed': 'Number of tasks which failed',
+    'retried': 'Number of tasks which were retried',
+    'runtime': 'Time spent running tasks',
+    'queue_wait': 'Time between publishing and starting tasks',
+}
+
+# Functions returning other metrics to serve, in the Prometheus text format, by name
+_collectors = {}
+
+
+def add_collector(name, collector):
+    """Serve metrics returned by the given function, in the Prometheus text format, with task
+    metrics. It replaces any function previously added with the same name."""
+    _collectors[name] = collector
+
+
+def histogram_offset(histogram):
+    """Return the offset of the sum of the given histogram in values of a task, which is followed
+    by the count of each bucket."""
+    return len(_COUNTERS) + _HISTOGRAMS.index(histogram) * _HISTOGRAM_SIZE
+
+
+def stamp_publish_time(headers=None, **kwargs):
+    """Add the publish time to the headers of a task message (``before_task_publish`` handler)."""
+    if headers is not None:
+        headers.setdefault(PUBLISHED_AT_HEADER, time.time())
+
+
+def _escape(value):
+    """Return the given string escaped as a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class TaskMetrics:
+    """Counters and histograms of the given tasks, for the given number of processes.
+
+    Slot 0 is used by the process which creates the instance, slot ``n`` by the pool process with
+    index ``n - 1``.
+    """
+
+    def __init__(self, task_names, processes=1):
+        self.slots = processes + 1
+        self._slot = 0
+        self._lock = threading.Lock()
+        self._started_at = {}
+        #: Tables of values replaced by ``add_tasks()``, still summed
+        self._retired = []
+        self._allocate(task_names)
+
+    def _allocate(self, task_names):
+        self.task_names = sorted(task_names)
+        self._task_indexes = {name: index for index, name in enumerate(self.task_names)}
+        self._slot_size = len(self.task_names) * _TASK_SIZE
+        self._map = mmap.mmap(-1, max(1, self.slots * self._slot_size) * 8)
+        self._values = memoryview(self._map).cast('d')
+        self._tables = self._retired + [(self._values, self._task_indexes, self._slot_size)]
+
+    def use_process_slot(self):
+        """Make the current process write to its own slot (from a pool process)."""
+        index = getattr(current_process(), 'index', None)
+        self._slot = index + 1 if index is not None else 0
+        self._lock = threading.Lock()
+        self._started_at = {}
+
+    def add_tasks(self, task_names):
+        """Track the given tasks too, from the worker main process before pool processes are
+        forked again (after plugins are reloaded).
+
+        Values are then written to a new memory map. The previous one is still summed, so that
+        values written to it by pool processes forked before are kept.
+        """
+        new_task_names = set(task_names) - set(self.task_names)
+        if not new_task_names:
+            return
+        with self._lock:
+            self._retired.append((self._values, self._task_indexes, self._slot_size))
+            self._allocate(self.task_names + sorted(new_task_names))
+
+    def _task_offset(self, task_name):
+        """Return the offset of values of the given task in the slot of this process, or ``None``
+        if the task is not tracked."""
+        index = self._task_indexes.get(task_name)
+        return None if index is None else self._slot * self._slot_size + index * _TASK_SIZE
+
+    def _observe(self, offset, histogram, value):
+        """Add a value to a histogram of a task, whose values are at the given offset."""
+        offset += histogram_offset(histogram)
+        self._values[offset] += value
+        self._values[offset + 1 + bisect_left(BUCKETS, value)] += 1
+
+    def on_task_prerun(self, task_id=None, task=None, **kwargs):
+        now = time.time()
+        request = task.request
+        published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+        if published_at is None and request.headers:  # Applied locally, not received by a worker
+            published_at = request.headers.get(PUBLISHED_AT_HEADER)
+        with self._lock:
+            offset = self._task_offset(task.name)
+            if offset is None:
+                return
+            self._started_at[task_id] = time.perf_counter()
+            self._values[offset] += 1
+            # Tasks with an ETA waited on purpose
+            if published_at is not None and not request.eta:
+                self._observe(offset, 'queue_wait', max(0.0, now - published_at))
+
+    def on_task_postrun(self, task_id=None, task=None, state=None, **kwargs):
+        with self._lock:
+            offset = self._task_offset(task.name)
+            if offset is None:
+                return
+            started_at = self._started_at.pop(task_id, None)
+            if state == 'SUCCESS':
+                self._values[offset + _COUNTERS.index('succeeded')] += 1
+            elif state == 'RETRY':
+                self._values[offset + _COUNTERS.index('retried')] += 1
+            if started_at is not None:
+                self._observe(offset, 'runtime', time.perf_counter() - started_at)
+
+    def on_task_failure(self, sender=None, **kwargs):
+        with self._lock:
+            offset = self._task_offset(sender.name)
+            if offset is None:
+                return
+            self._values[offset + _COUNTERS.index('failed')] += 1
+
+    def totals(self, task_name):
+        """Return values of the given task summed over all slots, as a list."""
+        totals = [0.0] * _TASK_SIZE
+        for values, task_indexes, slot_size in self._tables:
+            if task_name not in task_indexes:
+                continue
+            index = task_indexes[task_name] * _TASK_SIZE
+            for slot in range(self.slots):
+                offset = slot * slot_size + index
+                for i, value in enumerate(values[offset:offset + _TASK_SIZE]):
+                    totals[i] += value
+        return totals
+
+    def as_prometheus_text(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        totals = {name: self.totals(name) for name in self.task_names}
+        lines = []
+        for i, counter in enumerate(_COUNTERS):
+            metric = 'excewo_task_{}_total'.format(counter)
+            lines.extend(['# HELP {} {}'.format(metric, _HELP[counter]),
+                          '# TYPE {} counter'.format(metric)])
+            for name in self.task_names:
+                lines.append('{}{{task="{}"}} {:.0f}'.format(metric, _escape(name),
+                                                             totals[name][i]))
+        for h, histogram in enumerate(_HISTOGRAMS):
+            metric = 'excewo_task_{}_seconds'.format(histogram)
+            lines.extend(['# HELP {} {}'.format(metric, _HELP[histogram]),
+                          '# TYPE {} histogram'.format(metric)])
+            for name in self.task_names:
+                offset = len(_COUNTERS) + h * _HISTOGRAM_SIZE
+                values = totals[name][offset:offset + _HISTOGRAM_SIZE]
+                label = _escape(name)
+                count = 0
+                for bound, bucket_count in zip(BUCKETS + (float('inf'),), values[1:]):
+                    count += bucket_count
+                    lines.append('{}_bucket{{task="{}",le="{}"}} {:.0f}'.format(
+                        metric, label, '+Inf' if bound == float('inf') else repr(bound), count
+                    ))
+                lines.append('{}_sum{{task="{}"}} {!r}'.format(metric, label, values[0]))
+                lines.append('{}_count{{task="{}"}} {:.0f}'.format(metric, label, count))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """HTTP request handler serving metrics of the server."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = ''.join([self.server.metrics.as_prometheus_text()]
+                       + [collector() for collector in _collectors.values()]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request from {}: {}'.format(self.address_string(), format % args))
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server serving task metrics, each request in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        super().__init__(address, _MetricsRequestHandler)
+        self.metrics = metrics
+
+
+class _MetricsInstaller:
+    """Signal handlers allocating metrics for the worker and serving them while it runs."""
+
+    def __init__(self, app, port, address):
+        self.app = app
+        self.port = port
+        self.address = address
+        self.metrics = None
+        self.server = None
+
+    def on_worker_init(self, sender=None, **kwargs):
+        # Autoscaled pools may grow up to their maximum concurrency
+        autoscale = getattr(sender, 'options', {}).get('autoscale')
+        if isinstance(autoscale, str):
+            autoscale = autoscale.split(',')
+        processes = max(sender.concurrency or 1, int(autoscale[0]) if autoscale else 0)
+        # Built-in Celery tasks are not tracked
+        task_names = [name for name in self.app.tasks if not name.startswith('celery.')]
+        self.metrics = TaskMetrics(task_names, processes)
+        for signal, dispatch_uid in _TASK_SIGNAL_UIDS:
+            signal.disconnect(dispatch_uid=dispatch_uid)
+        signals.task_prerun.connect(self.metrics.on_task_prerun, weak=False,
+                                    dispatch_uid='excewo_metrics_prerun')
+        signals.task_postrun.connect(self.metrics.on_task_postrun, weak=False,
+                                     dispatch_uid='excewo_metrics_postrun')
+        signals.task_failure.connect(self.metrics.on_task_failure, weak=False,
+                                     dispatch_uid='excewo_metrics_failure')
+
+    def on_worker_process_init(self, **kwargs):
+        if self.metrics is not None:
+            self.metrics.use_process_slot()
+
+    def add_registered_tasks(self):
+        """Track tasks registered since the worker started, after plugins are reloaded."""
+        if self.metrics is not None:
+            self.metrics.add_tasks(name for name in self.app.tasks
+                                   if not name.startswith('celery.'))
+
+    def on_worker_ready(self, **kwargs):
+        if self.metrics is None or self.port is None:
+            return
+        try:
+            self.server = _MetricsServer((self.address, self.port), self.metrics)
+        except OSError as exc:
+            logging.error('Cannot serve task metrics on {}:{}: {}'.format(self.address,
+                                                                          self.port, exc))
+            return
+        threading.Thread(target=self.server.serve_forever, name='excewo-metrics',
+                         daemon=True).start()
+        logging.info('Serving task metrics on http://{}:{}/metrics'.format(
+            *self.server.server_address[:2]
+        ))
+
+    def on_worker_shutdown(self, **kwargs):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def install_metrics(app, port, address='127.0.0.1'):
+    """Collect metrics of plugin tasks of the given application when a worker starts, and serve
+    them on the given port while it runs (unless the port is ``None``).
+
+    Return the object holding signal handlers, whose ``metrics`` attribute is the ``TaskMetrics``
+    instance once the worker is initialized.
+    """
+    installer = _MetricsInstaller(app, port, address)
+    signals.worker_init.connect(installer.on_worker_init, weak=False,
+                                dispatch_uid='excewo_metrics_worker_init')
+    signals.worker_process_init.connect(installer.on_worker_process_init, weak=False,
+                                        dispatch_uid='excewo_metrics_worker_process_init')
+    signals.worker_ready.connect(installer.on_worker_ready, weak=False,
+                                 dispatch_uid='excewo_metrics_worker_ready')
+    signals.worker_shutdown.connect(installer.on_worker_shutdown, weak=False,
+                                    dispatch_uid='excewo_metrics_worker_shutdown')
+    return installer
@@ -0,0 +1,528 @@
+"""Discovery and lazy registration of task plugins.
+
+A task plugin is a module declared in the ``excewo.tasks`` entry point group. Importing it registers
+its tasks with the Celery application. In lazy mode, lightweight stand-in tasks are registered
+instead, and the real plugin module is only imported when one of its tasks is first executed.
+
+What plugins provide can be saved to a manifest file, so that next startups neither scan entry
+points nor import plugins just to find out which tasks exist. The same records tell which plugins
+changed when they are reloaded in a running worker.
+"""
+
+
+__all__ = ('LazyPluginTask', 'PluginReloader', 'PluginTaskRegistry', 'import_plugins',
+           'load_manifest', 'register_lazy_tasks', 'save_manifest', 'scan_plugins',
+           'scan_plugins_isolated', 'task_plugin_entry_points')
+
+
+from contextlib import contextmanager
+import hashlib
+import importlib
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata
+from celery import Task
+from celery.app.registry import TaskRegistry
+from celery.app.trace import task_has_custom
+from celery.exceptions import NotRegistered
+
+from extensible_celery_worker.memory import current_rss
+from extensible_celery_worker.preload import preload_plugins
+from extensible_celery_worker.startup_profile import phase, plugin_import, record_plugin
+
+
+TASK_PLUGIN_NAMESPACE = 'excewo.tasks'
+
+_MANIFEST_VERSION = 2
+
+# Task options given to ``@app.task()`` that the worker needs to know before the plugin is imported
+_PROXIED_TASK_OPTIONS = frozenset((
+    'acks_late',
+    'ignore_result',
+    'pure',
+    'rate_limit',
+    'reject_on_worker_lost',
+    'serializer',
+    'soft_time_limit',
+    'store_errors_even_if_ignored',
+    'time_limit',
+    'track_started',
+))
+
+_plugin_import_lock = threading.RLock()
+
+
+class LazyPluginTask(Task):
+    """Stand-in for a plugin task whose module is imported the first time the task is executed.
+
+    Handlers of the real task (``on_success()``, ``on_failure()``, ``on_retry()``,
+    ``after_return()``) and its custom ``__call__()``, if any, are called as they would be without
+    the stand-in.
+    """
+
+    #: Dotted path of the plugin module providing the real task
+    plugin_module = None
+
+    _real_task = None
+
+    @contextmanager
+    def _real_request(self):
+        """Context manager making the request of this stand-in the request of the real task."""
+        real_task = self._real_task or self._import_real_task()
+        real_task.request_stack.push(self.request)
+        try:
+            yield real_task
+        finally:
+            real_task.request_stack.pop()
+
+    def __call__(self, *args, **kwargs):
+        with self._real_request() as real_task:
+            if task_has_custom(real_task, '__call__'):
+                return real_task(*args, **kwargs)
+            return real_task.run(*args, **kwargs)
+
+    def on_success(self, retval, task_id, args, kwargs):
+        if self._real_task is not None:
+            with self._real_request() as real_task:
+                real_task.on_success(retval, task_id, args, kwargs)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        if self._real_task is not None:
+            with self._real_request() as real_task:
+                real_task.on_failure(exc, task_id, args, kwargs, einfo)
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        if self._real_task is not None:
+            with self._real_request() as real_task:
+                real_task.on_retry(exc, task_id, args, kwargs, einfo)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        if self._real_task is not None:
+            with self._real_request() as real_task:
+                real_task.after_return(status, retval, task_id, args, kwargs, einfo)
+
+    def _import_real_task(self):
+        """Import the plugin module providing this task and return the real task."""
+        with _plugin_import_lock:
+            if self._real_task is None:
+                _import_plugin_module(self.app, self.plugin_module)
+            if self._real_task is None:
+                raise NotRegistered(self.name)
+        return self._real_task
+
+
+class PluginTaskRegistry(TaskRegistry):
+    """Task registry waiting for on-demand plugin imports to finish before reporting a task as not
+    registered.
+
+    Stand-in tasks leave the registry while their plugin module is imported, so that ``@app.task``
+    registers the real tasks. With the threads or gevent pools, a task looked up meanwhile is then
+    found once the import is done.
+    """
+
+    def __missing__(self, key):
+        with _plugin_import_lock:
+            if key in self:
+                return self.get(key)
+        return super().__missing__(key)
+
+
+def _entry_point_module(entry_point):
+    """Return the dotted path of the module an entry point refers to."""
+    return entry_point.value.split(':')[0].strip()
+
+
+def _import_plugin_module(app, module):
+    """Import a plugin module on behalf of its stand-in tasks and bind them to the real tasks."""
+    stand_ins = {name: task for name, task in app.tasks.items()
+                 if isinstance(task, LazyPluginTask) and task.plugin_module == module}
+    # Stand-ins must leave the registry, otherwise ``@app.task`` would return them instead of
+    # registering the real tasks
+    for name in stand_ins:
+        del app.tasks[name]
+    start = time.monotonic()
+    try:
+        importlib.import_module(module)
+    finally:
+        for name, stand_in in stand_ins.items():
+            real_task = app.tasks.get(name)
+            if real_task is not None and real_task is not stand_in:
+                stand_in._real_task = real_task
+            # The worker keeps executing the stand-in, whose tracer is already built
+            app.tasks[name] = stand_in
+    logging.info('Imported task plugin module {} on demand in {:.3f}s'.format(
+        module, time.monotonic() - start
+    ))
+
+
+def _file_digest(path):
+    """Return the SHA-256 hex digest of the file at the given path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_state(path):
+    """Return the modification time, size and digest of the file at the given path."""
+    stat = os.stat(path)
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': _file_digest(path),
+    }
+
+
+def _module_files(module_names):
+    """Return a mapping of each source file of the given modules to its modification time, size
+    and digest."""
+    files = {}
+    for module_name in module_names:
+        path = getattr(sys.modules.get(module_name), '__file__', None)
+        if not path or not os.path.isfile(path):
+            continue
+        files[path] = _file_state(path)
+    return files
+
+
+def _unchanged_file(path, state):
+    """Return whether the file at the given path is the same as when ``state`` was recorded."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_mtime_ns == state['mtime_ns'] and stat.st_size == state['size']:
+        return True
+    return stat.st_size == state['size'] and _file_digest(path) == state['sha256']
+
+
+def _environment_fingerprint(app):
+    """Return what must not change for a plugin manifest to remain valid.
+
+    Installing, upgrading or removing a distribution changes the modification time of its
+    installation directory, which is in ``sys.path``. The current directory is left out since its
+    modification time changes for unrelated reasons.
+    """
+    path_mtimes = {}
+    for entry in sys.path:
+        if not entry:
+            continue
+        try:
+            path_mtimes[entry] = os.stat(entry).st_mtime_ns
+        except OSError:
+            path_mtimes[entry] = None
+    return {
+        'app_name': app.main,
+        'python': '{} {}'.format(sys.executable, sys.version),
+        'sys_path': path_mtimes,
+    }
+
+
+def _task_options(task):
+    """Return the options explicitly given to ``@app.task()`` for the given task."""
+    return {k: v for k, v in vars(type(task)).items()
+            if k in _PROXIED_TASK_OPTIONS and isinstance(v, (bool, int, float, str, type(None)))}
+
+
+def task_plugin_entry_points():
+    """Return the entry points of all installed task plugins, without loading them."""
+    entry_points = importlib_metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=TASK_PLUGIN_NAMESPACE))
+    return list(entry_points.get(TASK_PLUGIN_NAMESPACE, ()))
+
+
+def scan_plugins(app, plugin_names=None):
+    """Import every installed task plugin (or only those whose name is in ``plugin_names``, if
+    given) and return a list of records describing each of them.
+
+    Each record is a dictionary with the plugin ``name``, its ``module``, the ``tasks`` it
+    registered (mapping task names to their explicit options), the state of the plugin package
+    source ``files``, and the wall time (``import_seconds``) and resident memory (``rss_bytes``)
+    its import cost. If the plugin could not be imported, ``error`` holds the reason why (it is
+    ``None`` otherwise).
+    """
+    records = []
+    with phase('entry point scan'):
+        entry_points = task_plugin_entry_points()
+    for entry_point in entry_points:
+        if plugin_names is not None and entry_point.name not in plugin_names:
+            continue
+        module = _entry_point_module(entry_point)
+        known_task_names = set(app.tasks)
+        known_module_names = set(sys.modules)
+        rss_before = current_rss()
+        start = time.monotonic()
+        error = None
+        try:
+            with plugin_import(entry_point.name, module):
+                entry_point.load()
+        except Exception as exc:
+            logging.exception('Could not load task plugin "{}"'.format(entry_point.name))
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        import_seconds = time.monotonic() - start
+        package = module.split('.')[0]
+        records.append({
+            'name': entry_point.name,
+            'module': module,
+            'tasks': {} if error else {name: _task_options(app.tasks[name])
+                                       for name in sorted(set(app.tasks) - known_task_names)},
+            'files': {} if error else _module_files({module}.union(
+                name for name in set(sys.modules) - known_module_names
+                if name == package or name.startswith(package + '.')
+            )),
+            'import_seconds': import_seconds,
+            'rss_bytes': max(0, current_rss() - rss_before),
+            'error': error,
+        })
+    return records
+
+
+def scan_plugins_isolated(app):
+    """Same as ``scan_plugins()``, but import plugins in a separate Python process so that they are
+    not loaded in the current one."""
+    with tempfile.TemporaryDirectory(prefix='excewo-') as tmp_dir, \
+            phase('plugin scan in a separate process'):
+        output_path = pathlib.Path(tmp_dir) / 'plugins.json'
+        subprocess.run([sys.executable, '-m', __name__, app.main, output_path.as_posix()],
+                       check=True)
+        with output_path.open() as output:
+            records = json.load(output)
+    for record in records:
+        record_plugin(record)
+    return records
+
+
+def import_plugins(app, records):
+    """Import the module of each plugin described in ``records``, registering their tasks."""
+    for record in records:
+        try:
+            with plugin_import(record['name'], record['module']):
+                importlib.import_module(record['module'])
+        except Exception:
+            logging.exception('Could not load task plugin "{}"'.format(record['name']))
+
+
+def load_manifest(path, app):
+    """Return plugin records saved in the manifest file at the given path, or ``None`` if it does
+    not exist or is outdated."""
+    path = pathlib.Path(path).expanduser()
+    try:
+        with path.open() as f, phase('plugin manifest loading'):
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logging.warning('Ignoring unreadable plugin manifest {}'.format(path.as_posix()))
+        return None
+    if manifest.get('version') != _MANIFEST_VERSION:
+        return None
+    if manifest.get('fingerprint') != _environment_fingerprint(app):
+        logging.info('Plugin manifest {} is outdated: installed packages or application '
+                     'name changed'.format(path.as_posix()))
+        return None
+    for record in manifest['plugins']:
+        for file_path, state in record['files'].items():
+            if not _unchanged_file(file_path, state):
+                logging.info('Plugin manifest {} is outdated: {} changed'.format(
+                    path.as_posix(), file_path
+                ))
+                return None
+    return manifest['plugins']
+
+
+def save_manifest(path, app, records):
+    """Save plugin records in a manifest file at the given path.
+
+    Nothing is saved if a plugin could not be imported, so that it is imported again on next
+    startup instead of being left out until the manifest is outdated for another reason.
+    """
+    path = pathlib.Path(path).expanduser()
+    failed = [record['name'] for record in records if record.get('error')]
+    if failed:
+        logging.warning('Not saving plugin manifest {}: could not load task plugins {}'.format(
+            path.as_posix(), ', '.join(failed)
+        ))
+        return
+    manifest = {
+        'version': _MANIFEST_VERSION,
+        'fingerprint': _environment_fingerprint(app),
+        'plugins': records,
+    }
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name('.{}.{}'.format(path.name, os.getpid()))
+        with tmp_path.open('w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path.as_posix(), path.as_posix())
+    except OSError as exc:
+        logging.warning('Could not save plugin manifest {}: {}'.format(path.as_posix(), exc))
+
+
+def register_lazy_tasks(app, records):
+    """Register a stand-in task for each task provided by the plugins described in ``records``.
+
+    Tasks which are already registered (because their plugin module is already imported) are left
+    untouched. Return the list of registered stand-ins.
+    """
+    stand_ins = []
+    for record in records:
+        for name, options in record['tasks'].items():
+            if name in app.tasks:
+                continue
+            task_cls = type(name.rpartition('.')[2], (LazyPluginTask,), dict(
+                options,
+                name=name,
+                plugin_module=record['module'],
+                __module__=record['module'],
+            ))
+            stand_ins.append(app.register_task(task_cls()))
+    return stand_ins
+
+
+class PluginReloader:
+    """Reloader of task plugins registered from ``records`` (as returned by ``scan_plugins()``),
+    which finds out which plugins changed since they were loaded, and loads them again.
+
+    A plugin changed if one of its source files changed, if its entry point refers to another
+    module, or if it was installed or removed (only plugins whose name is in ``plugin_names``, if
+    given, are considered). ``plugin_loading`` is the mode plugins were loaded with, and the
+    manifest at ``manifest_path``, if given, is updated after each reload, as on startup.
+    ``on_reload`` is called without arguments after plugins were reloaded, for instance to
+    configure their new tasks.
+    """
+
+    def __init__(self, app, records, plugin_loading='eager', plugin_names=None,
+                 manifest_path=None, on_reload=None):
+        self.app = app
+        self.records = {record['name']: record for record in records}
+        self.plugin_loading = plugin_loading
+        self.plugin_names = plugin_names
+        self.manifest_path = manifest_path
+        self.on_reload = on_reload
+
+    def _entry_point_modules(self):
+        """Return a mapping of names of installed task plugins to their module."""
+        importlib.invalidate_caches()
+        return {entry_point.name: _entry_point_module(entry_point)
+                for entry_point in task_plugin_entry_points()
+                if self.plugin_names is None or entry_point.name in self.plugin_names}
+
+    def outdated_plugins(self, retry_failed=False):
+        """Return the sorted names of plugins which changed, were installed or were removed, and
+        of plugins which could not be imported if ``retry_failed`` is true."""
+        modules = self._entry_point_modules()
+        outdated = set(modules).symmetric_difference(self.records)
+        for name, record in self.records.items():
+            if name in modules and (
+                modules[name] != record['module'] or (retry_failed and record.get('error')) or
+                not all(_unchanged_file(path, state) for path, state in record['files'].items())
+            ):
+                outdated.add(name)
+        return sorted(outdated)
+
+    def _unload(self, record):
+        """Unregister tasks of the plugin described by the given record, and forget its modules,
+        warm-up functions and resources. Return what was removed, to restore it."""
+        tasks = {name: self.app.tasks.pop(name) for name in record['tasks']
+                 if name in self.app.tasks}
+        modules = {name: sys.modules.pop(name) for name, module in list(sys.modules.items())
+                   if name == record['module'] or
+                   getattr(module, '__file__', None) in record['files']}
+        warm_ups = [warm_up for warm_up in self.app.warm_ups if warm_up.__module__ in modules]
+        self.app.warm_ups[:] = [warm_up for warm_up in self.app.warm_ups
+                                if warm_up not in warm_ups]
+        resources = {name: self.app.resources.pop(name)
+                     for name, resource in list(self.app.resources.items())
+                     if resource.setup.__module__ in modules}
+        return tasks, modules, warm_ups, resources
+
+    def _restore(self, removed):
+        """Register again tasks, modules, warm-up functions and resources returned by
+        ``_unload()``."""
+        tasks, modules, warm_ups, resources = removed
+        self.app.tasks.update(tasks)
+        sys.modules.update(modules)
+        self.app.warm_ups.extend(warm_ups)
+        self.app.resources.update(resources)
+
+    def reload(self, retry_failed=False):
+        """Load again plugins which changed since they were loaded (and plugins which could not be
+        imported if ``retry_failed`` is true), and return the names of the tasks which were
+        registered, replaced or unregistered.
+
+        If a plugin which was already loaded cannot be imported any longer, its previous version
+        is kept until its files change again.
+        """
+        with _plugin_import_lock:
+            outdated = self.outdated_plugins(retry_failed)
+            if not outdated:
+                return set()
+            start = time.monotonic()
+            removed = {name: self._unload(self.records[name])
+                       for name in outdated if name in self.records}
+            kept_warm_up_count = len(self.app.warm_ups)
+            if self.plugin_loading == 'lazy':
+                records = [record for record in scan_plugins_isolated(self.app)
+                           if record['name'] in outdated]
+                register_lazy_tasks(self.app, [record for record in records
+                                               if not record.get('error')])
+            else:
+                records = scan_plugins(self.app, outdated)
+            new_warm_ups = self.app.warm_ups[kept_warm_up_count:]
+            previous_records = {name: self.records.pop(name)
+                                for name in outdated if name in self.records}
+            task_names = set()
+            for record in records:
+                name = record['name']
+                if record.get('error') and name in removed:
+                    logging.warning('Keeping the previous version of task plugin "{}"'.format(
+                        name
+                    ))
+                    self._restore(removed[name])
+                    previous = previous_records.pop(name)
+                    self.records[name] = dict(previous, files={
+                        path: _file_state(path) for path in previous['files']
+                        if os.path.isfile(path)
+                    })
+                    continue
+                self.records[name] = record
+                task_names.update(record['tasks'])
+            for previous in previous_records.values():
+                task_names.update(previous['tasks'])
+            if self.plugin_loading == 'preload':
+                preload_plugins(self.app, new_warm_ups)
+            if self.on_reload is not None:
+                self.on_reload()
+        if self.manifest_path and (self.plugin_loading == 'lazy' or self.plugin_names is None):
+            save_manifest(self.manifest_path, self.app, list(self.records.values()))
+        logging.info('Reloaded task plugins {} in {:.3f}s'.format(
+            ', '.join(outdated), time.monotonic() - start
+        ))
+        return task_names
+
+
+def _main(argv):
+    """Scan task plugins for the application named ``argv[0]`` and dump records to ``argv[1]``."""
+    from extensible_celery_worker import app
+    app_name, output_path = argv
+    app.main = app_name
+    records = scan_plugins(app)
+    with open(output_path, 'w') as output:
+        json.dump(records, output)
+
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
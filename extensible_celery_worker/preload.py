@@ -0,0 +1,86 @@
+"""Preloading of task plugins in the worker main process, for copy-on-write friendly pools.
+
+Plugins are imported and warmed up in the main process. Just before pool processes are forked, the
+garbage collector is run and all surviving objects are frozen (moved to a permanent generation), so
+that garbage collection in pool processes does not write to, and thus un-share, memory pages
+inherited from the main process.
+"""
+
+
+__all__ = ('preload_plugins',)
+
+
+import gc
+import logging
+import time
+
+from celery import signals
+
+from extensible_celery_worker.memory import memory_usage
+
+
+def _mib(size):
+    """Return the given size in bytes as a string in MiB."""
+    return '{:.1f} MiB'.format(size / 2 ** 20)
+
+
+def _run_warm_ups(warm_ups):
+    """Call the given warm-up functions declared by plugins."""
+    for warm_up in warm_ups:
+        start = time.monotonic()
+        try:
+            warm_up()
+        except Exception:
+            logging.exception('Warm-up {}.{} failed'.format(warm_up.__module__,
+                                                            warm_up.__qualname__))
+            continue
+        logging.info('Warm-up {}.{} done in {:.3f}s'.format(
+            warm_up.__module__, warm_up.__qualname__, time.monotonic() - start
+        ))
+
+
+def _freeze_heap(sender=None, **kwargs):
+    """Collect garbage and freeze all remaining objects before pool processes are forked."""
+    if not hasattr(gc, 'freeze'):  # Python < 3.7
+        logging.warning('Cannot freeze the heap before forking pool processes: Python 3.7 or '
+                        'later is required')
+        return
+    gc.collect()
+    gc.freeze()
+    logging.info('Froze {} objects before forking pool processes'.format(gc.get_freeze_count()))
+
+
+def _report_pool_memory(sender=None, **kwargs):
+    """Log unique and shared memory of each pool process once the worker is ready."""
+    pids = sender.pool.info.get('processes', []) if sender.pool is not None else []
+    usages = {pid: memory_usage(pid) for pid in pids}
+    usages = {pid: usage for pid, usage in usages.items() if usage is not None}
+    if not usages:
+        logging.info('Memory usage of pool processes is not available on this platform')
+        return
+    for pid, usage in sorted(usages.items()):
+        logging.info('Pool process {}: USS {}, PSS {}, shared {}, RSS {}'.format(
+            pid, _mib(usage['uss']), _mib(usage['pss']), _mib(usage['shared']),
+            _mib(usage['rss']),
+        ))
+    logging.info('All {} pool processes: USS {}, PSS {}'.format(
+        len(usages),
+        _mib(sum(usage['uss'] for usage in usages.values())),
+        _mib(sum(usage['pss'] for usage in usages.values())),
+    ))
+
+
+def preload_plugins(app, warm_ups=None):
+    """Warm up already imported plugins and prepare the heap to be shared with pool processes.
+
+    Memory usage of pool processes is logged when the worker is ready. If ``warm_ups`` is given,
+    only these warm-up functions are called: plugins were reloaded in a running worker, and the
+    heap is frozen right away, before pool processes are restarted.
+    """
+    if warm_ups is not None:
+        _run_warm_ups(warm_ups)
+        _freeze_heap()
+        return
+    _run_warm_ups(app.warm_ups)
+    signals.worker_init.connect(_freeze_heap, dispatch_uid='excewo_freeze_heap')
+    signals.worker_ready.connect(_report_pool_memory, dispatch_uid='excewo_report_pool_memory')
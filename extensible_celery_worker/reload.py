@@ -0,0 +1,112 @@
+"""Reload of task plugins in a running worker, without restarting it.
+
+When the worker main process receives ``SIGUSR2``, or when plugin source files change (if they are
+watched), task plugins which changed since they were loaded are imported again, new plugins are
+loaded and removed plugins unloaded (see ``PluginReloader``). The consumer then uses the new tasks
+for messages it receives from then on, while tasks already received run to completion with the
+code they were received with.
+
+Prefork pool processes are restarted gracefully: each process exits once its current task is
+done, and is replaced with a process forked from the main process, which runs the new code. Other
+pools run tasks in the main process, which already runs the new code.
+"""
+
+
+__all__ = ('RELOAD_SIGNAL', 'configure_plugin_reload')
+
+
+import logging
+import threading
+import time
+
+from celery import bootsteps, platforms
+from celery.app.trace import build_tracer
+
+
+RELOAD_SIGNAL = 'SIGUSR2'
+
+# Number of seconds between two checks of whether plugins must be reloaded
+_CHECK_INTERVAL = 1.0
+
+
+class _PluginReloadStep(bootsteps.StartStopStep):
+    """Consumer bootstep reloading plugins on signal, or when their files change."""
+
+    requires = ('celery.worker.consumer.tasks:Tasks',)
+
+    #: ``PluginReloader`` of the plugins of the worker
+    reloader = None
+
+    #: Number of seconds between two checks of plugin files, ``None`` not to watch them
+    watch_interval = None
+
+    def __init__(self, c, **kwargs):
+        super().__init__(c, **kwargs)
+        self._requested = False
+        self._last_watch = time.monotonic()
+        self._timer_entry = None
+
+    def start(self, c):
+        # Signal handlers can only be installed in the main thread
+        if threading.current_thread() is threading.main_thread():
+            platforms.signals[RELOAD_SIGNAL] = self._on_signal
+        self._timer_entry = c.timer.call_repeatedly(_CHECK_INTERVAL, self._check, (c,))
+
+    def stop(self, c):
+        if self._timer_entry is not None:
+            self._timer_entry.cancel()
+            self._timer_entry = None
+
+    def _on_signal(self, signum, frame):
+        # Plugins are reloaded by the consumer, not while the signal interrupts it
+        self._requested = True
+
+    def _check(self, c):
+        """Reload plugins if it was requested, or if they are watched and it is time to."""
+        requested, self._requested = self._requested, False
+        now = time.monotonic()
+        watched = self.watch_interval is not None and \
+            now - self._last_watch >= self.watch_interval
+        if watched:
+            self._last_watch = now
+        if requested:
+            logging.info('Received {}, reloading task plugins'.format(RELOAD_SIGNAL))
+        if requested or watched:
+            self.reload(c, retry_failed=requested)
+
+    def reload(self, c, retry_failed=False):
+        """Reload plugins which changed, and make the consumer and the pool use their tasks."""
+        try:
+            task_names = self.reloader.reload(retry_failed)
+        except Exception:
+            logging.exception('Could not reload task plugins')
+            return
+        if not task_names:
+            if retry_failed:
+                logging.info('No task plugin changed')
+            return
+        # Same as ``Consumer.update_strategies()`` and ``reset_rate_limits()``, for reloaded tasks
+        for name in task_names:
+            task = c.app.tasks.get(name)
+            if task is None:
+                c.strategies.pop(name, None)
+                c.task_buckets.pop(name, None)
+                continue
+            c.strategies[name] = task.start_strategy(c.app, c)
+            task.__trace__ = build_tracer(name, task, c.app.loader, c.hostname, app=c.app)
+            c.task_buckets[name] = c.bucket_for_task(task)
+        try:
+            c.pool.restart()
+        except NotImplementedError:  # Tasks run in the main process
+            return
+        logging.info('Restarting pool processes once they are done with their current task')
+
+
+def configure_plugin_reload(app, reloader, watch_interval=None):
+    """Make workers of the given application reload plugins with the given ``PluginReloader`` on
+    ``SIGUSR2``, and every ``watch_interval`` seconds if given and plugins changed."""
+    app.conf.worker_pool_restarts = True
+    app.steps['consumer'].add(type('PluginReloadConsumer', (_PluginReloadStep,), {
+        'reloader': reloader,
+        'watch_interval': watch_interval,
+    }))
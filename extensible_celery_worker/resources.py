@@ -0,0 +1,166 @@
+"""Resources declared by plugins (connection pools, loaded models, compiled regexes...), managed by
+the worker in each pool process.
+
+A resource is declared with the ``app.resource`` decorator, on a function creating it. If the
+function is a generator, it yields the resource, and the code after ``yield`` tears it down::
+
+    @app.resource
+    def db():
+        pool = create_pool(DATABASE_URL)
+        yield pool
+        pool.close()
+
+    @app.task
+    def count_users():
+        with db.get().connection() as connection:
+            ...
+
+Resources are set up in each prefork pool process when it starts (setup time is logged), torn down
+when it exits, and set up on first use in other processes. Resources set up in the worker main
+process (for instance by warm-up functions) are torn down before pool processes are forked, and
+forked processes never use or tear down resources inherited from their parent.
+"""
+
+
+__all__ = ('Resource', 'manage_resources', 'set_up_resources', 'tear_down_resources')
+
+
+import inspect
+import logging
+import os
+import threading
+import time
+import weakref
+
+from celery import current_app, signals
+
+
+_UNSET = object()
+
+# All resources of this process, forgotten in forked processes
+_all_resources = weakref.WeakSet()
+
+
+class Resource:
+    """Resource created by ``setup``, a function, or a generator function yielding the resource
+    and tearing it down when resumed."""
+
+    def __init__(self, setup, name=None):
+        self.setup = setup
+        self.name = name or '{}.{}'.format(setup.__module__, setup.__qualname__)
+        #: Number of seconds the last setup of the resource took in this process
+        self.setup_seconds = None
+        self._value = _UNSET
+        self._generator = None
+        self._lock = threading.Lock()
+        _all_resources.add(self)
+
+    def get(self):
+        """Return the resource, which is set up first if it is not yet in this process."""
+        value = self._value
+        if value is _UNSET:
+            value = self._set_up()
+        return value
+
+    def _set_up(self):
+        """Set up the resource, unless another thread just did, and return it."""
+        with self._lock:
+            if self._value is not _UNSET:
+                return self._value
+            start = time.monotonic()
+            if inspect.isgeneratorfunction(self.setup):
+                generator = self.setup()
+                value = next(generator)
+                self._generator = generator
+            else:
+                value = self.setup()
+            self.setup_seconds = time.monotonic() - start
+            self._value = value
+        logging.info('Set up resource {} in {:.3f}s'.format(self.name, self.setup_seconds))
+        return value
+
+    def tear_down(self):
+        """Tear down the resource if it is set up in this process."""
+        with self._lock:
+            generator, self._generator = self._generator, None
+            self._value = _UNSET
+        if generator is None:
+            return
+        try:
+            next(generator)
+        except StopIteration:
+            return
+        generator.close()
+        logging.warning('Resource {} yielded more than once'.format(self.name))
+
+    def _forget(self):
+        """Forget the resource inherited from the parent process, without tearing it down."""
+        self._value = _UNSET
+        self._generator = None
+        self._lock = threading.Lock()
+
+
+def _forget_resources():
+    for resource in list(_all_resources):
+        resource._forget()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_resources)
+
+
+def set_up_resources(app):
+    """Set up all resources declared for the given application which are not yet in this
+    process."""
+    start = time.monotonic()
+    count = 0
+    for resource in list(getattr(app, 'resources', {}).values()):
+        if resource._value is not _UNSET:
+            continue
+        try:
+            resource.get()
+        except Exception:
+            logging.exception('Could not set up resource {}'.format(resource.name))
+            continue
+        count += 1
+    if count:
+        logging.info('Set up {} resources in {:.3f}s'.format(count, time.monotonic() - start))
+
+
+def tear_down_resources(app):
+    """Tear down all resources declared for the given application which are set up in this
+    process."""
+    for resource in list(getattr(app, 'resources', {}).values()):
+        try:
+            resource.tear_down()
+        except Exception:
+            logging.exception('Could not tear down resource {}'.format(resource.name))
+
+
+def _on_worker_init(sender=None, **kwargs):
+    # Pool processes must not share what the main process set up
+    tear_down_resources(sender.app)
+
+
+def _on_worker_process_init(**kwargs):
+    set_up_resources(current_app)
+
+
+def _on_worker_process_shutdown(**kwargs):
+    tear_down_resources(current_app)
+
+
+def _on_worker_shutdown(sender=None, **kwargs):
+    tear_down_resources(sender.app)
+
+
+def manage_resources():
+    """Set up and tear down resources of the application of the worker in its processes."""
+    signals.worker_init.connect(_on_worker_init, dispatch_uid='excewo_resources_worker_init')
+    signals.worker_process_init.connect(_on_worker_process_init,
+                                        dispatch_uid='excewo_resources_worker_process_init')
+    signals.worker_process_shutdown.connect(
+        _on_worker_process_shutdown, dispatch_uid='excewo_resources_worker_process_shutdown'
+    )
+    signals.worker_shutdown.connect(_on_worker_shutdown,
+                                    dispatch_uid='excewo_resources_worker_shutdown')
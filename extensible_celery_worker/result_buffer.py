@@ -0,0 +1,246 @@
+"""Buffering of task results, written to the result backend in batches.
+
+By default, each task execution stores its result with a few round-trips to the result backend:
+a read of the current state of the task (so that a successful result is never overwritten), then
+a write. With result buffering, each worker process encodes results as tasks finish, but keeps
+them in a buffer written to the backend once it holds ``size`` results, or ``delay`` seconds after
+the oldest one was buffered: results are then read once for all with a single ``mget``, and written
+in a single pipeline (Redis backend) or one write per result (other key-value backends, such as
+Memcached or the file system). ``AsyncResult.get()`` thus sees results at most ``delay`` seconds
+(plus the write itself) after tasks finished.
+
+Results of a process are written in the order they were stored. With ``coalesce``, only the last
+state stored for a task in a batch is written (for example, ``SUCCESS`` rather than ``STARTED``
+then ``SUCCESS``, or custom progress states), which saves writes but hides intermediate states.
+
+Some results are written immediately, after the results buffered before them:
+
+* results of chord header tasks, since the chord callback is run once all of them are stored;
+* results of tasks acknowledged late (``acks_late``), unless ``buffer_acks_late``: their message
+  is acknowledged when the task is done, so a buffered result would be lost if the process died
+  before writing it, although the message would not be delivered again;
+* results stored outside task executions.
+
+Buffered results of other tasks are lost if the process is killed before writing them. Results
+are only buffered with key-value result backends (Redis, Memcached, file system...).
+"""
+
+
+__all__ = ('ResultBuffer', 'configure_result_buffering')
+
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from celery import signals
+from celery.backends.base import DisabledBackend, KeyValueStoreBackend
+from celery.backends.redis import RedisBackend
+from celery.states import SUCCESS
+
+
+_app = None
+_settings = None
+
+# Installed buffers, flushed when processes exit
+_buffers = []
+
+
+class ResultBuffer:
+    """Buffer of results of the given key-value result backend, written once it holds ``size``
+    results or ``delay`` seconds after the oldest one was buffered."""
+
+    def __init__(self, backend, size=100, delay=0.1, coalesce=True, buffer_acks_late=False):
+        self.backend = backend
+        self.size = size
+        self.delay = delay
+        self.coalesce = coalesce
+        self.buffer_acks_late = buffer_acks_late
+        # Unbound, so that the buffer can replace the method of the backend instance
+        self._store_result = type(backend).store_result
+        self._reset()
+
+    def _reset(self):
+        #: List of (task_id, state, encoded meta-data) tuples, oldest first
+        self._entries = []
+        self._first_at = None
+        self._condition = threading.Condition()
+        # Held while writing, so that batches are written in order
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _use_process(self):
+        # Results of the parent process are its own to write, and its locks may have been held by
+        # its threads when it forked
+        if self._pid != os.getpid():
+            self._reset()
+
+    def install(self):
+        """Make the backend store results through the buffer."""
+        self.backend.store_result = self.store_result
+
+    def buffers(self, request):
+        """Return whether the result of a task execution with the given request is buffered."""
+        if request is None or getattr(request, 'chord', None):
+            return False
+        if self.buffer_acks_late:
+            return True
+        task = self.backend.app.tasks.get(getattr(request, 'task', None))
+        return task is not None and not task.acks_late
+
+    def store_result(self, task_id, result, state, traceback=None, request=None, **kwargs):
+        """Buffer the result of a task, or write it with the results buffered before it if it
+        must not be buffered."""
+        if not self.buffers(request):
+            self.flush()
+            return self._store_result(self.backend, task_id, result, state, traceback,
+                                      request=request, **kwargs)
+        backend = self.backend
+        # Encoded now, so that encoding errors fail the task as they would without buffering
+        result = backend.encode_result(result, state)
+        meta = backend._get_result_meta(result=result, state=state, traceback=traceback,
+                                        request=request)
+        meta['task_id'] = task_id
+        entry = (task_id, state, backend.encode(meta))
+        self._use_process()
+        with self._condition:
+            self._entries.append(entry)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            full = len(self._entries) >= self.size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='excewo-result-buffer',
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        if full:
+            self.flush()
+        return result
+
+    def _run(self):
+        """Write buffered results once the oldest one is old enough."""
+        condition = self._condition
+        while True:
+            with condition:
+                if self._condition is not condition:  # Reset in a forked process
+                    return
+                if self._first_at is None:
+                    condition.wait()
+                    continue
+                wait = self._first_at + self.delay - time.monotonic()
+                if wait > 0:
+                    condition.wait(wait)
+                    continue
+            self.flush()
+
+    def flush(self):
+        """Write buffered results."""
+        self._use_process()
+        with self._write_lock:
+            with self._condition:
+                entries, self._entries = self._entries, []
+                self._first_at = None
+            if not entries:
+                return
+            if self.coalesce:
+                latest = {}
+                for entry in entries:
+                    latest.pop(entry[0], None)
+                    latest[entry[0]] = entry
+                entries = list(latest.values())
+            try:
+                self._write(entries)
+            except Exception as exc:
+                logging.error('Could not store {} buffered task results: {}'.format(
+                    len(entries), exc
+                ))
+
+    def _write(self, entries):
+        backend = self.backend
+        keys = [backend.get_key_for_task(task_id) for task_id, _, _ in entries]
+        # Successful results are never overwritten, as when results are not buffered
+        done = self._successful(keys)
+        writes = [(key, state, value) for key, (_, state, value) in zip(keys, entries)
+                  if key not in done]
+        if isinstance(backend, RedisBackend):
+            backend.ensure(self._write_pipeline, (writes,))
+        else:
+            for key, state, value in writes:
+                backend._set_with_state(key, value, state)
+
+    def _successful(self, keys):
+        """Return the given keys holding successful results in the backend."""
+        backend = self.backend
+        try:
+            values = backend.mget(keys)
+        except NotImplementedError:
+            values = [backend.get(key) for key in keys]
+        if isinstance(values, dict):
+            values = [values.get(key) for key in keys]
+        return {key for key, value in zip(keys, values)
+                if value and backend.decode_result(value)['status'] == SUCCESS}
+
+    def _write_pipeline(self, writes):
+        backend = self.backend
+        with backend.client.pipeline() as pipe:
+            for key, _, value in writes:
+                if backend.expires:
+                    pipe.setex(key, backend.expires, value)
+                else:
+                    pipe.set(key, value)
+                pipe.publish(key, value)
+            pipe.execute()
+
+
+def _install(backend):
+    """Buffer results of the given backend, unless they already are or cannot be."""
+    if isinstance(getattr(backend.store_result, '__self__', None), ResultBuffer) or \
+            isinstance(backend, DisabledBackend):
+        return
+    if not isinstance(backend, KeyValueStoreBackend):
+        logging.warning('Results are not buffered with result backend {}, which is not a '
+                        'key-value store'.format(type(backend).__name__))
+        return
+    result_buffer = ResultBuffer(backend, **_settings)
+    result_buffer.install()
+    _buffers.append(result_buffer)
+
+
+def _on_worker_init(sender=None, **kwargs):
+    # Threads and solo pools run tasks with the backend of the main process
+    if _settings is not None:
+        _install(sender.app.backend)
+
+
+def _on_worker_process_init(**kwargs):
+    if _settings is not None:
+        _install(_app.backend)
+
+
+def _flush(**kwargs):
+    for result_buffer in _buffers:
+        result_buffer.flush()
+
+
+def configure_result_buffering(app, size=100, delay=0.1, coalesce=True, buffer_acks_late=False):
+    """Make workers of the given application buffer task results (see `ResultBuffer`), or store
+    them immediately if ``size`` is ``None``."""
+    global _app, _settings
+    _app = app
+    if size is None:
+        _settings = None
+        return
+    _settings = {'size': size, 'delay': delay, 'coalesce': coalesce,
+                 'buffer_acks_late': buffer_acks_late}
+    signals.worker_init.connect(_on_worker_init, dispatch_uid='excewo_result_buffer_init')
+    signals.worker_process_init.connect(_on_worker_process_init,
+                                        dispatch_uid='excewo_result_buffer_process_init')
+    signals.worker_process_shutdown.connect(_flush,
+                                            dispatch_uid='excewo_result_buffer_process_shutdown')
+    signals.worker_shutdown.connect(_flush, dispatch_uid='excewo_result_buffer_worker_shutdown')
+
+
+atexit.register(_flush)
@@ -0,0 +1,109 @@
+"""Automatic per-plugin queues and task routes.
+
+Task names are ``<application name>.<plugin>.<task>`` (see ``gen_task_name()``), so tasks of each
+plugin can be routed to a queue of their own, and a slow plugin does not block the others. Several
+plugins may share a queue.
+
+The worker reserves at most a given number of messages from a queue with a limited capacity: such
+a queue is consumed on a channel of its own, with its own prefetch count, instead of with the other
+queues.
+"""
+
+
+__all__ = ('configure_plugin_queues', 'plugin_name', 'plugin_queue_name')
+
+
+import logging
+
+from celery import bootsteps
+from kombu import Exchange, Queue
+
+
+def plugin_name(app, task_name):
+    """Return the name of the plugin providing the given task, or ``None`` if the task name is
+    not prefixed with the application name."""
+    prefix = app.main + '.'
+    if not task_name.startswith(prefix):
+        return None
+    plugin, sep, _ = task_name[len(prefix):].partition('.')
+    return plugin if sep else None
+
+
+def plugin_queue_name(app, queue):
+    """Return the actual name of the given plugin queue, prefixed with the application name."""
+    return '{}.{}'.format(app.main, queue)
+
+
+class _CapacityConsumerStep(bootsteps.ConsumerStep):
+    """Consumer bootstep consuming each queue with a limited capacity on its own channel."""
+
+    #: Mapping of queue names to the maximum number of messages reserved by the worker
+    capacities = {}
+
+    def __init__(self, c, **kwargs):
+        super().__init__(c, **kwargs)
+        consume_from = c.app.amqp.queues.consume_from
+        self.queues = [consume_from[name] for name in self.capacities if name in consume_from]
+        # Not consumed by the default task consumer any longer
+        c.app.amqp.queues.deselect([queue.name for queue in self.queues])
+
+    def start(self, c):
+        on_task_received = c.create_task_handler()
+        self.consumers = []
+        for queue in self.queues:
+            consumer = c.app.amqp.TaskConsumer(c.connection.channel(), queues=[queue],
+                                               on_decode_error=c.on_decode_error)
+            consumer.on_message = on_task_received
+            consumer.qos(prefetch_count=self.capacities[queue.name])
+            consumer.consume()
+            self.consumers.append(consumer)
+            logging.info('Consuming queue {} with a capacity of {} messages'.format(
+                queue.name, self.capacities[queue.name]
+            ))
+
+
+def configure_plugin_queues(app, shared_queues=None, capacities=None):
+    """Route tasks of each plugin to a queue of its own, and make the worker consume these queues.
+
+    ``shared_queues`` maps queue names to lists of plugins sharing the queue (other plugins get a
+    queue named after them). ``capacities`` maps queue names to the maximum number of messages the
+    worker reserves from the queue. Queue names are prefixed with the application name. Queues and
+    routes already configured for the application take precedence.
+
+    Return the mapping of plugin names to queue names.
+    """
+    queue_of_plugin = {plugin: queue for queue, plugins in (shared_queues or {}).items()
+                       for plugin in plugins}
+    plugin_queues = {}
+    for task_name in app.tasks:
+        plugin = plugin_name(app, task_name)
+        if plugin is not None and plugin not in plugin_queues:
+            plugin_queues[plugin] = plugin_queue_name(app, queue_of_plugin.get(plugin, plugin))
+    routes = {'{}.{}.*'.format(app.main, plugin): {'queue': queue}
+              for plugin, queue in sorted(plugin_queues.items())}
+    # Includes the default queue if no queue is configured
+    queues = list(app.amqp.Queues(app.conf.task_queues).values())
+    known_queue_names = {queue.name for queue in queues}
+    for queue_name in sorted(set(plugin_queues.values()) - known_queue_names):
+        queues.append(Queue(queue_name, Exchange(queue_name), routing_key=queue_name))
+    app.conf.task_queues = queues
+    configured_routes = app.conf.task_routes
+    if not configured_routes:
+        app.conf.task_routes = (routes,)
+    elif isinstance(configured_routes, (list, tuple)):
+        app.conf.task_routes = tuple(configured_routes) + (routes,)
+    else:
+        app.conf.task_routes = (configured_routes, routes)
+    # Queues and routes may already have been computed from the previous configuration
+    del app.amqp.queues
+    del app.amqp.router
+    app.amqp.flush_routes()
+    capacities = {plugin_queue_name(app, queue): capacity
+                  for queue, capacity in (capacities or {}).items() if capacity}
+    if capacities:
+        app.steps['consumer'].add(type('PluginQueueCapacityConsumer', (_CapacityConsumerStep,),
+                                       {'capacities': capacities}))
+    logging.info('Routing plugin tasks to queues: {}'.format(', '.join(
+        '{} -> {}'.format(plugin, queue) for plugin, queue in sorted(plugin_queues.items())
+    )))
+    return plugin_queues
@@ -0,0 +1,217 @@
+"""Profiling of worker startup, by phase and by task plugin.
+
+Startup code marks its phases with ``phase()`` and plugin imports with ``plugin_import()``. These
+are no-ops unless a profile is active (see ``profiling()``). While a profile is active, each module
+import is timed, as ``python -X importtime`` would, and recorded in the phase or plugin import that
+triggered it.
+"""
+
+
+__all__ = ('StartupProfile', 'phase', 'plugin_import', 'profiling', 'record_plugin')
+
+
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+from extensible_celery_worker.memory import current_rss
+
+
+_current_profile = None
+
+
+class _TimedLoader:
+    """Loader wrapper timing module execution for a startup profile."""
+
+    def __init__(self, loader, profile):
+        self._loader = loader
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        try:
+            with self._profile._import(module.__name__):
+                self._loader.exec_module(module)
+        finally:
+            # Do not leave this wrapper behind, some code expects actual loader classes
+            module.__loader__ = self._loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self._loader
+
+
+class _ImportFinder:
+    """Meta path finder wrapping loaders found by other finders with ``_TimedLoader``."""
+
+    def __init__(self, profile):
+        self._profile = profile
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self._profile)
+                return spec
+        return None
+
+
+class StartupProfile:
+    """Wall time and resident memory spent in each startup phase and plugin import.
+
+    Each phase and plugin import also holds the tree of modules it imported, with the time spent
+    executing each module alone (``self_us``) and with the modules it imported (``cumulative_us``),
+    in microseconds.
+    """
+
+    def __init__(self, app_name=None):
+        self.app_name = app_name
+        self.phases = []
+        self.plugins = []
+        self.total_seconds = None
+        self.rss_bytes = None
+        self._import_stack = []
+
+    @contextmanager
+    def _measure(self, entry):
+        """Context manager measuring the code it wraps into the given entry."""
+        entry['imports'] = []
+        self._import_stack.append(entry['imports'])
+        rss_before = current_rss()
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            entry['rss_bytes'] = current_rss() - rss_before
+            self._import_stack.pop()
+
+    @contextmanager
+    def _import(self, module_name):
+        """Context manager timing the import of the given module, if within a measured entry."""
+        if not self._import_stack:
+            yield
+            return
+        node = {'module': module_name, 'imports': []}
+        self._import_stack[-1].append(node)
+        self._import_stack.append(node['imports'])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._import_stack.pop()
+            node['cumulative_us'] = int((time.perf_counter() - start) * 1e6)
+            node['self_us'] = node['cumulative_us'] - sum(child['cumulative_us']
+                                                          for child in node['imports'])
+
+    def as_dict(self):
+        """Return the profile as a JSON serializable dictionary."""
+        return {
+            'app_name': self.app_name,
+            'total_seconds': self.total_seconds,
+            'rss_bytes': self.rss_bytes,
+            'phases': self.phases,
+            'plugins': self.plugins,
+        }
+
+    def as_json(self):
+        """Return the profile as a JSON string."""
+        return json.dumps(self.as_dict(), indent=2)
+
+    def as_text(self):
+        """Return the profile as human-readable text."""
+        lines = [
+            'Startup profile of {} (total {:.3f}s, RSS {:+.1f} MiB)'.format(
+                self.app_name, self.total_seconds or 0, (self.rss_bytes or 0) / 2 ** 20
+            ),
+            '',
+            '{:<40} {:>10} {:>10}'.format('Phase', 'Time (s)', 'RSS (MiB)'),
+        ]
+        for entry in self.phases:
+            lines.append('{:<40} {:>10.3f} {:>+10.1f}'.format(
+                entry['name'], entry['seconds'], entry['rss_bytes'] / 2 ** 20
+            ))
+        lines.extend(['', '{:<40} {:>10} {:>10}'.format('Plugin', 'Time (s)', 'RSS (MiB)')])
+        for entry in self.plugins:
+            lines.append('{:<40} {:>10.3f} {:>+10.1f}{}'.format(
+                entry['name'], entry['seconds'], entry['rss_bytes'] / 2 ** 20,
+                '' if entry['in_process'] else '  (imported in a separate process)'
+            ))
+        for entry in self.plugins:
+            if not entry['imports']:
+                continue
+            lines.extend(['', 'Imports of plugin {} ({}):'.format(entry['name'], entry['module']),
+                          'import time: self [us] | cumulative | imported package'])
+            lines.extend(_import_tree_lines(entry['imports']))
+        return '\n'.join(lines)
+
+
+def _import_tree_lines(nodes, depth=0):
+    """Yield each line of an import tree, formatted as ``python -X importtime`` does."""
+    for node in nodes:
+        # Like -X importtime, children come first
+        yield from _import_tree_lines(node['imports'], depth + 1)
+        yield 'import time: {:>9} | {:>10} | {}{}'.format(node['self_us'], node['cumulative_us'],
+                                                          '  ' * depth, node['module'])
+
+
+@contextmanager
+def profiling(app_name=None):
+    """Context manager activating a new startup profile, which it returns."""
+    global _current_profile
+    profile = StartupProfile(app_name)
+    finder = _ImportFinder(profile)
+    sys.meta_path.insert(0, finder)
+    _current_profile = profile
+    rss_before = current_rss()
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.total_seconds = time.perf_counter() - start
+        profile.rss_bytes = current_rss() - rss_before
+        _current_profile = None
+        sys.meta_path.remove(finder)
+
+
+@contextmanager
+def phase(name):
+    """Context manager measuring a startup phase, if a profile is active."""
+    if _current_profile is None:
+        yield
+        return
+    with _current_profile._measure({'name': name}) as entry:
+        yield
+    _current_profile.phases.append(entry)
+
+
+@contextmanager
+def plugin_import(name, module):
+    """Context manager measuring the import of a task plugin, if a profile is active."""
+    if _current_profile is None:
+        yield
+        return
+    with _current_profile._measure({'name': name, 'module': module, 'in_process': True}) as entry:
+        yield
+    _current_profile.plugins.append(entry)
+
+
+def record_plugin(record):
+    """Add a task plugin imported in a separate process to the active profile, if any."""
+    if _current_profile is None:
+        return
+    _current_profile.plugins.append({
+        'name': record['name'],
+        'module': record['module'],
+        'in_process': False,
+        'seconds': record['import_seconds'],
+        'rss_bytes': record['rss_bytes'],
+        'imports': [],
+    })
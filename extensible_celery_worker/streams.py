@@ -0,0 +1,206 @@
+"""Tasks streaming their results, defined as generator functions.
+
+The items a streaming task yields are grouped in chunks of up to ``stream_chunk_size`` items, and
+each chunk is written to the result backend under a key of its own as soon as it is full, or
+``stream_flush_interval`` seconds after its first item was yielded (by a thread of its own, so
+that a slow producer does not hold items back). Large string and bytes-like items
+are offloaded to the blob store, when it is configured (see ``blobs``). The result of the task is
+a stream descriptor, once all chunks are written.
+
+Clients iterate over items with ``StreamResult.stream()``, which reads and removes chunks as the
+task writes them, so that neither the worker nor the client holds all items in memory, and the
+first items are available before the task ends. A stream can be read once.
+
+Streaming requires a key-value result backend (Redis, Memcached, file system...): with other
+backends, the task result is the list of all items.
+"""
+
+
+__all__ = ('STREAM_KEY', 'StreamChunkNotFound', 'StreamResult', 'StreamTask')
+
+
+import logging
+import threading
+import time
+
+from celery import Task
+from celery.backends.base import KeyValueStoreBackend
+from celery.exceptions import TimeoutError
+
+from extensible_celery_worker.blobs import ClaimCheckResult, _offload_item, resolve
+
+
+STREAM_KEY = '__excewo_stream__'
+
+
+class StreamChunkNotFound(LookupError):
+    """A chunk of a stream is missing from the result backend: it expired, or the stream was
+    already read."""
+
+
+def _chunk_key(backend, task_id, index):
+    return backend.get_key_for_task(task_id, ':stream:{}'.format(index))
+
+
+def _is_stream(value):
+    return type(value) is dict and STREAM_KEY in value
+
+
+class StreamTask(Task):
+    """Base class of tasks whose ``run()`` method is a generator function, streaming the items it
+    yields to clients."""
+
+    #: Maximum number of items of a chunk
+    stream_chunk_size = 100
+
+    #: Maximum number of seconds between the first item of a chunk and the chunk being written
+    #: (``0`` to write each item as soon as it is yielded)
+    stream_flush_interval = 1.0
+
+    def __call__(self, *args, **kwargs):
+        request = self.request_stack.top
+        call = super().__call__
+        # As the worker does for tasks without a custom ``__call__()`` (see ``PureTask``)
+        if getattr(call, '__func__', None) is Task.__call__ and request is not None:
+            items = self.run(*args, **kwargs)
+        else:
+            items = call(*args, **kwargs)
+        # Called as a function: the caller iterates over the generator
+        if request is None or not request.id:
+            return items
+        if not isinstance(self.backend, KeyValueStoreBackend):
+            logging.warning('Results of task {} are not streamed with result backend {}, which is '
+                            'not a key-value store'.format(self.name, type(self.backend).__name__))
+            return list(items)
+        return self._stream(request.id, items)
+
+    def _stream(self, task_id, items):
+        """Write the given items as chunks of a stream, and return the stream descriptor."""
+        writer = _ChunkWriter(self, task_id)
+        count = 0
+        try:
+            for item in items:
+                writer.add(item)
+                count += 1
+        except BaseException:
+            # Items yielded before the task failed are streamed, followed by its exception
+            try:
+                writer.close(last=False)
+            except Exception:
+                logging.exception('Could not write the last items of the stream of task '
+                                  '{}'.format(task_id))
+            raise
+        return {STREAM_KEY: task_id, 'chunks': writer.close(), 'items': count}
+
+
+class _ChunkWriter:
+    """Writer of chunks of the stream of the given task execution, writing a chunk once it is
+    full, or from a thread of its own once its first item is old enough."""
+
+    def __init__(self, task, task_id):
+        self.task = task
+        self.task_id = task_id
+        self._chunk = []
+        self._chunk_started = None
+        self._index = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, item):
+        """Add an item to the current chunk, and write it if it is full."""
+        task = self.task
+        with self._condition:
+            self._chunk.append(item)
+            if len(self._chunk) == 1:
+                self._chunk_started = time.monotonic()
+                if task.stream_flush_interval > 0:
+                    if self._thread is None:
+                        self._thread = threading.Thread(target=self._run, daemon=True,
+                                                        name='excewo-stream-flush')
+                        self._thread.start()
+                    self._condition.notify()
+            if len(self._chunk) >= task.stream_chunk_size or task.stream_flush_interval <= 0:
+                self._write(last=False)
+
+    def _run(self):
+        """Write the current chunk once its first item is old enough."""
+        with self._condition:
+            while not self._closed:
+                if not self._chunk:
+                    self._condition.wait()
+                    continue
+                wait = self._chunk_started + self.task.stream_flush_interval - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                try:
+                    self._write(last=False)
+                except Exception:
+                    # Written again with the next items, or when the writer is closed
+                    logging.exception('Could not write chunk {} of the stream of task {}'.format(
+                        self._index, self.task_id
+                    ))
+                    self._chunk_started = time.monotonic()
+
+    def _write(self, last):
+        backend = self.task.backend
+        backend.set(_chunk_key(backend, self.task_id, self._index),
+                    backend.encode({'items': _offload_item(self._chunk), 'last': last}))
+        self._chunk = []
+        self._index += 1
+
+    def close(self, last=True):
+        """Write the last chunk (or the pending items, if not ``last``), stop the thread, and
+        return the number of chunks written."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            if last or self._chunk:
+                self._write(last)
+        if self._thread is not None:
+            self._thread.join()
+        return self._index
+
+
+class StreamResult(ClaimCheckResult):
+    """Task result whose items can be read while the task still runs, if it streams them."""
+
+    def stream(self, timeout=None, interval=0.05):
+        """Return an iterator over items of the stream of the task, waiting for each chunk at
+        most ``timeout`` seconds, and polling the result backend every ``interval`` seconds.
+
+        The exception of the task is raised after the items it yielded, if it failed. Items of
+        tasks which do not stream their result are those of the list it returned.
+        """
+        backend = self.backend
+        index = 0
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            key = _chunk_key(backend, self.id, index)
+            value = backend.get(key)
+            if value is None and self.ready():
+                # Chunks are written before the task returns, but the chunk may have been written
+                # between the read and the end of the task
+                value = backend.get(key)
+                if value is None:
+                    # The exception of the task is raised, if it failed
+                    result = self.get(timeout=timeout)
+                    if not _is_stream(result):
+                        yield from result
+                        return
+                    raise StreamChunkNotFound('Chunk {} of the stream of task {} does not '
+                                              'exist'.format(index, self.id))
+            if value is None:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError('The operation timed out.')
+                time.sleep(interval)
+                continue
+            backend.delete(key)
+            chunk = backend.decode(value)
+            index += 1
+            if deadline is not None:
+                deadline = time.monotonic() + timeout
+            yield from resolve(chunk['items'], remove=True)
+            if chunk['last']:
+                return
@@ -0,0 +1,254 @@
+"""Sampling profiler of allocations and CPU time of selected tasks.
+
+A fraction of executions of the selected tasks run with ``tracemalloc`` tracing allocations and
+``cProfile`` profiling calls. After such an execution, memory blocks allocated by the task and
+still alive (what makes worker memory grow) are aggregated by allocation site (traceback), and call
+statistics are added to those of previous executions of the task. Other executions, and tasks which
+are not selected, are not profiled. Nothing is installed unless profiling is configured.
+
+Each pool process writes its aggregates of each task to the ``raw`` subdirectory of the profile
+directory after each profiled execution. ``dump_task_profiles()`` (also run by the
+``dump_task_profiles`` remote control command and ``excewo dump-task-profiles``) merges aggregates
+of all processes into text files, meant to be compared between releases, and ``pstats`` files.
+
+Only one execution is profiled at a time in each process: with the threads pool, allocations of
+other threads running at the same time are also traced.
+"""
+
+
+__all__ = ('TaskProfiler', 'configure_task_profiling', 'dump_task_profiles')
+
+
+from pathlib import Path
+import cProfile
+import io
+import json
+import linecache
+import logging
+import os
+import pstats
+import random
+import shutil
+import threading
+import time
+import tracemalloc
+
+from celery import signals
+from celery.worker.control import control_command
+
+
+#: Number of frames stored in the traceback of each allocation site
+TRACEBACK_FRAMES = 10
+
+# Number of allocation sites and functions in text dumps
+_TOP = 50
+
+_profiler = None
+
+
+class TaskProfiler:
+    """Profiler of a ``sample_rate`` fraction of executions of the given tasks, writing its
+    aggregates to ``directory``."""
+
+    def __init__(self, task_names, sample_rate, directory):
+        self.task_names = frozenset(task_names)
+        self.sample_rate = sample_rate
+        self.directory = Path(directory).expanduser()
+        self._reset()
+
+    def _reset(self):
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._running = None
+        # Aggregates by task name: number of profiled executions, allocation sites mapping
+        # tracebacks to sizes and block counts, and call statistics
+        self._executions = {}
+        self._allocations = {}
+        self._stats = {}
+
+    @property
+    def raw_directory(self):
+        return self.directory / 'raw'
+
+    def use_process(self):
+        """Forget aggregates inherited from the parent process (from a pool process)."""
+        self._reset()
+
+    def on_task_prerun(self, task_id=None, task=None, **kwargs):
+        if task.name not in self.task_names or self._random.random() >= self.sample_rate:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        # Allocations cannot be told apart if something else is already tracing them
+        trace_allocations = not tracemalloc.is_tracing()
+        if trace_allocations:
+            tracemalloc.start(TRACEBACK_FRAMES)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active
+            profile = None
+        self._running = (task_id, trace_allocations, profile)
+
+    def on_task_postrun(self, task_id=None, task=None, **kwargs):
+        running = self._running
+        if running is None or running[0] != task_id:
+            return
+        _, trace_allocations, profile = running
+        self._running = None
+        try:
+            if profile is not None:
+                profile.disable()
+            snapshot = None
+            if trace_allocations:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            self._add(task.name, snapshot, profile)
+        finally:
+            self._lock.release()
+
+    def _add(self, task_name, snapshot, profile):
+        """Add allocations and call statistics of an execution of the task and write aggregates
+        of the task."""
+        self._executions[task_name] = self._executions.get(task_name, 0) + 1
+        if snapshot is not None:
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ))
+            sites = self._allocations.setdefault(task_name, {})
+            for statistic in snapshot.statistics('traceback'):
+                site = tuple((frame.filename, frame.lineno) for frame in statistic.traceback)
+                size, count = sites.get(site, (0, 0))
+                sites[site] = (size + statistic.size, count + statistic.count)
+        if profile is not None:
+            if task_name in self._stats:
+                self._stats[task_name].add(profile)
+            else:
+                self._stats[task_name] = pstats.Stats(profile)
+        try:
+            self._write(task_name)
+        except OSError:
+            logging.exception('Could not write profile of task {}'.format(task_name))
+
+    def _write(self, task_name):
+        self.raw_directory.mkdir(parents=True, exist_ok=True)
+        prefix = self.raw_directory / '{}.{}'.format(os.getpid(), task_name)
+        allocations = {
+            'executions': self._executions[task_name],
+            'sites': [[[list(frame) for frame in site], size, count]
+                      for site, (size, count) in self._allocations.get(task_name, {}).items()],
+        }
+        with open('{}.alloc.json'.format(prefix), 'w') as f:
+            json.dump(allocations, f)
+        if task_name in self._stats:
+            self._stats[task_name].dump_stats('{}.pstats'.format(prefix))
+
+
+def _merged_allocations(paths):
+    """Return the number of executions and allocation sites merged from the given files."""
+    executions = 0
+    sites = {}
+    for path in paths:
+        with open(path) as f:
+            allocations = json.load(f)
+        executions += allocations['executions']
+        for frames, size, count in allocations['sites']:
+            site = tuple(tuple(frame) for frame in frames)
+            site_size, site_count = sites.get(site, (0, 0))
+            sites[site] = (site_size + size, site_count + count)
+    return executions, sites
+
+
+def _format_allocations(task_name, executions, sites):
+    lines = ['Task {}: {} profiled executions'.format(task_name, executions), '']
+    top = sorted(sites.items(), key=lambda site: site[1][0], reverse=True)[:_TOP]
+    for frames, (size, count) in top:
+        lines.append('{:.1f} KiB in {:.1f} blocks per execution'.format(
+            size / executions / 2 ** 10, count / executions
+        ))
+        # Most recent call last, as in Python tracebacks
+        for filename, lineno in frames:
+            lines.append('  File "{}", line {}'.format(filename, lineno))
+            line = linecache.getline(filename, lineno).strip()
+            if line:
+                lines.append('    ' + line)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def dump_task_profiles(directory, output_directory=None):
+    """Merge aggregates written by all processes to the given profile directory, write dumps of
+    each task to ``output_directory`` (by default, a new timestamped subdirectory) and return its
+    path.
+
+    For each task, ``<task>.allocations.txt`` lists the allocation sites of blocks still alive
+    after executions, by decreasing size, ``<task>.cpu.txt`` the functions taking most time, and
+    ``<task>.pstats`` holds all call statistics (see ``pstats``).
+    """
+    directory = Path(directory).expanduser()
+    output_directory = Path(output_directory or directory / time.strftime('%Y%m%d-%H%M%S'))
+    output_directory.mkdir(parents=True, exist_ok=True)
+    allocation_paths = {}
+    stats_paths = {}
+    for path in sorted((directory / 'raw').glob('*')):
+        # Raw files are named <pid>.<task>.alloc.json or <pid>.<task>.pstats
+        name = path.name.partition('.')[2]
+        if name.endswith('.alloc.json'):
+            allocation_paths.setdefault(name[:-len('.alloc.json')], []).append(path)
+        elif name.endswith('.pstats'):
+            stats_paths.setdefault(name[:-len('.pstats')], []).append(path)
+    for task_name, paths in allocation_paths.items():
+        executions, sites = _merged_allocations(paths)
+        (output_directory / '{}.allocations.txt'.format(task_name)).write_text(
+            _format_allocations(task_name, executions, sites)
+        )
+    for task_name, paths in stats_paths.items():
+        stream = io.StringIO()
+        stats = pstats.Stats(*(path.as_posix() for path in paths), stream=stream)
+        stats.dump_stats((output_directory / '{}.pstats'.format(task_name)).as_posix())
+        # Without raw file names and directories, dumps of different runs can be compared
+        stats.files = []
+        stats.strip_dirs().sort_stats('cumulative').print_stats(_TOP)
+        (output_directory / '{}.cpu.txt'.format(task_name)).write_text(stream.getvalue())
+    logging.info('Dumped task profiles to {}'.format(output_directory))
+    return output_directory
+
+
+class _ProfilerInstaller:
+    """Signal handlers profiling tasks in worker processes."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def on_worker_init(self, **kwargs):
+        # Aggregates of a previous worker must not be merged with the new ones
+        shutil.rmtree(self.profiler.raw_directory.as_posix(), ignore_errors=True)
+
+    def on_worker_process_init(self, **kwargs):
+        self.profiler.use_process()
+
+
+def configure_task_profiling(task_names, sample_rate, directory):
+    """Profile a ``sample_rate`` fraction of executions of the given tasks in workers, writing
+    aggregates to ``directory``, and return the profiler."""
+    global _profiler
+    _profiler = TaskProfiler(task_names, sample_rate, directory)
+    installer = _ProfilerInstaller(_profiler)
+    signals.worker_init.connect(installer.on_worker_init, weak=False,
+                                dispatch_uid='excewo_task_profile_worker_init')
+    signals.worker_process_init.connect(installer.on_worker_process_init, weak=False,
+                                        dispatch_uid='excewo_task_profile_worker_process_init')
+    signals.task_prerun.connect(_profiler.on_task_prerun, weak=False,
+                                dispatch_uid='excewo_task_profile_prerun')
+    signals.task_postrun.connect(_profiler.on_task_postrun, weak=False,
+                                 dispatch_uid='excewo_task_profile_postrun')
+    return _profiler
+
+
+@control_command(name='dump_task_profiles')
+def _dump_task_profiles_command(state, **kwargs):
+    """Dump profiles of tasks profiled by the worker."""
+    if _profiler is None:
+        return {'error': 'task profiling is disabled'}
+    return {'ok': dump_task_profiles(_profiler.directory).as_posix()}
@@ -0,0 +1,324 @@
+"""Tracing of the phases of task executions, exported as OpenTelemetry (OTLP) spans.
+
+For a sampled fraction of traces (a trace being a task and all tasks it sent, such as next steps of
+a chain), the worker records a span for each task execution, from the moment the worker received
+its message (or the task started, for tasks applied in process) until it is done, with a child span
+for each phase:
+
+* ``queue``: waiting in the broker, from publishing to reception by the worker (for tasks
+  published with `extensible_celery_worker`);
+* ``wait``: waiting in the worker until a pool process starts it, which includes message decoding
+  and argument deserialization;
+* ``arguments``: resolution of blob references in arguments (see ``blobs``);
+* ``body``: the task function;
+* ``result``: offloading the result, sending next steps and storing the result in the result
+  backend.
+
+Spans of a task are children of the span of the task which sent it (``parent_id``), in the trace
+of the first task (``root_id``): span and trace ids are derived from task ids, so that no tracing
+context goes through messages. Traces are sampled on their id, so that all tasks of a sampled trace
+are traced.
+
+Each process buffers its spans and writes them in batches, as lines of the OTLP JSON encoding of
+``ExportTraceServiceRequest`` messages, to a file (as read by the ``otlpjsonfile`` receiver of the
+OpenTelemetry collector) or a TCP socket (``tcp://host:port``). Phases of ``async def`` tasks are
+not traced.
+"""
+
+
+__all__ = ('SpanExporter', 'configure_task_tracing', 'task_phase')
+
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+try:
+    from time import time_ns as _time_ns
+except ImportError:  # Python < 3.7
+    def _time_ns():
+        return int(time.time() * 1e9)
+
+from celery import signals
+from celery.states import SUCCESS
+
+from extensible_celery_worker.metrics import PUBLISHED_AT_HEADER
+
+
+#: Request field holding the time the worker received the message
+RECEIVED_AT_FIELD = 'excewo_received_at'
+
+# OTLP span kinds and status codes
+_KIND_INTERNAL = 1
+_KIND_CONSUMER = 5
+_STATUS_OK = 1
+_STATUS_ERROR = 2
+
+_exporter = None
+_sample_rate = 0.0
+
+# Traced executions running in the current thread, innermost last
+_local = threading.local()
+
+
+class SpanExporter:
+    """Exporter writing spans in batches of up to ``batch_size`` spans, at least every
+    ``flush_interval`` seconds while tasks run, to the file at ``output`` or the TCP socket at
+    ``tcp://host:port``."""
+
+    def __init__(self, output, service_name='excewo', batch_size=512, flush_interval=1.0):
+        self.output = output
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._spans = []
+        self._last_flush = time.monotonic()
+        self._pid = os.getpid()
+        self._socket = None
+
+    def export(self, spans):
+        """Add spans to the current batch, which is written if it is full or old enough."""
+        with self._lock:
+            # Spans of the parent process are its own to write
+            if self._pid != os.getpid():
+                self._reset()
+            self._spans.extend(spans)
+            if len(self._spans) < self.batch_size and \
+                    time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            spans, self._spans = self._spans, []
+            self._last_flush = time.monotonic()
+            self._write(spans)
+
+    def flush(self):
+        """Write spans of the current batch."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            spans, self._spans = self._spans, []
+            self._last_flush = time.monotonic()
+            if spans:
+                self._write(spans)
+
+    def _write(self, spans):
+        line = json.dumps(self._request(spans), separators=(',', ':')) + '\n'
+        try:
+            if self.output.startswith('tcp://'):
+                self._send(line.encode('utf-8'))
+            else:
+                path = pathlib.Path(self.output).expanduser()
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # A single write per batch, so that processes do not mix their lines
+                fd = os.open(path.as_posix(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try:
+                    os.write(fd, line.encode('utf-8'))
+                finally:
+                    os.close(fd)
+        except OSError as exc:
+            logging.warning('Could not export {} spans to {}: {}'.format(
+                len(spans), self.output, exc
+            ))
+
+    def _send(self, data):
+        if self._socket is None:
+            address = urlsplit(self.output)
+            self._socket = socket.create_connection((address.hostname, address.port), timeout=5)
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+
+    def _request(self, spans):
+        """Return the OTLP ``ExportTraceServiceRequest`` of the given spans."""
+        resource = [_attribute('service.name', self.service_name),
+                    _attribute('host.name', socket.gethostname()),
+                    _attribute('process.pid', os.getpid())]
+        return {'resourceSpans': [{
+            'resource': {'attributes': resource},
+            'scopeSpans': [{'scope': {'name': 'extensible_celery_worker'}, 'spans': spans}],
+        }]}
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def _id(task_id, size):
+    """Return a span (8 bytes) or trace (16 bytes) id derived from a task id, in hexadecimal."""
+    return hashlib.blake2b(task_id.encode('utf-8'), digest_size=size).hexdigest()
+
+
+def _span(trace_id, span_id, parent_span_id, name, start, end, kind=_KIND_INTERNAL,
+          attributes=(), error=False):
+    """Return a span in the OTLP JSON encoding, given times in nanoseconds."""
+    span = {
+        'traceId': trace_id,
+        'spanId': span_id,
+        'name': name,
+        'kind': kind,
+        'startTimeUnixNano': str(start),
+        'endTimeUnixNano': str(max(start, end)),
+        'attributes': [_attribute(key, value) for key, value in attributes],
+        'status': {'code': _STATUS_ERROR if error else _STATUS_OK},
+    }
+    if parent_span_id:
+        span['parentSpanId'] = parent_span_id
+    return span
+
+
+class _Execution:
+    """Phases of a traced task execution."""
+
+    def __init__(self, task_id, trace_id, started_at):
+        self.task_id = task_id
+        self.trace_id = trace_id
+        self.started_at = started_at
+        #: List of (name, start, end) tuples, in nanoseconds
+        self.phases = []
+
+
+def _sampled(trace_id):
+    return int(trace_id[:8], 16) < _sample_rate * 2 ** 32
+
+
+def _executions():
+    executions = getattr(_local, 'executions', None)
+    if executions is None:
+        executions = _local.executions = []
+    return executions
+
+
+class _Phase:
+    """Context manager recording a phase of a traced task execution."""
+
+    def __init__(self, execution, name):
+        self.execution = execution
+        self.name = name
+
+    def __enter__(self):
+        self.start = _time_ns()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.execution.phases.append((self.name, self.start, _time_ns()))
+
+
+class _NoPhase:
+    """Context manager recording nothing, for threads which run no traced task execution."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def task_phase(name):
+    """Return a context manager recording a phase of the traced task execution of the current
+    thread, if any."""
+    executions = getattr(_local, 'executions', None)
+    if not executions:
+        return _NO_PHASE
+    return _Phase(executions[-1], name)
+
+
+def _on_task_received(request=None, **kwargs):
+    if _exporter is not None:
+        # Sent with the request to the pool process running the task
+        request.request_dict[RECEIVED_AT_FIELD] = time.time()
+
+
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    if _exporter is None:
+        return
+    trace_id = _id(task.request.root_id or task_id, 16)
+    if _sampled(trace_id):
+        _executions().append(_Execution(task_id, trace_id, _time_ns()))
+
+
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    executions = getattr(_local, 'executions', None)
+    if not executions or executions[-1].task_id != task_id:
+        return
+    execution = executions.pop()
+    exporter = _exporter
+    if exporter is not None:
+        exporter.export(_execution_spans(task, execution, state, _time_ns()))
+
+
+def _execution_spans(task, execution, state, end):
+    """Return the spans of a traced task execution which ended at the given time."""
+    request = task.request
+    trace_id = execution.trace_id
+    span_id = _id(execution.task_id, 8)
+    received_at = getattr(request, RECEIVED_AT_FIELD, None)
+    published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+    phases = []
+    if received_at is not None:
+        received_at = int(received_at * 1e9)
+        # Tasks with an ETA waited on purpose
+        if published_at is not None and not request.eta:
+            phases.append(('queue', int(published_at * 1e9), received_at))
+        phases.append(('wait', received_at, execution.started_at))
+    phases.extend(execution.phases)
+    body_ends = [phase_end for name, _, phase_end in execution.phases if name == 'body']
+    if body_ends:
+        phases.append(('result', body_ends[-1], end))
+    attributes = [('celery.task_name', task.name), ('celery.task_id', execution.task_id),
+                  ('celery.state', state or ''), ('celery.retries', request.retries or 0)]
+    if request.hostname:
+        attributes.append(('celery.hostname', request.hostname))
+    start = min([execution.started_at] + [phase_start for _, phase_start, _ in phases])
+    spans = [_span(trace_id, span_id, _id(request.parent_id, 8) if request.parent_id else None,
+                   task.name, start, end, _KIND_CONSUMER, attributes,
+                   error=state not in (None, SUCCESS))]
+    for name, phase_start, phase_end in phases:
+        spans.append(_span(trace_id, os.urandom(8).hex(), span_id, name, phase_start, phase_end))
+    return spans
+
+
+def _flush(**kwargs):
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def configure_task_tracing(exporter, sample_rate=1.0):
+    """Trace a ``sample_rate`` fraction of traces of task executions, exporting spans with the
+    given exporter (``None`` to disable tracing).
+
+    Return the previous exporter and sample rate, and flush spans of the previous exporter.
+    """
+    global _exporter, _sample_rate
+    previous = (_exporter, _sample_rate)
+    if _exporter is not None and _exporter is not exporter:
+        _exporter.flush()
+    _exporter, _sample_rate = exporter, sample_rate
+    if exporter is not None:
+        signals.task_received.connect(_on_task_received, dispatch_uid='excewo_tracing_received')
+        signals.task_prerun.connect(_on_task_prerun, dispatch_uid='excewo_tracing_prerun')
+        signals.task_postrun.connect(_on_task_postrun, dispatch_uid='excewo_tracing_postrun')
+        signals.worker_process_shutdown.connect(_flush,
+                                                dispatch_uid='excewo_tracing_process_shutdown')
+        signals.worker_shutdown.connect(_flush, dispatch_uid='excewo_tracing_worker_shutdown')
+    return previous
+
+
+atexit.register(_flush)
@@ -0,0 +1,128 @@
+"""Tests for the accounting module."""
+
+
+from unittest.mock import patch
+import threading
+import unittest
+
+from celery import signals
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.accounting import TaskUsage, format_task_usage
+
+
+MIB = 2 ** 20
+
+
+class TaskUsageTest(unittest.TestCase):
+    """Test for memory and CPU accounting of tasks."""
+
+    def setUp(self):
+        self.app = Celery('accounting_test_app', set_as_current=False)
+        self.cache = []
+
+        @self.app.task(name='accounting_test_app.reports.build', shared=False)
+        def build(size):
+            self.cache.append(bytearray(size))
+
+        @self.app.task(name='accounting_test_app.ping.ping', shared=False)
+        def ping():
+            return 'pong'
+
+        self.build = build
+        self.ping = ping
+        self.usage = TaskUsage(self.app, [build.name, ping.name],
+                               budgets={'reports': 100 * MIB})
+        for signal, handler in ((signals.task_prerun, self.usage.on_task_prerun),
+                                (signals.task_postrun, self.usage.on_task_postrun)):
+            signal.connect(handler, weak=False)
+            self.addCleanup(signal.disconnect, handler)
+        patcher = patch('extensible_celery_worker.accounting.current_rss')
+        self.rss = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_totals(self):
+        """Check that memory growth and CPU time of tasks are summed up by task."""
+        self.rss.side_effect = [10 * MIB, 12 * MIB, 12 * MIB, 20 * MIB, 20 * MIB, 20 * MIB]
+        self.build.apply((10,))
+        self.build.apply((10,))
+        self.ping.apply()
+        totals = self.usage.totals()
+        self.assertEqual(totals[self.build.name]['tasks'], 2)
+        self.assertEqual(totals[self.build.name]['rss_growth'], 10 * MIB)
+        self.assertEqual(totals[self.build.name]['max_rss_growth'], 8 * MIB)
+        self.assertEqual(totals[self.build.name]['plugin'], 'reports')
+        self.assertEqual(totals[self.build.name]['budget'], 100 * MIB)
+        self.assertGreaterEqual(totals[self.build.name]['cpu_seconds'], 0)
+        self.assertEqual(totals[self.ping.name]['rss_growth'], 0)
+        self.assertIsNone(totals[self.ping.name]['budget'])
+
+    def test_untracked_tasks(self):
+        """Check that tasks which were not given are ignored."""
+        @self.app.task(name='accounting_test_app.ping.other', shared=False)
+        def other():
+            pass
+
+        other.apply()
+        self.assertEqual(self.usage.totals(), {})
+        self.rss.assert_not_called()
+
+    def test_added_tasks(self):
+        """Check that tasks added later are accounted for, and that statistics written before are
+        kept."""
+        @self.app.task(name='accounting_test_app.ping.other', shared=False)
+        def other():
+            pass
+
+        self.rss.side_effect = [10 * MIB, 12 * MIB, 12 * MIB, 15 * MIB, 15 * MIB, 15 * MIB]
+        self.build.apply((10,))
+        self.usage.add_tasks([self.build.name, other.name])
+        self.build.apply((10,))
+        other.apply()
+        totals = self.usage.totals()
+        self.assertEqual(totals[self.build.name]['tasks'], 2)
+        self.assertEqual(totals[self.build.name]['rss_growth'], 5 * MIB)
+        self.assertEqual(totals[self.build.name]['max_rss_growth'], 3 * MIB)
+        self.assertEqual(totals[other.name]['tasks'], 1)
+
+    @patch('logging.warning')
+    @patch('extensible_celery_worker.accounting.current_process')
+    def test_memory_budget(self, process, warning):
+        """Check that a pool process whose tasks of a plugin grew memory beyond its budget is
+        recycled once."""
+        shutdown = process.return_value._target._shutdown = threading.Event()
+        self.rss.side_effect = [0, 60 * MIB, 60 * MIB, 90 * MIB, 90 * MIB, 150 * MIB,
+                                150 * MIB, 300 * MIB]
+        self.build.apply((10,))
+        self.build.apply((10,))
+        self.assertFalse(shutdown.is_set())
+        self.build.apply((10,))
+        self.assertTrue(shutdown.is_set())
+        self.assertIn('reports', warning.call_args[0][0])
+        self.build.apply((10,))
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(self.usage.totals()[self.build.name]['recycles'], 1)
+
+    @patch('logging.warning')
+    @patch('extensible_celery_worker.accounting.current_process')
+    def test_memory_budget_without_pool_process(self, process, warning):
+        """Check that processes which cannot be recycled only log that they exceed the budget."""
+        process.return_value._target = None
+        self.rss.side_effect = [0, 200 * MIB]
+        self.build.apply((10,))
+        warning.assert_called_once()
+        self.assertEqual(self.usage.totals()[self.build.name]['recycles'], 0)
+
+    def test_format_task_usage(self):
+        """Check that tasks growing memory the most are shown first."""
+        self.rss.side_effect = [0, 1 * MIB, 1 * MIB, 4 * MIB]
+        self.ping.apply()
+        self.build.apply((10,))
+        lines = format_task_usage({'celery@host': self.usage.totals()}).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('Task'))
+        self.assertTrue(lines[1].startswith(self.build.name))
+        self.assertIn('celery@host', lines[1])
+        self.assertTrue(lines[2].startswith(self.ping.name))
+        self.assertEqual(len(format_task_usage({'celery@host': self.usage.totals()},
+                                               limit=1).splitlines()), 2)
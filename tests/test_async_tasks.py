@@ -0,0 +1,69 @@
+"""Tests for the async_tasks module."""
+
+
+import asyncio
+import threading
+import time
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.async_tasks import AsyncTask, _EventLoopThread
+
+
+class AsyncTaskTest(unittest.TestCase):
+    """Test for tasks defined with ``async def``."""
+
+    def setUp(self):
+        self.app = Celery('async_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+
+        @self.app.task(bind=True, shared=False)
+        async def wait(self, seconds):
+            await asyncio.sleep(seconds)
+            return self.request.id, threading.current_thread().name
+
+        self.wait = wait
+
+    def test_async_task(self):
+        """Check that the coroutine is run on the event loop, with the request of the task."""
+        self.assertIsInstance(self.wait, AsyncTask)
+        result = self.wait.apply((0.01,), task_id='my-task-id')
+        self.assertEqual(result.get(), ('my-task-id', 'excewo-asyncio'))
+
+    def test_concurrent_tasks(self):
+        """Check that coroutines of all threads of the threads pool run concurrently."""
+        with start_worker(self.app, pool='threads', concurrency=20, perform_ping_check=False):
+            start = time.monotonic()
+            results = [self.wait.delay(0.5) for _ in range(20)]
+            task_ids = [result.get(timeout=10)[0] for result in results]
+            elapsed = time.monotonic() - start
+        self.assertEqual(task_ids, [result.id for result in results])
+        self.assertLess(elapsed, 5)
+
+
+class EventLoopThreadTest(unittest.TestCase):
+    """Test for the event loop running coroutines of tasks."""
+
+    def test_in_flight_limit(self):
+        """Check that at most the given number of coroutines run at the same time."""
+        event_loop = _EventLoopThread(in_flight_limit=2)
+        self.addCleanup(event_loop.loop.call_soon_threadsafe, event_loop.loop.stop)
+        running = []
+        peaks = []
+
+        async def count():
+            running.append(None)
+            peaks.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+
+        threads = [threading.Thread(target=event_loop.run, args=(count(),)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peaks), 6)
+        self.assertEqual(max(peaks), 2)
@@ -0,0 +1,122 @@
+"""Tests for the autoscale module."""
+
+
+from unittest.mock import PropertyMock, patch
+import time
+import unittest
+
+from kombu.common import QoS
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.autoscale import (
+    AdaptiveAutoscaler,
+    autoscale_worker_args,
+    configure_adaptive_autoscaler,
+)
+from extensible_celery_worker.metrics import TaskMetrics
+
+
+class _Pool:
+    """Pool whose processes are only counted."""
+
+    def __init__(self, num_processes):
+        self.num_processes = num_processes
+
+    def grow(self, n):
+        self.num_processes += n
+
+    def shrink(self, n):
+        self.num_processes -= n
+
+    def maintain_pool(self):
+        pass
+
+
+class _Installer:
+    """Metrics installer of a worker which is initialized."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+
+class _Worker:
+    """Worker whose consumer reserves 4 messages for each process."""
+
+    def __init__(self, processes):
+        self.consumer = type('Consumer', (), {})()
+        self.consumer.prefetch_multiplier = 4
+        self.consumer.initial_prefetch_count = processes * 4
+        self.consumer.qos = QoS(lambda prefetch_count: None, processes * 4)
+
+
+class AdaptiveAutoscalerTest(unittest.TestCase):
+    """Test for pool size and prefetch count decisions."""
+
+    def setUp(self):
+        patcher = patch('logging.info')
+        self.info = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('extensible_celery_worker.autoscale._settings', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = Celery('autoscale_test_app', set_as_current=False)
+        self.metrics = TaskMetrics(['autoscale_test_app.maths.add'], processes=8)
+        configure_adaptive_autoscaler(self.app, _Installer(self.metrics), min_concurrency=1,
+                                      max_concurrency=8, queue_wait_target=0.5)
+
+    def _autoscaler(self, processes, reserved):
+        """Return an autoscaler of a pool with the given processes and reserved messages, whose
+        moving averages are initialized."""
+        qty = patch.object(AdaptiveAutoscaler, 'qty', new_callable=PropertyMock,
+                           return_value=reserved)
+        qty.start()
+        self.addCleanup(qty.stop)
+        autoscaler = AdaptiveAutoscaler(_Pool(processes), 8, 1, worker=_Worker(processes))
+        autoscaler.maybe_scale()
+        return autoscaler
+
+    def _run_tasks(self, autoscaler, count, runtime, queue_wait):
+        """Record tasks with the given runtime and queue wait time, and update the autoscaler."""
+        offset = self.metrics._task_offset('autoscale_test_app.maths.add')
+        for _ in range(count):
+            self.metrics._observe(offset, 'runtime', runtime)
+            self.metrics._observe(offset, 'queue_wait', queue_wait)
+        autoscaler._last_update = None
+        autoscaler.maybe_scale()
+
+    def test_grow(self):
+        """Check that the pool grows when reserved messages wait too long."""
+        autoscaler = self._autoscaler(2, 6)
+        self._run_tasks(autoscaler, 4, 0.5, 2.0)
+        self.assertEqual(autoscaler.pool.num_processes, 6)
+        self.assertIn('Growing pool by 4 processes', self.info.call_args_list[0][0][0])
+
+    def test_max_concurrency(self):
+        """Check that the pool does not grow beyond the maximum concurrency."""
+        autoscaler = self._autoscaler(2, 100)
+        self._run_tasks(autoscaler, 4, 0.5, 2.0)
+        self.assertEqual(autoscaler.pool.num_processes, 8)
+
+    def test_shrink(self):
+        """Check that the pool shrinks when processes are idle and messages do not wait."""
+        autoscaler = self._autoscaler(4, 1)
+        autoscaler._last_scale_up = time.monotonic() - autoscaler.keepalive - 1
+        self._run_tasks(autoscaler, 4, 0.5, 0.01)
+        self.assertEqual(autoscaler.pool.num_processes, 1)
+
+    def test_prefetch(self):
+        """Check that more messages are reserved for short tasks and fewer for long tasks."""
+        autoscaler = self._autoscaler(2, 2)
+        consumer = autoscaler.worker.consumer
+        self._run_tasks(autoscaler, 10, 0.002, 0.0)
+        self.assertEqual((consumer.initial_prefetch_count, consumer.qos.value), (128, 128))
+        for _ in range(10):
+            self._run_tasks(autoscaler, 1, 600.0, 0.0)
+        self.assertEqual((consumer.initial_prefetch_count, consumer.qos.value), (2, 2))
+        self.assertEqual(autoscaler.info()['prefetch_multiplier'], 1)
+
+    def test_worker_args(self):
+        """Check that workers are started with the configured autoscaling bounds."""
+        self.assertEqual(autoscale_worker_args(), ['--autoscale', '8,1'])
+        self.assertEqual(self.app.conf.worker_autoscaler,
+                         'extensible_celery_worker.autoscale:AdaptiveAutoscaler')
@@ -0,0 +1,74 @@
+"""Tests for the batches module."""
+
+
+from unittest.mock import patch
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.batches import BatchTask, configure_batch_tasks
+
+
+def _count(items):
+    """Return the number of items of each argument tuple."""
+    return [len(item) for item in items]
+
+
+class BatchTaskTest(unittest.TestCase):
+    """Test for batch tasks run by a worker."""
+
+    def setUp(self):
+        self.app = Celery('batches_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.batches = []
+
+        @self.app.batch_task(batch_size=4, batch_flush_interval=0.2, shared=False)
+        def double(items):
+            self.batches.append(items)
+            return [2 * x for x, in items]
+
+        @self.app.batch_task(batch_size=2, shared=False)
+        def broken(items):
+            raise RuntimeError('Broken batch')
+
+        self.double = double
+        self.broken = broken
+
+    def test_batch_size(self):
+        """Check that a full batch is run at once and that each message gets its own result."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            results = [self.double.delay(i) for i in range(8)]
+            self.assertEqual([result.get(timeout=10) for result in results],
+                             [0, 2, 4, 6, 8, 10, 12, 14])
+        self.assertEqual(self.batches, [[(0,), (1,), (2,), (3,)], [(4,), (5,), (6,), (7,)]])
+
+    def test_flush_interval(self):
+        """Check that an incomplete batch is run after the flush interval."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            results = [self.double.delay(i) for i in range(3)]
+            self.assertEqual([result.get(timeout=10) for result in results], [0, 2, 4])
+        self.assertEqual(self.batches, [[(0,), (1,), (2,)]])
+
+    def test_batch_failure(self):
+        """Check that all messages of a batch fail when the task raises an exception."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False), \
+                patch('logging.error'):
+            results = [self.broken.delay(i) for i in range(2)]
+            for result in results:
+                with self.assertRaisesRegex(RuntimeError, 'Broken batch'):
+                    result.get(timeout=10)
+
+    def test_local_call(self):
+        """Check that a batch task called locally runs a batch of one message."""
+        self.assertEqual(self.double(21), 42)
+        self.assertEqual(self.batches, [[(21,)]])
+
+    def test_configure_batch_tasks(self):
+        """Check that batch settings are changed for batch tasks of the given plugins."""
+        task = self.app.task(name='batches_test_app.scoring.score', base=BatchTask,
+                             shared=False)(_count)
+        configure_batch_tasks(self.app, {'scoring': 500}, {'scoring': 0.05})
+        self.assertEqual((task.batch_size, task.batch_flush_interval), (500, 0.05))
+        self.assertEqual(self.double.batch_size, 4)
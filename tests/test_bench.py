@@ -0,0 +1,37 @@
+"""Benchmarks of example tasks, run with pytest-benchmark (skipped if it is not installed)."""
+
+
+from unittest.mock import patch
+import pathlib
+import tempfile
+
+from extensible_celery_worker import app
+from extensible_celery_worker.__main__ import set_up_worker
+from extensible_celery_worker.bench import run_benchmark
+import pytest
+
+
+pytest.importorskip('pytest_benchmark')
+
+
+_MESSAGES = 200
+
+
+@pytest.fixture(scope='module')
+def bench_app():
+    # Do not write the plugin manifest to the actual user cache directory
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            patch('extensible_celery_worker.__main__.user_cache_dir',
+                  return_value=pathlib.Path(cache_dir)), \
+            set_up_worker():
+        yield app
+
+
+@pytest.mark.parametrize('pool,concurrency', [('solo', 1), ('threads', 2), ('prefork', 2)])
+def test_always_true(benchmark, bench_app, pool, concurrency):
+    """Benchmark the ``examples.always_true`` task."""
+    result = benchmark.pedantic(run_benchmark, args=(bench_app, 'examples.always_true', _MESSAGES,
+                                                     pool, concurrency), rounds=3)
+    benchmark.extra_info.update(result)
+    assert result['messages'] == _MESSAGES
+    assert result['latency_p50'] <= result['latency_p95'] <= result['latency_p99']
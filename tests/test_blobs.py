@@ -0,0 +1,127 @@
+"""Tests for the blobs module."""
+
+
+from unittest.mock import patch
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.blobs import (
+    REFERENCE_KEY,
+    BlobNotFound,
+    BlobStore,
+    configure_blob_store,
+    offload_arguments,
+)
+
+
+def _size(data):
+    """Return the size of the given data."""
+    return len(data)
+
+
+def _repeat(text, count):
+    """Return the given text repeated the given number of times."""
+    return text * count
+
+
+def _type_name(data):
+    """Return the name of the type of the given data."""
+    return type(data).__name__
+
+
+class BlobStoreTest(unittest.TestCase):
+    """Test for the blob store."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name)
+        self.store = BlobStore(self.path, threshold=10)
+
+    def _files(self):
+        return sorted(path.name for path in self.path.glob('*/*'))
+
+    def test_put_get(self):
+        """Check that strings and bytes are read back."""
+        self.assertEqual(self.store.get(self.store.put('é' * 20)), 'é' * 20)
+        self.assertEqual(self.store.get(self.store.put(bytearray(b'abc'))), b'abc')
+
+    def test_zero_copy(self):
+        """Check that bytes blobs can be read as memory views."""
+        view = self.store.get(self.store.put(b'x' * 100), zero_copy=True)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(bytes(view[:3]), b'xxx')
+
+    def test_content_addressed(self):
+        """Check that a content is stored once and removed with its last reference."""
+        first = self.store.put(b'x' * 100)
+        second = self.store.put(b'x' * 100)
+        self.assertEqual(len(self._files()), 3)
+        self.store.remove(first)
+        self.assertEqual(self.store.get(second), b'x' * 100)
+        self.store.remove(second)
+        self.assertEqual(self._files(), [])
+        with self.assertRaises(BlobNotFound):
+            self.store.get(first)
+
+    def test_sweep(self):
+        """Check that expired references are removed."""
+        reference = self.store.put(b'x' * 100)
+        fresh = self.store.put(b'y' * 100)
+        old = time.time() - 2 * self.store.ttl
+        os.utime(self.store._blob_path(reference[REFERENCE_KEY]).as_posix(), (old, old))
+        with patch('logging.info'):
+            self.store.sweep()
+        self.assertEqual(len(self._files()), 2)
+        self.assertEqual(self.store.get(fresh), b'y' * 100)
+
+    def test_offload_arguments(self):
+        """Check that only large arguments and items of list arguments are offloaded."""
+        configure_blob_store(self.store)
+        self.addCleanup(configure_blob_store, None)
+        args, kwargs = offload_arguments(('short', b'x' * 100, [1, 'y' * 100]), {'z': 'z' * 100})
+        self.assertEqual(args[0], 'short')
+        self.assertIn(REFERENCE_KEY, args[1])
+        self.assertEqual(args[2][0], 1)
+        self.assertIn(REFERENCE_KEY, args[2][1])
+        self.assertIn(REFERENCE_KEY, kwargs['z'])
+
+
+class ClaimCheckTest(unittest.TestCase):
+    """Test for task arguments and results offloaded to the blob store."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name)
+        configure_blob_store(BlobStore(self.path, threshold=10))
+        self.addCleanup(configure_blob_store, None)
+        self.app = Celery('blobs_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.size = self.app.task(name='blobs_test_app.data.size', shared=False)(_size)
+        self.repeat = self.app.task(name='blobs_test_app.data.repeat', shared=False)(_repeat)
+        self.type_name = self.app.task(name='blobs_test_app.data.type_name', shared=False,
+                                       zero_copy=True)(_type_name)
+
+    def test_arguments_and_result(self):
+        """Check that offloaded arguments and results are resolved, then removed."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            self.assertEqual(self.size.delay(b'x' * 100).get(timeout=10), 100)
+            result = self.repeat.delay('y', 100)
+            self.assertEqual(result.get(timeout=10), 'y' * 100)
+            self.assertEqual(result.get(timeout=10), 'y' * 100)
+        self.assertEqual(list(self.path.glob('*/*')), [])
+
+    def test_zero_copy(self):
+        """Check that tasks allowing it get memory views of bytes blobs, and strings of string
+        blobs."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            self.assertEqual(self.type_name.delay(b'x' * 100).get(timeout=10), 'memoryview')
+            self.assertEqual(self.type_name.delay('x' * 100).get(timeout=10), 'str')
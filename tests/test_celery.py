@@ -5,9 +5,11 @@ from unittest.mock import patch
 import contextlib
 import pathlib
 import sys
+import tempfile
 import unittest
 
 from extensible_celery_worker import DEFAULT_CONFIG, app
+from extensible_celery_worker import memo
 from extensible_celery_worker.__main__ import main
 
 from celery.contrib.testing.app import DEFAULT_TEST_CONFIG
@@ -17,6 +19,17 @@ from celery.contrib.testing.worker import start_worker as _start_worker
 import pytest
 
 
+def _use_temporary_cache_dir(test_case):
+    """Make the plugin manifest be written to a temporary directory instead of the actual user
+    cache directory, until the end of the given test."""
+    tmp_dir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(tmp_dir.cleanup)
+    patcher = patch('extensible_celery_worker.__main__.user_cache_dir',
+                    return_value=pathlib.Path(tmp_dir.name))
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
 @pytest.mark.usefixtures('start_worker')
 class CeleryAppDefaultInitTest(unittest.TestCase):
     """Test the Celery application default initialization."""
@@ -57,6 +70,7 @@ class CeleryAppCliInitTest(unittest.TestCase):
         patcher = patch.object(app, 'worker_main')
         self.mock_app_worker_main = patcher.start()
         self.addCleanup(patcher.stop)
+        _use_temporary_cache_dir(self)
 
     def test_no_command(self):
         """Check that the Celery application does not start if no command is given."""
@@ -116,6 +130,7 @@ class CeleryAppNameTest(unittest.TestCase):
         patcher = patch.object(app, 'worker_main')
         self.mock_app_worker_main = patcher.start()
         self.addCleanup(patcher.stop)
+        _use_temporary_cache_dir(self)
 
     def test_app_default_name(self):
         """Check that the default name is used when no cli arg nor configuration file is given."""
@@ -162,6 +177,7 @@ class CeleryAppConfigTest(unittest.TestCase):
         patcher = patch.object(app, 'worker_main')
         self.mock_app_worker_main = patcher.start()
         self.addCleanup(patcher.stop)
+        _use_temporary_cache_dir(self)
 
     def test_app_default_config(self):
         """Check that the default configuration is used when no cli arg nor configuration file is
@@ -227,6 +243,7 @@ class CeleryAppRegisteredTasksTest(unittest.TestCase):
         patcher = patch.object(app, 'worker_main')
         self.mock_app_worker_main = patcher.start()
         self.addCleanup(patcher.stop)
+        _use_temporary_cache_dir(self)
 
     def test_registered_example_tasks(self):
         """Check that the example tasks are registered with the Celery application."""
@@ -237,6 +254,15 @@ class CeleryAppRegisteredTasksTest(unittest.TestCase):
                 with self.subTest(msg='Check that task "{}" is registered'.format(task_fullname)):
                     self.assertIn(task_fullname, app.tasks)
 
+    def test_no_memo_cache(self):
+        """Check that the cache of results of pure tasks is not used when it is not configured and
+        no task is pure."""
+        with patch.object(sys, 'argv', ['excewo', 'worker']), \
+                patch('extensible_celery_worker.__main__.add_collector') as add_collector:
+            main()
+        self.assertIsNone(memo._cache)
+        self.assertNotIn('memo', [args[0] for args, _ in add_collector.call_args_list])
+
 
 @pytest.fixture(scope='class')
 def start_worker(request):
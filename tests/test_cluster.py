@@ -0,0 +1,138 @@
+"""Tests for the cluster module."""
+
+
+from unittest.mock import patch
+import configparser
+import pathlib
+import signal
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+from extensible_celery_worker.__main__ import _cluster_worker_pools
+from extensible_celery_worker.cluster import Cluster, WorkerPool
+
+
+def _python_command(code):
+    """Return the command line running the given Python code."""
+    return [sys.executable, '-c', textwrap.dedent(code)]
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """Test for worker pool definitions."""
+
+    def test_command(self):
+        """Check that workers load the plugins of their pool and get a node name of their own."""
+        pool = WorkerPool('cpu', ['-P', 'prefork', '-c', '4'], ['reports', 'exports'])
+        self.assertEqual(pool.command(['-n', 'my_worker']), [
+            sys.executable, '-m', 'extensible_celery_worker', '-n', 'my_worker',
+            '--plugins', 'reports,exports', 'worker', '--', '-P', 'prefork', '-c', '4',
+            '-n', 'cpu@%h',
+        ])
+
+    def test_command_all_plugins(self):
+        """Check that a pool without plugins loads all plugins, and that a given node name is
+        kept."""
+        command = WorkerPool('default', ['--hostname=main@%h']).command()
+        self.assertNotIn('--plugins', command)
+        self.assertEqual(command[-3:], ['worker', '--', '--hostname=main@%h'])
+
+    def test_pools_from_config(self):
+        """Check that pools are read from the configuration and consume queues of their plugins."""
+        config = configparser.ConfigParser()
+        config.read_string(textwrap.dedent('''
+            [excewo]
+            plugin_queues = yes
+            plugin_queue.slow = reports, exports
+            cluster_pool.cpu = -P prefork -c 4
+            cluster_plugins.cpu = reports, exports, images
+            cluster_pool.io = -P threads -c 20 -Q my_worker.io
+            cluster_plugins.io = http
+            cluster_pool.other = -P solo
+        '''))
+        cpu, io, other = _cluster_worker_pools(config, 'my_worker')
+        self.assertEqual(cpu.plugin_names, ['reports', 'exports', 'images'])
+        self.assertEqual(cpu.worker_args, ['-P', 'prefork', '-c', '4',
+                                           '-Q', 'my_worker.images,my_worker.slow'])
+        self.assertEqual(io.worker_args, ['-P', 'threads', '-c', '20', '-Q', 'my_worker.io'])
+        self.assertIsNone(other.plugin_names)
+        self.assertEqual(other.worker_args, ['-P', 'solo'])
+
+    def test_pools_from_plugin_records(self):
+        """Check that pools consume the queues tasks of their plugins are routed to, when plugin
+        names differ from the modules of their tasks."""
+        config = configparser.ConfigParser()
+        config.read_string(textwrap.dedent('''
+            [excewo]
+            plugin_queues = yes
+            plugin_queue.slow = exports
+            cluster_pool.cpu = -P prefork -c 4
+            cluster_plugins.cpu = reporting, exporting
+        '''))
+        records = [
+            {'name': 'reporting', 'module': 'acme.reports.tasks',
+             'tasks': {'my_worker.reports.build': {}}},
+            {'name': 'exporting', 'module': 'acme.exports',
+             'tasks': {'my_worker.exports.csv': {}, 'my_worker.exports.json': {}}},
+        ]
+        cpu, = _cluster_worker_pools(config, 'my_worker', records)
+        self.assertEqual(cpu.worker_args, ['-P', 'prefork', '-c', '4',
+                                           '-Q', 'my_worker.reports,my_worker.slow'])
+
+
+class ClusterTest(unittest.TestCase):
+    """Test for the supervision of worker processes."""
+
+    def setUp(self):
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _supervise(self, cluster, seconds):
+        """Supervise processes of the given cluster for the given time."""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            cluster.poll()
+            time.sleep(0.01)
+
+    def test_restart(self):
+        """Check that exited processes are started again, waiting longer each time."""
+        cluster = Cluster({'crashing': _python_command('raise SystemExit(1)')},
+                          restart_delay=0.2, max_restart_delay=10.0)
+        self.addCleanup(cluster.stop)
+        cluster.start()
+        with patch('logging.warning') as warning:
+            self._supervise(cluster, 1.2)
+        # Restarted after 0.2s then 0.4s, and waiting 0.8s more for the next restart
+        self.assertEqual(cluster.restart_counts['crashing'], 2)
+        self.assertIn('exited with code 1', warning.call_args[0][0])
+
+    def test_graceful_stop(self):
+        """Check that processes are terminated on stop."""
+        cluster = Cluster({'sleeping': _python_command('import time; time.sleep(60)')})
+        cluster.start()
+        cluster.stop()
+        self.assertIsNotNone(cluster.processes['sleeping'].returncode)
+        self.assertEqual(cluster.restart_counts['sleeping'], 0)
+
+    def test_kill_after_timeout(self):
+        """Check that processes which do not exit in time are killed."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        ready_path = pathlib.Path(tmp_dir.name) / 'ready'
+        cluster = Cluster({'stubborn': _python_command('''
+            import pathlib, signal, sys, time
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            pathlib.Path(sys.argv[1]).touch()
+            time.sleep(60)
+        ''') + [ready_path.as_posix()]}, shutdown_timeout=0.5)
+        cluster.start()
+        deadline = time.monotonic() + 10
+        while not ready_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with patch('logging.warning') as warning:
+            cluster.stop()
+        self.assertEqual(cluster.processes['stubborn'].returncode, -signal.SIGKILL)
+        warning.assert_called_once()
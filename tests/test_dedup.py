@@ -0,0 +1,100 @@
+"""Tests for the dedup module."""
+
+
+from unittest.mock import patch
+import os
+import tempfile
+import time
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.dedup import DedupIndex, configure_message_dedup
+
+
+_calls = []
+
+
+def _count(x):
+    _calls.append(x)
+    return len(_calls)
+
+
+class DedupIndexTest(unittest.TestCase):
+    """Test for the index of task messages."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = DedupIndex(os.path.join(directory.name, 'dedup.sqlite'), max_entries=3)
+
+    def test_duplicate(self):
+        """Check that messages of tasks running or done are duplicates, unless the task failed."""
+        self.assertIsNone(self.index.duplicate('app.a.task', ['id:1:0']))
+        self.index.start('app.a.task', ['id:1:0'])
+        self.assertEqual(self.index.duplicate('app.a.task', ['id:1:0']), 'id:1:0')
+        self.index.finish(['id:1:0'], succeeded=True)
+        self.assertEqual(self.index.duplicate('app.a.task', ['id:1:0']), 'id:1:0')
+        self.assertIsNone(self.index.duplicate('app.a.task', ['id:1:1']))
+        self.index.start('app.a.task', ['id:2:0'])
+        self.index.finish(['id:2:0'], succeeded=False)
+        self.assertIsNone(self.index.duplicate('app.a.task', ['id:2:0']))
+        self.assertEqual(self.index.stats(), {'app.a.task': {'ids': 2, 'arguments': 0}})
+        self.assertIn('excewo_dedup_duplicates_total{task="app.a.task",of="id"} 2',
+                      self.index.as_prometheus_text())
+
+    def test_dead_process(self):
+        """Check that tasks whose process died before they were done may run again."""
+        pid = os.fork()
+        if not pid:  # Child process
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.index.start('app.a.task', ['id:1:0'], pid=pid)
+        self.assertIsNone(self.index.duplicate('app.a.task', ['id:1:0']))
+
+    def test_bounds(self):
+        """Check that the oldest entries are evicted, and that expired entries are ignored."""
+        for task_id in range(5):
+            self.index.start('app.a.task', ['id:{}:0'.format(task_id)])
+        self.assertIsNone(self.index.duplicate('app.a.task', ['id:0:0']))
+        self.assertIsNotNone(self.index.duplicate('app.a.task', ['id:4:0']))
+        with patch('time.time', return_value=time.time() + self.index.ttl + 1):
+            self.assertIsNone(self.index.duplicate('app.a.task', ['id:4:0']))
+
+
+class MessageDedupTest(unittest.TestCase):
+    """Test for deduplication of messages received by the worker."""
+
+    def setUp(self):
+        self.app = Celery('dedup_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = DedupIndex(os.path.join(directory.name, 'dedup.sqlite'))
+        configure_message_dedup(self.app, self.index)
+        self.addCleanup(configure_message_dedup, self.app, None)
+        del _calls[:]
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_worker(self):
+        """Check that messages with the task id of a task done, or with the arguments of a task
+        done for idempotent tasks, are dropped."""
+        count = self.app.task(name='dedup_test_app.counter.count', shared=False)(_count)
+        count_once = self.app.task(name='dedup_test_app.counter.count_once', idempotent=True,
+                                   shared=False)(_count)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            self.assertEqual(count.apply_async((1,), task_id='first').get(timeout=10), 1)
+            count.apply_async((1,), task_id='first')
+            self.assertEqual(count.delay(1).get(timeout=10), 2)
+            self.assertEqual(count_once.delay(2).get(timeout=10), 3)
+            count_once.delay(2)
+            self.assertEqual(count_once.delay(3).get(timeout=10), 4)
+        self.assertEqual(_calls, [1, 1, 2, 3])
+        self.assertEqual(self.index.stats(), {
+            'dedup_test_app.counter.count': {'ids': 1, 'arguments': 0},
+            'dedup_test_app.counter.count_once': {'ids': 0, 'arguments': 1},
+        })
@@ -0,0 +1,93 @@
+"""Tests for the events module."""
+
+
+from collections import Counter, defaultdict
+from unittest.mock import patch
+import unittest
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.events import (
+    SUMMARY_EVENT,
+    TaskEventDispatcher,
+    configure_task_event_aggregation,
+    count_task_summary,
+)
+
+
+class TaskEventDispatcherTest(unittest.TestCase):
+    """Test for aggregation of task events."""
+
+    def setUp(self):
+        self.app = Celery('events_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://')
+        self.sent = []
+        patcher = patch('celery.events.dispatcher.EventDispatcher.publish',
+                        lambda dispatcher, type, fields, *args, **kwargs:
+                        self.sent.append(dict(fields, type=type)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(configure_task_event_aggregation, None)
+        self.connection = self.app.connection_for_write()
+        self.addCleanup(self.connection.release)
+
+    def _dispatcher(self):
+        """Return an enabled event dispatcher of the application."""
+        dispatcher = self.app.events.Dispatcher(self.connection, enabled=True)
+        self.addCleanup(dispatcher.close)
+        self.assertIsInstance(dispatcher, TaskEventDispatcher)
+        return dispatcher
+
+    def _run_task(self, dispatcher, task_id, succeeded=True):
+        """Send events of a task with the given id."""
+        dispatcher.send('task-received', uuid=task_id, name='events_test_app.maths.add')
+        dispatcher.send('task-started', uuid=task_id)
+        if succeeded:
+            dispatcher.send('task-succeeded', uuid=task_id, result='2', runtime=0.5)
+        else:
+            dispatcher.send('task-failed', uuid=task_id, exception='ValueError()')
+
+    def test_summary(self):
+        """Check that task events are counted by task name and sent in summaries."""
+        configure_task_event_aggregation(interval=3600)
+        dispatcher = self._dispatcher()
+        for i in range(3):
+            self._run_task(dispatcher, 'task-{}'.format(i), succeeded=i != 2)
+        dispatcher.send('worker-heartbeat')
+        self.assertEqual([event['type'] for event in self.sent], ['worker-heartbeat'])
+        dispatcher.send_summary()
+        summary = self.sent[-1]
+        self.assertEqual(summary['type'], SUMMARY_EVENT)
+        self.assertEqual(summary['tasks'], {'events_test_app.maths.add': {
+            'received': 3, 'started': 3, 'succeeded': 2, 'failed': 1, 'runtime': 1.0,
+        }})
+        self.assertEqual(dispatcher._task_names, {})
+
+    def test_interval(self):
+        """Check that the summary is sent with the first event after the interval."""
+        configure_task_event_aggregation(interval=0)
+        dispatcher = self._dispatcher()
+        self._run_task(dispatcher, 'task-0')
+        self.assertEqual([event['type'] for event in self.sent], [SUMMARY_EVENT] * 3)
+
+    def test_sampling(self):
+        """Check that events of sampled tasks are sent."""
+        configure_task_event_aggregation(interval=3600, sample_rate=1.0)
+        dispatcher = self._dispatcher()
+        self._run_task(dispatcher, 'task-0')
+        self.assertEqual([event['type'] for event in self.sent],
+                         ['task-received', 'task-started', 'task-succeeded'])
+
+    def test_disabled(self):
+        """Check that task events are sent by default."""
+        dispatcher = self._dispatcher()
+        self._run_task(dispatcher, 'task-0')
+        self.assertEqual(len(self.sent), 3)
+
+    def test_count_task_summary(self):
+        """Check that summaries are counted as task events."""
+        counter = defaultdict(Counter)
+        count_task_summary(counter, {'hostname': 'celery@host', 'tasks': {
+            'events_test_app.maths.add': {'received': 3, 'succeeded': 2, 'runtime': 1.0},
+            'events_test_app.maths.mul': {'received': 1},
+        }})
+        self.assertEqual(counter, {'celery@host': {'task-received': 4, 'task-succeeded': 2}})
@@ -0,0 +1,68 @@
+"""Tests for the fusion module."""
+
+
+import unittest
+
+from celery import chain, signals
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.fusion import configure_chain_fusion
+
+
+def _add(x, y):
+    """Return the sum of the arguments."""
+    return x + y
+
+
+def _double(x):
+    """Return twice the argument."""
+    return 2 * x
+
+
+class ChainFusionTest(unittest.TestCase):
+    """Test for chain steps run by the worker in process."""
+
+    def setUp(self):
+        self.app = Celery('fusion_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.add = self.app.task(name='fusion_test_app.maths.add', shared=False)(_add)
+        self.double = self.app.task(name='fusion_test_app.other.double', shared=False)(_double)
+        self.published = []
+        signals.before_task_publish.connect(self._on_publish)
+        self.addCleanup(signals.before_task_publish.disconnect, self._on_publish)
+        self.addCleanup(configure_chain_fusion)
+
+    def _on_publish(self, sender=None, **kwargs):
+        if sender.startswith('fusion_test_app.'):
+            self.published.append(sender)
+
+    def _run(self, *steps):
+        """Run a chain of the given steps with a worker and return its result."""
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            result = chain(*steps).apply_async()
+            return result, result.get(timeout=10)
+
+    def test_fused_chain(self):
+        """Check that local steps are not sent, and that only the last result is stored."""
+        configure_chain_fusion(plugins={'maths': True})
+        result, value = self._run(self.add.s(1, 1), self.add.s(2), self.add.s(3))
+        self.assertEqual(value, 7)
+        self.assertEqual(self.published, ['fusion_test_app.maths.add'])
+        self.assertEqual(result.parent.state, 'PENDING')
+        self.assertEqual(result.parent.parent.state, 'SUCCESS')
+
+    def test_fallback(self):
+        """Check that steps of plugins without chain fusion are sent to the broker."""
+        configure_chain_fusion(True, {'other': False})
+        _, value = self._run(self.add.s(1, 1), self.double.s(), self.add.s(3), self.add.s(4))
+        self.assertEqual(value, 11)
+        self.assertEqual(self.published, ['fusion_test_app.maths.add',
+                                          'fusion_test_app.other.double'])
+
+    def test_disabled(self):
+        """Check that chain fusion is disabled by default."""
+        _, value = self._run(self.add.s(1, 1), self.add.s(2))
+        self.assertEqual(value, 4)
+        self.assertEqual(self.published, ['fusion_test_app.maths.add'] * 2)
@@ -0,0 +1,109 @@
+"""Tests for the limits module."""
+
+
+from unittest.mock import patch
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.limits import HostLimits, configure_host_limits
+
+
+_running = []
+_max_running = []
+_running_lock = threading.Lock()
+
+
+def _slow(x):
+    with _running_lock:
+        _running.append(x)
+        _max_running.append(len(_running))
+    time.sleep(0.05)
+    with _running_lock:
+        _running.remove(x)
+    return x
+
+
+class HostLimitsTest(unittest.TestCase):
+    """Test for the limits shared by workers of a host."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'limits')
+
+    def test_rate(self):
+        """Check that tasks take tokens of rate limits, up to the burst size."""
+        limits = HostLimits(self.path, rates={'app.a.task': 1 / 60}, bursts={'app.a.task': 2})
+        self.assertEqual(limits.acquire(['app.a.task']), 0)
+        self.assertEqual(limits.acquire(['app.a.task']), 0)
+        self.assertAlmostEqual(limits.acquire(['app.a.task']), 60, delta=1)
+        self.assertAlmostEqual(limits.stats()['app.a.task']['tokens'], 0, delta=0.1)
+        with patch('time.time', return_value=time.time() + 60):
+            self.assertEqual(limits.acquire(['app.a.task']), 0)
+
+    def test_concurrency(self):
+        """Check that concurrency limits are shared by all users of the limits file, and that
+        tasks of workers which died are not counted."""
+        limits = HostLimits(self.path, concurrency={'a': 1})
+        other_limits = HostLimits(self.path, concurrency={'a': 1})
+        self.assertEqual(limits.acquire(['a']), 0)
+        self.assertGreater(other_limits.acquire(['a']), 0)
+        limits.release(['a'])
+        self.assertEqual(limits.stats(), {'a': {'running': 0}})
+        pid = os.fork()
+        if not pid:  # Child process
+            os._exit(limits.acquire(['a']) != 0)
+        os.waitpid(pid, 0)
+        self.assertEqual(other_limits.acquire(['a']), 0)
+        self.assertIn('excewo_limit_running{limit="a"} 1', limits.as_prometheus_text())
+
+    def test_all_or_nothing(self):
+        """Check that no limit is taken if one of them is reached."""
+        limits = HostLimits(self.path, rates={'a': 1 / 60}, concurrency={'b': 1})
+        self.assertEqual(limits.acquire(['b']), 0)
+        self.assertGreater(limits.acquire(['a', 'b']), 0)
+        self.assertEqual(limits.stats(), {'a': {'tokens': 1}, 'b': {'running': 1}})
+
+
+class LimitedWorkerTest(unittest.TestCase):
+    """Test for host limits applied by workers."""
+
+    def setUp(self):
+        self.app = Celery('limits_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.slow = self.app.task(name='limits_test_app.math.slow', shared=False)(_slow)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'limits')
+        self.addCleanup(configure_host_limits, self.app, None)
+        del _max_running[:]
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rate(self):
+        """Check that tasks wait for tokens of the rate limit of their task."""
+        configure_host_limits(self.app, HostLimits(self.path, rates={self.slow.name: 20}))
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            start = time.monotonic()
+            results = [self.slow.delay(x) for x in range(5)]
+            self.assertEqual([result.get(timeout=10) for result in results], list(range(5)))
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_concurrency(self):
+        """Check that tasks of a plugin do not run at the same time beyond its concurrency
+        limit, and wait in order."""
+        limits = HostLimits(self.path, concurrency={'math': 1})
+        configure_host_limits(self.app, limits)
+        with start_worker(self.app, pool='threads', concurrency=4, perform_ping_check=False):
+            results = [self.slow.delay(x) for x in range(6)]
+            self.assertEqual([result.get(timeout=10) for result in results], list(range(6)))
+        self.assertEqual(max(_max_running), 1)
+        self.assertEqual(limits.stats(), {'math': {'running': 0}})
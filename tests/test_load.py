@@ -0,0 +1,91 @@
+"""Tests for the load module."""
+
+
+from unittest.mock import patch
+import json
+import random
+import tempfile
+import time
+import unittest
+import uuid
+
+from celery.exceptions import NotRegistered
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.load import ArgumentTemplates, format_load_results, run_load
+
+
+def _label(size, name):
+    return '{}:{}'.format(name, size)
+
+
+def _slow():
+    time.sleep(0.05)
+
+
+class ArgumentTemplatesTest(unittest.TestCase):
+    """Test for templates of task messages."""
+
+    def test_message(self):
+        """Check that placeholders of templates are replaced, keeping the type of single
+        placeholders."""
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump([{'task': 'plugin.task', 'args': ['{n}', 'report-{n}'],
+                        'kwargs': {'size': '{randint:1:3}', 'key': '{uuid}',
+                                   'options': {'ratio': '{random}'}}}], f)
+            f.flush()
+            templates = ArgumentTemplates.from_file(f.name)
+        task_name, args, kwargs = templates.message(7, random.Random(0))
+        self.assertEqual(task_name, 'plugin.task')
+        self.assertEqual(args, [7, 'report-7'])
+        self.assertIn(kwargs['size'], (1, 2, 3))
+        uuid.UUID(kwargs['key'])
+        self.assertIsInstance(kwargs['options']['ratio'], float)
+
+    def test_weights(self):
+        """Check that templates are picked according to their weight."""
+        templates = ArgumentTemplates([{'task': 'a', 'weight': 0}, {'task': 'b'}])
+        self.assertEqual({templates.message(n)[0] for n in range(20)}, {'b'})
+
+
+class LoadTest(unittest.TestCase):
+    """Test for synthetic load of an embedded worker."""
+
+    def setUp(self):
+        self.app = Celery('load_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://')
+        self.label = self.app.task(name='load_test_app.text.label', shared=False)(_label)
+        self.slow = self.app.task(name='load_test_app.text.slow', shared=False)(_slow)
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_steps(self):
+        """Check that messages are sent at the rate or in the bursts of each step, and that their
+        results are measured."""
+        templates = ArgumentTemplates([{'task': 'text.label', 'args': ['{randint:1:9}', 'x']}])
+        results = run_load(self.app, templates, [{'rate': 50, 'duration': 0.2},
+                                                 {'burst': 5, 'interval': 0.1, 'duration': 0.2}])
+        self.assertEqual([(result['step'], result['sent'], result['succeeded'])
+                          for result in results],
+                         [('rate 50/s', 10, 10), ('burst 5/0.1s', 10, 10)])
+        for result in results:
+            self.assertLessEqual(result['latency_p50'], result['latency_p99'])
+            self.assertFalse(result['saturated'])
+        self.assertIn('Saturation throughput', format_load_results(results))
+
+    def test_saturation(self):
+        """Check that steps stop once workers cannot keep up with the offered rate."""
+        templates = ArgumentTemplates([{'task': self.slow.name}])
+        results = run_load(self.app, templates, [{'rate': 100, 'duration': 0.3},
+                                                 {'rate': 200, 'duration': 0.3}])
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0]['saturated'])
+        self.assertLess(results[0]['throughput'], 25)
+        self.assertIn('rate 100/s', format_load_results(results))
+
+    def test_unknown_task(self):
+        """Check that templates of unknown tasks are rejected."""
+        with self.assertRaises(NotRegistered):
+            run_load(self.app, ArgumentTemplates([{'task': 'text.unknown'}]),
+                     [{'rate': 1, 'duration': 1}])
@@ -0,0 +1,127 @@
+"""Tests for the memo module."""
+
+
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.memo import MemoCache, PureTask, configure_memo_cache
+
+
+class MemoCacheTest(unittest.TestCase):
+    """Test for the cache of task results."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name) / 'memo.sqlite'
+        self.cache = MemoCache(self.path, max_bytes=100)
+
+    def test_key(self):
+        """Check that keys depend on the task and arguments, not on keyword arguments order."""
+        key = MemoCache.key('task', (1, 'a'), {'x': 1, 'y': [2]})
+        self.assertEqual(key, MemoCache.key('task', [1, 'a'], {'y': [2], 'x': 1}))
+        self.assertNotEqual(key, MemoCache.key('other_task', (1, 'a'), {'x': 1, 'y': [2]}))
+        self.assertNotEqual(key, MemoCache.key('task', (1, 'b'), {'x': 1, 'y': [2]}))
+        self.assertIsNone(MemoCache.key('task', (object(),), {}))
+
+    def test_hits_and_misses(self):
+        """Check that cached results are found, and that hits and misses are counted."""
+        key = MemoCache.key('task', (1,), {})
+        self.assertEqual(self.cache.get('task', key), (False, None))
+        self.cache.set('task', key, {'result': [1, 2]})
+        self.assertEqual(self.cache.get('task', key), (True, {'result': [1, 2]}))
+        self.assertEqual(self.cache.stats(), {'task': {'hits': 1, 'misses': 1, 'entries': 1,
+                                                       'bytes': 16}})
+        self.assertIn('excewo_memo_hits_total{task="task"} 1', self.cache.as_prometheus_text())
+
+    def test_read_only_lookups(self):
+        """Check that lookups do not write to the database, and that their counts are written
+        later."""
+        key = MemoCache.key('task', (1,), {})
+        self.cache.set('task', key, 1)
+        self.cache.get('task', key)
+        other_connection = sqlite3.connect(self.path.as_posix(), timeout=0,
+                                           isolation_level=None)
+        self.addCleanup(other_connection.close)
+        other_connection.execute('BEGIN IMMEDIATE')  # Held until the end of the transaction
+        self.cache.stats_flush_interval = 60
+        self.assertEqual(self.cache.get('task', key), (True, 1))
+        other_connection.execute('ROLLBACK')
+        self.assertEqual(self.cache.stats()['task']['hits'], 2)
+
+    def test_ttl(self):
+        """Check that results expire after their time to live."""
+        key = MemoCache.key('task', (1,), {})
+        self.cache.set('task', key, 1, ttl=0.05)
+        self.assertEqual(self.cache.get('task', key), (True, 1))
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get('task', key), (False, None))
+        self.assertNotIn('task', [task for task, stats in self.cache.stats().items()
+                                  if stats['entries']])
+
+    def test_lru_eviction(self):
+        """Check that least recently used results are evicted when the cache is full."""
+        keys = [MemoCache.key('task', (i,), {}) for i in range(4)]
+        for key in keys[:3]:
+            self.cache.set('task', key, 'x' * 28)  # 30 bytes in JSON
+            time.sleep(0.01)
+        self.cache.get('task', keys[0])
+        self.cache.set('task', keys[3], 'x' * 28)
+        self.assertEqual([self.cache.get('task', key)[0] for key in keys],
+                         [True, False, True, True])
+        self.cache.set('task', keys[1], 'x' * 200)  # Larger than the cache
+        self.assertFalse(self.cache.get('task', keys[1])[0])
+
+    def test_shared_by_processes(self):
+        """Check that results cached by a forked process are found by others."""
+        if not hasattr(os, 'fork'):
+            self.skipTest('Only testing pool processes where fork is available')
+        key = MemoCache.key('task', (1,), {})
+        self.cache.get('task', key)  # Opens a connection before forking
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                self.cache.set('task', key, 'from child')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get('task', key), (True, 'from child'))
+
+
+class PureTaskTest(unittest.TestCase):
+    """Test for pure tasks."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        configure_memo_cache(MemoCache(pathlib.Path(tmp_dir.name) / 'memo.sqlite'))
+        self.addCleanup(configure_memo_cache, None)
+        self.app = Celery('memo_test_app', set_as_current=False)
+        self.calls = []
+
+        @self.app.task(bind=True, pure=True, shared=False)
+        def square(task, x):
+            self.calls.append(task.request.id)
+            return x * x
+
+        self.square = square
+
+    def test_cache_hit_skips_execution(self):
+        """Check that a pure task is only executed once for the same arguments."""
+        self.assertIsInstance(self.square, PureTask)
+        self.assertEqual(self.square.apply((3,), task_id='first').result, 9)
+        self.assertEqual(self.square.apply((3,), task_id='second').result, 9)
+        self.assertEqual(self.square.apply((4,), task_id='third').result, 16)
+        self.assertEqual(self.calls, ['first', 'third'])
+
+    def test_no_cache(self):
+        """Check that pure tasks are executed each time when caching is disabled."""
+        configure_memo_cache(None)
+        self.square.apply((3,))
+        self.square.apply((3,))
+        self.assertEqual(len(self.calls), 2)
@@ -0,0 +1,156 @@
+"""Tests for the metrics module."""
+
+
+from unittest.mock import patch
+import os
+import threading
+import time
+import unittest
+import urllib.request
+
+from celery import signals
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.metrics import (
+    PUBLISHED_AT_HEADER,
+    TaskMetrics,
+    _MetricsServer,
+    stamp_publish_time,
+)
+
+
+class TaskMetricsTest(unittest.TestCase):
+    """Test for task metrics."""
+
+    def setUp(self):
+        self.app = Celery('metrics_test_app')
+
+        @self.app.task
+        def add(x, y):
+            return x + y
+
+        @self.app.task
+        def fail():
+            pass
+
+        self.add = add
+        self.failing = fail
+        self.metrics = TaskMetrics([add.name, fail.name], processes=2)
+        for signal, handler in ((signals.task_prerun, self.metrics.on_task_prerun),
+                                (signals.task_postrun, self.metrics.on_task_postrun),
+                                (signals.task_failure, self.metrics.on_task_failure)):
+            signal.connect(handler, weak=False)
+            self.addCleanup(signal.disconnect, handler)
+
+    def test_counters(self):
+        """Check that started, succeeded and failed tasks are counted."""
+        self.add.apply((1, 2))
+        self.add.apply((3, 4))
+        self.failing.apply()
+        signals.task_failure.send(sender=self.failing, task_id='failed', exception=RuntimeError())
+        started, succeeded, failed, retried = self.metrics.totals(self.add.name)[:4]
+        self.assertEqual((started, succeeded, failed, retried), (2, 2, 0, 0))
+        started, succeeded, failed, retried = self.metrics.totals(self.failing.name)[:4]
+        self.assertEqual((started, succeeded, failed, retried), (1, 1, 1, 0))
+
+    def test_queue_wait(self):
+        """Check that queue wait time is measured from the publish time header."""
+        self.add.apply((1, 2), headers={PUBLISHED_AT_HEADER: time.time() - 2})
+        text = self.metrics.as_prometheus_text()
+        self.assertIn('excewo_task_queue_wait_seconds_bucket{{task="{}",le="1.0"}} 0'.format(
+            self.add.name
+        ), text)
+        self.assertIn('excewo_task_queue_wait_seconds_bucket{{task="{}",le="2.5"}} 1'.format(
+            self.add.name
+        ), text)
+        self.assertIn('excewo_task_queue_wait_seconds_count{{task="{}"}} 1'.format(self.add.name),
+                      text)
+
+    def test_untracked_tasks(self):
+        """Check that tasks which were not given are ignored."""
+        @self.app.task
+        def untracked():
+            pass
+
+        untracked.apply()
+        self.assertNotIn(untracked.name, self.metrics.as_prometheus_text())
+
+    def test_pool_processes_are_summed(self):
+        """Check that metrics written by forked pool processes are summed up."""
+        if not hasattr(os, 'fork'):
+            self.skipTest('Only testing pool processes where fork is available')
+        self.add.apply((1, 2))
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                with patch('extensible_celery_worker.metrics.current_process') as process:
+                    process.return_value.index = 1
+                    self.metrics.use_process_slot()
+                self.add.apply((1, 2))
+                signals.task_failure.send(sender=self.failing, task_id='failed',
+                                          exception=RuntimeError())
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.metrics.totals(self.add.name)[:2], [2, 2])
+        self.assertEqual(self.metrics.totals(self.failing.name)[2], 1)
+
+    def test_added_tasks(self):
+        """Check that tasks added later are tracked, and that values written before, also by pool
+        processes forked before, are kept."""
+        if not hasattr(os, 'fork'):
+            self.skipTest('Only testing pool processes where fork is available')
+
+        @self.app.task
+        def reloaded():
+            pass
+
+        self.add.apply((1, 2))
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                with patch('extensible_celery_worker.metrics.current_process') as process:
+                    process.return_value.index = 0
+                    self.metrics.use_process_slot()
+                time.sleep(0.2)  # Still running its task while tasks are added
+                self.add.apply((1, 2))
+            finally:
+                os._exit(0)
+        self.metrics.add_tasks([self.add.name, reloaded.name])
+        self.add.apply((1, 2))
+        reloaded.apply()
+        os.waitpid(pid, 0)
+        self.assertEqual(self.metrics.totals(self.add.name)[:2], [3, 3])
+        self.assertEqual(self.metrics.totals(reloaded.name)[:2], [1, 1])
+        self.assertIn('excewo_task_started_total{{task="{}"}} 1'.format(reloaded.name),
+                      self.metrics.as_prometheus_text())
+
+    def test_stamp_publish_time(self):
+        """Check that the publish time header is added, unless already there."""
+        headers = {}
+        stamp_publish_time(headers=headers)
+        self.assertAlmostEqual(headers[PUBLISHED_AT_HEADER], time.time(), delta=1)
+        headers = {PUBLISHED_AT_HEADER: 1.0}
+        stamp_publish_time(headers=headers)
+        self.assertEqual(headers[PUBLISHED_AT_HEADER], 1.0)
+
+
+class MetricsServerTest(unittest.TestCase):
+    """Test for the metrics HTTP listener."""
+
+    def test_metrics_endpoint(self):
+        """Check that metrics are served in the Prometheus text format."""
+        metrics = TaskMetrics(['my_worker.plugin.task'])
+        server = _MetricsServer(('127.0.0.1', 0), metrics)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with patch('logging.debug'), urllib.request.urlopen(url, timeout=5) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            body = response.read().decode('utf-8')
+        self.assertIn('# TYPE excewo_task_started_total counter', body)
+        self.assertIn('excewo_task_started_total{task="my_worker.plugin.task"} 0', body)
+        self.assertIn('excewo_task_runtime_seconds_bucket{task="my_worker.plugin.task",'
+                      'le="+Inf"} 0', body)
@@ -0,0 +1,220 @@
+"""Tests for the plugins module."""
+
+
+from unittest.mock import patch
+import hashlib
+import os
+import pathlib
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from extensible_celery_worker import app
+from extensible_celery_worker.plugins import (
+    LazyPluginTask,
+    load_manifest,
+    register_lazy_tasks,
+    save_manifest,
+    scan_plugins,
+)
+
+
+_PLUGIN_MODULE = 'excewo_lazy_test_plugin'
+
+_CONCURRENT_PLUGIN_MODULE = 'excewo_concurrent_lazy_test_plugin'
+
+
+class LazyPluginTaskTest(unittest.TestCase):
+    """Test for lazily registered plugin tasks."""
+
+    def setUp(self):
+        self.app = app
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = pathlib.Path(tmp_dir.name)
+        (self.tmp_path / '{}.py'.format(_PLUGIN_MODULE)).write_text(textwrap.dedent('''
+            from celery import Task
+
+            from extensible_celery_worker import app
+
+
+            calls = []
+
+
+            class RecordingTask(Task):
+
+                def __call__(self, *args, **kwargs):
+                    calls.append('__call__')
+                    return super().__call__(*args, **kwargs)
+
+                def on_success(self, retval, task_id, args, kwargs):
+                    calls.append(('on_success', retval))
+
+                def after_return(self, status, retval, task_id, args, kwargs, einfo):
+                    calls.append(('after_return', status))
+
+
+            @app.task(acks_late=True)
+            def answer():
+                return 42
+
+
+            @app.task(base=RecordingTask)
+            def recorded():
+                return 'recorded'
+        '''))
+        sys.path.insert(0, tmp_dir.name)
+        self.addCleanup(sys.path.remove, tmp_dir.name)
+        self.addCleanup(sys.modules.pop, _PLUGIN_MODULE, None)
+        self.task_name = self.app.gen_task_name('answer', _PLUGIN_MODULE)
+        self.recorded_task_name = self.app.gen_task_name('recorded', _PLUGIN_MODULE)
+        for task_name in (self.task_name, self.recorded_task_name):
+            self.addCleanup(self.app.tasks.pop, task_name, None)
+        self.records = [{
+            'name': 'lazy_test',
+            'module': _PLUGIN_MODULE,
+            'tasks': {self.task_name: {'acks_late': True}, self.recorded_task_name: {}},
+            'import_seconds': 0.0,
+            'rss_bytes': 0,
+        }]
+
+    def test_register_lazy_tasks(self):
+        """Check that stand-in tasks are registered without importing the plugin module."""
+        register_lazy_tasks(self.app, self.records)
+        self.assertNotIn(_PLUGIN_MODULE, sys.modules)
+        self.assertIsInstance(self.app.tasks[self.task_name], LazyPluginTask)
+        self.assertTrue(self.app.tasks[self.task_name].acks_late)
+
+    def test_lazy_task_execution(self):
+        """Check that executing a stand-in task imports the plugin module and runs the real task."""
+        register_lazy_tasks(self.app, self.records)
+        self.assertEqual(self.app.tasks[self.task_name].apply().result, 42)
+        self.assertIn(_PLUGIN_MODULE, sys.modules)
+        # The stand-in stays registered so that worker tracers remain valid
+        self.assertIsInstance(self.app.tasks[self.task_name], LazyPluginTask)
+
+    def test_real_task_handlers(self):
+        """Check that the custom ``__call__()`` and handlers of the real task are called."""
+        register_lazy_tasks(self.app, self.records)
+        self.assertEqual(self.app.tasks[self.recorded_task_name].apply().result, 'recorded')
+        self.assertEqual(sys.modules[_PLUGIN_MODULE].calls,
+                         ['__call__', ('on_success', 'recorded'), ('after_return', 'SUCCESS')])
+
+    def test_lookup_during_import(self):
+        """Check that a task looked up while its plugin module is imported on demand is found."""
+        (self.tmp_path / '{}.py'.format(_CONCURRENT_PLUGIN_MODULE)).write_text(textwrap.dedent('''
+            import threading
+
+            from extensible_celery_worker import app
+
+
+            # Look the task up in another thread while this module is imported
+            looked_up = []
+            lookup = threading.Thread(target=lambda: looked_up.append(app.tasks[{!r}]))
+            lookup.start()
+            lookup.join(0.1)
+
+
+            @app.task
+            def answer():
+                return 42
+        '''.format(self.app.gen_task_name('answer', _CONCURRENT_PLUGIN_MODULE))))
+        self.addCleanup(sys.modules.pop, _CONCURRENT_PLUGIN_MODULE, None)
+        task_name = self.app.gen_task_name('answer', _CONCURRENT_PLUGIN_MODULE)
+        self.addCleanup(self.app.tasks.pop, task_name, None)
+        stand_in, = register_lazy_tasks(self.app, [{
+            'name': 'concurrent_lazy_test',
+            'module': _CONCURRENT_PLUGIN_MODULE,
+            'tasks': {task_name: {}},
+            'import_seconds': 0.0,
+            'rss_bytes': 0,
+        }])
+        self.assertEqual(stand_in.apply().result, 42)
+        plugin_module = sys.modules[_CONCURRENT_PLUGIN_MODULE]
+        plugin_module.lookup.join(5)
+        self.assertEqual(plugin_module.looked_up, [stand_in])
+
+    def test_already_registered_tasks(self):
+        """Check that tasks from already imported plugin modules are not replaced by stand-ins."""
+        __import__(_PLUGIN_MODULE)
+        real_task = self.app.tasks[self.task_name]
+        self.assertEqual(register_lazy_tasks(self.app, self.records), [])
+        self.assertIs(self.app.tasks[self.task_name], real_task)
+
+
+class PluginManifestTest(unittest.TestCase):
+    """Test for the plugin manifest cache."""
+
+    def setUp(self):
+        self.app = app
+        self.app.main = 'default_extensible_celery_worker_app'
+        self.addCleanup(setattr, self.app, 'main', 'default_extensible_celery_worker_app')
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.manifest_path = pathlib.Path(tmp_dir.name) / 'plugins.json'
+        self.plugin_path = pathlib.Path(tmp_dir.name) / 'plugin.py'
+        self.plugin_path.write_text('"""Plugin."""\n')
+        self.records = [{
+            'name': 'manifest_test',
+            'module': 'excewo_manifest_test_plugin',
+            'tasks': {'default_extensible_celery_worker_app.manifest_test.answer': {}},
+            'files': {self.plugin_path.as_posix(): {
+                'mtime_ns': self.plugin_path.stat().st_mtime_ns,
+                'size': self.plugin_path.stat().st_size,
+                'sha256': hashlib.sha256(self.plugin_path.read_bytes()).hexdigest(),
+            }},
+            'import_seconds': 0.0,
+            'rss_bytes': 0,
+        }]
+
+    def test_no_manifest(self):
+        """Check that nothing is loaded when the manifest does not exist."""
+        self.assertIsNone(load_manifest(self.manifest_path, self.app))
+
+    def test_manifest_round_trip(self):
+        """Check that saved plugin records are loaded back."""
+        save_manifest(self.manifest_path, self.app, self.records)
+        self.assertEqual(load_manifest(self.manifest_path, self.app), self.records)
+
+    def test_manifest_not_saved_with_failed_plugin(self):
+        """Check that the manifest is not saved when a plugin could not be imported."""
+        failed_record = dict(self.records[0], name='failed', tasks={}, files={},
+                             error='ImportError: No module named excewo_missing')
+        with patch('logging.warning'):
+            save_manifest(self.manifest_path, self.app, self.records + [failed_record])
+        self.assertFalse(self.manifest_path.exists())
+
+    def test_manifest_app_name_changed(self):
+        """Check that the manifest is outdated when the application name changes."""
+        save_manifest(self.manifest_path, self.app, self.records)
+        self.app.main = 'my_worker'
+        self.assertIsNone(load_manifest(self.manifest_path, self.app))
+
+    def test_manifest_plugin_file_changed(self):
+        """Check that the manifest is outdated when a plugin source file changes."""
+        save_manifest(self.manifest_path, self.app, self.records)
+        self.plugin_path.write_text('"""Changed plugin."""\n')
+        self.assertIsNone(load_manifest(self.manifest_path, self.app))
+
+    def test_manifest_plugin_file_touched(self):
+        """Check that the manifest remains valid when a plugin source file is only touched."""
+        save_manifest(self.manifest_path, self.app, self.records)
+        stat = self.plugin_path.stat()
+        os.utime(self.plugin_path.as_posix(), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(load_manifest(self.manifest_path, self.app), self.records)
+
+    def test_scan_example_plugin(self):
+        """Check that scanning installed plugins finds the example tasks."""
+        sys.modules.pop('extensible_celery_worker.examples.tasks', None)
+        task_name = 'default_extensible_celery_worker_app.examples.always_true'
+        self.app.tasks.pop(task_name, None)
+        records = {record['name']: record for record in scan_plugins(self.app)}
+        self.assertIn(task_name, records['examples']['tasks'])
+        self.assertTrue(any(path.endswith('tasks.py') for path in records['examples']['files']))
+
+    def test_scan_plugin_subset(self):
+        """Check that only plugins with the given names are scanned."""
+        self.assertEqual(scan_plugins(self.app, plugin_names=[]), [])
+        records = scan_plugins(self.app, plugin_names=['examples'])
+        self.assertEqual([record['name'] for record in records], ['examples'])
@@ -0,0 +1,57 @@
+"""Tests for the preload module."""
+
+
+from unittest.mock import patch
+import os
+import platform
+import unittest
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.memory import memory_usage
+from extensible_celery_worker.preload import preload_plugins
+
+
+class PreloadPluginsTest(unittest.TestCase):
+    """Test for plugin preloading."""
+
+    def setUp(self):
+        self.app = Celery('preload_test_app')
+
+    def test_warm_up_decorator(self):
+        """Check that the ``warm_up`` decorator registers the function and returns it unchanged."""
+        def load_model():
+            pass
+        self.assertIs(self.app.warm_up(load_model), load_model)
+        self.assertEqual(self.app.warm_ups, [load_model])
+
+    def test_warm_ups_are_called(self):
+        """Check that preloading plugins calls each warm-up function, even if one fails."""
+        calls = []
+
+        @self.app.warm_up
+        def failing():
+            raise RuntimeError('Cannot warm up')
+
+        @self.app.warm_up
+        def succeeding():
+            calls.append('succeeding')
+
+        # Do not connect signal handlers that would freeze the heap of the test process
+        with patch('logging.exception'), \
+                patch('extensible_celery_worker.preload.signals'):
+            preload_plugins(self.app)
+        self.assertEqual(calls, ['succeeding'])
+
+
+class MemoryUsageTest(unittest.TestCase):
+    """Test for the memory_usage function."""
+
+    def test_memory_usage(self):
+        """Check that memory usage of the current process is consistent."""
+        if platform.system() != 'Linux':
+            self.skipTest('Only testing memory usage under Linux')
+        usage = memory_usage(os.getpid())
+        self.assertGreater(usage['rss'], 0)
+        self.assertLessEqual(usage['uss'], usage['pss'])
+        self.assertLessEqual(usage['pss'], usage['rss'])
+        self.assertEqual(usage['uss'] + usage['shared'], usage['rss'])
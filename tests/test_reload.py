@@ -0,0 +1,110 @@
+"""Tests for the reload module and the plugin reloader."""
+
+
+from importlib.metadata import EntryPoint
+from unittest.mock import patch
+import pathlib
+import sys
+import tempfile
+import textwrap
+import time
+import types
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.plugins import PluginReloader, scan_plugins
+from extensible_celery_worker.reload import configure_plugin_reload
+
+
+_APP_MODULE = 'excewo_reload_test_app'
+
+_PLUGIN_MODULE = 'excewo_reload_test_plugin'
+
+_PLUGIN_SOURCE = '''
+from {app_module} import app
+
+
+@app.task(name='reload_test_app.plugin.answer', shared=False)
+def answer():
+    return {answer!r}
+'''
+
+
+class PluginReloaderTest(unittest.TestCase):
+    """Test for plugin reloads."""
+
+    def setUp(self):
+        self.app = Celery('reload_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        app_module = types.ModuleType(_APP_MODULE)
+        app_module.app = self.app
+        sys.modules[_APP_MODULE] = app_module
+        self.addCleanup(sys.modules.pop, _APP_MODULE, None)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.plugin_path = pathlib.Path(tmp_dir.name) / '{}.py'.format(_PLUGIN_MODULE)
+        self._write_plugin(1)
+        sys.path.insert(0, tmp_dir.name)
+        self.addCleanup(sys.path.remove, tmp_dir.name)
+        self.addCleanup(sys.modules.pop, _PLUGIN_MODULE, None)
+        self.entry_points = [EntryPoint('reload_test', _PLUGIN_MODULE, 'excewo.tasks')]
+        patcher = patch('extensible_celery_worker.plugins.task_plugin_entry_points',
+                        lambda: self.entry_points)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reloader = PluginReloader(self.app, scan_plugins(self.app))
+
+    def _write_plugin(self, answer, source=_PLUGIN_SOURCE):
+        """Write the source of the test plugin, whose task returns the given answer."""
+        self.plugin_path.write_text(textwrap.dedent(source.format(app_module=_APP_MODULE,
+                                                                  answer=answer)))
+
+    def _answer(self):
+        return self.app.tasks['reload_test_app.plugin.answer'].run()
+
+    def test_unchanged(self):
+        """Check that nothing is reloaded when plugins did not change."""
+        self.assertEqual(self.reloader.outdated_plugins(), [])
+        self.assertEqual(self.reloader.reload(), set())
+
+    def test_changed(self):
+        """Check that a changed plugin is imported again and its tasks replaced."""
+        self._write_plugin('two')
+        self.assertEqual(self.reloader.outdated_plugins(), ['reload_test'])
+        self.assertEqual(self.reloader.reload(), {'reload_test_app.plugin.answer'})
+        self.assertEqual(self._answer(), 'two')
+        self.assertEqual(self.reloader.outdated_plugins(), [])
+
+    def test_removed(self):
+        """Check that tasks of a removed plugin are unregistered."""
+        self.entry_points = []
+        self.assertEqual(self.reloader.reload(), {'reload_test_app.plugin.answer'})
+        self.assertNotIn('reload_test_app.plugin.answer', self.app.tasks)
+        self.assertNotIn(_PLUGIN_MODULE, sys.modules)
+
+    def test_broken(self):
+        """Check that the previous version of a plugin which cannot be imported is kept."""
+        self._write_plugin(3, source=_PLUGIN_SOURCE + '\nraise ValueError("broken")\n')
+        with patch('logging.exception'), patch('logging.warning') as warning:
+            self.assertEqual(self.reloader.reload(), set())
+        self.assertIn('Keeping the previous version', warning.call_args[0][0])
+        self.assertEqual(self._answer(), 1)
+        self.assertEqual(self.reloader.outdated_plugins(), [])
+
+    def test_worker(self):
+        """Check that a worker watching plugin files runs the new version of a changed task."""
+        configure_plugin_reload(self.app, self.reloader, watch_interval=0.01)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            task = self.app.signature('reload_test_app.plugin.answer')
+            self.assertEqual(task.delay().get(timeout=10), 1)
+            self._write_plugin('two')
+            deadline = time.monotonic() + 10
+            while task.delay().get(timeout=10) != 'two':
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.1)
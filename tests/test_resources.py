@@ -0,0 +1,90 @@
+"""Tests for the resources module."""
+
+
+from unittest.mock import patch
+import os
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.resources import set_up_resources, tear_down_resources
+
+
+def _is_open(task):
+    """Return whether the connection resource of the task application is open."""
+    return task.app.resources['connection'].get()['open']
+
+
+class ResourceTest(unittest.TestCase):
+    """Test for resources managed in worker processes."""
+
+    def setUp(self):
+        self.app = Celery('resources_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.events = []
+        patcher = patch('logging.info')
+        self.info = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        @self.app.resource(name='connection')
+        def connection():
+            self.events.append('connect')
+            yield {'open': True}
+            self.events.append('close')
+
+        @self.app.resource(name='pattern')
+        def compiled_pattern():
+            self.events.append('compile')
+            return 'compiled'
+
+        self.connection = connection
+        self.pattern = compiled_pattern
+
+    def test_get(self):
+        """Check that resources are set up once, on first use."""
+        self.assertEqual(self.connection.get(), {'open': True})
+        self.assertIs(self.connection.get(), self.connection.get())
+        self.assertEqual(self.events, ['connect'])
+        self.assertIsNotNone(self.connection.setup_seconds)
+        self.assertEqual(sorted(self.app.resources), ['connection', 'pattern'])
+        self.assertEqual(self.app.resource(_is_open).name, 'test_resources._is_open')
+
+    def test_set_up_and_tear_down(self):
+        """Check that all resources are set up and torn down together."""
+        set_up_resources(self.app)
+        self.assertEqual(self.events, ['connect', 'compile'])
+        self.assertIn('Set up 2 resources', self.info.call_args[0][0])
+        tear_down_resources(self.app)
+        self.assertEqual(self.events, ['connect', 'compile', 'close'])
+        self.connection.get()
+        self.assertEqual(self.events[-1], 'connect')
+
+    def test_fork(self):
+        """Check that forked processes set up resources of their own, and do not tear down
+        resources of their parent."""
+        parent_connection = self.connection.get()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:  # Child process
+            try:
+                tear_down_resources(self.app)
+                same = self.connection.get() is parent_connection
+                os.write(write_fd, repr((same, self.events)).encode())
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as child_output:
+            self.assertEqual(child_output.read(), repr((False, ['connect', 'connect'])))
+        self.assertEqual(self.events, ['connect'])
+
+    def test_worker(self):
+        """Check that resources are set up when the worker starts its pool, and that tasks get
+        them."""
+        task = self.app.task(name='resources_test_app.db.is_open', bind=True,
+                             shared=False)(_is_open)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            self.assertTrue(task.delay().get(timeout=10))
+        self.assertEqual(self.events, ['connect', 'compile'])
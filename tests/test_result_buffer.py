@@ -0,0 +1,104 @@
+"""Tests for the result_buffer module."""
+
+
+from unittest.mock import patch
+import time
+import unittest
+
+from celery.app.task import Context
+from celery.contrib.testing.worker import start_worker
+from celery.states import FAILURE, PENDING, STARTED, SUCCESS
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker import result_buffer as result_buffer_module
+from extensible_celery_worker.result_buffer import ResultBuffer, configure_result_buffering
+
+
+def _double(x):
+    return 2 * x
+
+
+class ResultBufferTest(unittest.TestCase):
+    """Test for the buffer of task results."""
+
+    def setUp(self):
+        self.app = Celery('result_buffer_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.double = self.app.task(name='result_buffer_test_app.math.double',
+                                    shared=False)(_double)
+        self.backend = self.app.backend
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _buffer(self, **kwargs):
+        result_buffer = ResultBuffer(self.backend, **kwargs)
+        result_buffer.install()
+        self.addCleanup(vars(self.backend).pop, 'store_result', None)
+        return result_buffer
+
+    def _state(self, task_id):
+        return self.backend.get_task_meta(task_id, cache=False)['status']
+
+    def test_size(self):
+        """Check that results are written once the buffer is full."""
+        self._buffer(size=3, delay=60)
+        request = Context(task=self.double.name)
+        for task_id in ('a', 'b'):
+            self.backend.mark_as_done(task_id, 2, request=request)
+        self.assertEqual(self._state('a'), PENDING)
+        self.backend.mark_as_done('c', 2, request=request)
+        self.assertEqual([self._state(task_id) for task_id in 'abc'], [SUCCESS] * 3)
+
+    def test_delay(self):
+        """Check that results are written once the oldest one is old enough."""
+        self._buffer(size=100, delay=0.05)
+        self.backend.mark_as_done('a', 2, request=Context(task=self.double.name))
+        deadline = time.monotonic() + 5
+        while self._state('a') != SUCCESS and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self._state('a'), SUCCESS)
+
+    def test_coalesce(self):
+        """Check that only the last state of a task in a batch is written, if coalescing."""
+        request = Context(task=self.double.name)
+        for coalesce, writes in ((True, 1), (False, 2)):
+            result_buffer = self._buffer(size=100, delay=60, coalesce=coalesce)
+            with patch.object(self.backend, '_set_with_state',
+                              wraps=self.backend._set_with_state) as set_with_state:
+                self.backend.store_result(str(coalesce), None, STARTED, request=request)
+                self.backend.mark_as_done(str(coalesce), 2, request=request)
+                result_buffer.flush()
+            self.assertEqual(set_with_state.call_count, writes)
+            self.assertEqual(self._state(str(coalesce)), SUCCESS)
+
+    def test_success_kept(self):
+        """Check that successful results are not overwritten."""
+        result_buffer = self._buffer(size=100, delay=60)
+        self.backend.mark_as_done('a', 2)
+        self.backend.mark_as_failure('a', ValueError(), request=Context(task=self.double.name))
+        result_buffer.flush()
+        self.assertEqual(self._state('a'), SUCCESS)
+
+    def test_write_through(self):
+        """Check that results of chord header tasks and of tasks acknowledged late are written
+        immediately, after results buffered before them."""
+        result_buffer = self._buffer(size=100, delay=60)
+        self.assertFalse(result_buffer.buffers(Context(task=self.double.name,
+                                                       chord={'task': 'callback'})))
+        self.backend.mark_as_done('a', 2, request=Context(task=self.double.name))
+        self.double.acks_late = True
+        self.backend.mark_as_failure('b', ValueError(), request=Context(task=self.double.name))
+        self.assertEqual([self._state('a'), self._state('b')], [SUCCESS, FAILURE])
+
+    def test_worker(self):
+        """Check that results of tasks run by workers are buffered, and can be waited for."""
+        configure_result_buffering(self.app, size=100, delay=0.05)
+        self.addCleanup(configure_result_buffering, self.app, None)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            result = (self.double.s(1) | self.double.s()).delay()
+            self.assertEqual(result.get(timeout=10), 4)
+            self.assertEqual(self.double.delay(3).get(timeout=10), 6)
+        self.assertTrue(any(result_buffer.backend.app is self.app
+                            for result_buffer in result_buffer_module._buffers))
@@ -0,0 +1,78 @@
+"""Tests for the routing module."""
+
+
+from unittest.mock import patch
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.routing import configure_plugin_queues, plugin_name
+
+
+def _task_name(self):
+    """Return the name of the task."""
+    return self.name
+
+
+class PluginQueuesTest(unittest.TestCase):
+    """Test for automatic per-plugin queues and routes."""
+
+    def setUp(self):
+        self.app = Celery('routing_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        for task_name in ('routing_test_app.reports.build', 'routing_test_app.exports.csv',
+                          'routing_test_app.fast.ping'):
+            self.app.task(name=task_name, bind=True)(_task_name)
+
+    def _queue(self, task_name):
+        """Return the name of the queue the given task is routed to."""
+        return self.app.amqp.router.route({}, task_name)['queue'].name
+
+    def test_plugin_name(self):
+        """Check that the plugin name is found in task names."""
+        self.assertEqual(plugin_name(self.app, 'routing_test_app.reports.build'), 'reports')
+        self.assertIsNone(plugin_name(self.app, 'celery.ping'))
+        self.assertIsNone(plugin_name(self.app, 'routing_test_app.orphan'))
+
+    def test_one_queue_per_plugin(self):
+        """Check that tasks of each plugin are routed to a queue of their own."""
+        with patch('logging.info'):
+            configure_plugin_queues(self.app)
+        self.assertEqual(self._queue('routing_test_app.reports.build'), 'routing_test_app.reports')
+        self.assertEqual(self._queue('routing_test_app.fast.ping'), 'routing_test_app.fast')
+        # Shared tasks from other test modules may add other queues
+        self.assertLessEqual({'celery', 'routing_test_app.reports', 'routing_test_app.exports',
+                              'routing_test_app.fast'}, set(self.app.amqp.queues.consume_from))
+
+    def test_shared_queue(self):
+        """Check that plugins can share a queue."""
+        with patch('logging.info'):
+            plugin_queues = configure_plugin_queues(self.app, {'slow': ['reports', 'exports']})
+        self.assertEqual(plugin_queues['reports'], 'routing_test_app.slow')
+        self.assertEqual(self._queue('routing_test_app.reports.build'), 'routing_test_app.slow')
+        self.assertEqual(self._queue('routing_test_app.exports.csv'), 'routing_test_app.slow')
+        self.assertEqual(self._queue('routing_test_app.fast.ping'), 'routing_test_app.fast')
+
+    def test_configured_routes_win(self):
+        """Check that routes given in the Celery configuration take precedence."""
+        self.app.conf.task_routes = {'routing_test_app.fast.*': {'queue': 'celery'}}
+        with patch('logging.info'):
+            configure_plugin_queues(self.app)
+        self.assertEqual(self._queue('routing_test_app.fast.ping'), 'celery')
+        self.assertEqual(self._queue('routing_test_app.reports.build'), 'routing_test_app.reports')
+
+    def test_queue_capacity(self):
+        """Check that a queue with a limited capacity is consumed on its own channel."""
+        with patch('logging.info'):
+            configure_plugin_queues(self.app, {'slow': ['reports', 'exports']}, {'slow': 2})
+        with start_worker(self.app, pool='solo', perform_ping_check=False) as worker:
+            result = self.app.send_task('routing_test_app.reports.build')
+            self.assertEqual(result.get(timeout=10), 'routing_test_app.reports.build')
+            consumer_step, = [step for step in worker.consumer.steps
+                              if type(step).__name__ == 'PluginQueueCapacityConsumer']
+            self.assertEqual([queue.name for queue in consumer_step.queues],
+                             ['routing_test_app.slow'])
+            self.assertNotIn('routing_test_app.slow', self.app.amqp.queues.consume_from)
+            self.assertEqual(consumer_step.consumers[0].channel.qos.prefetch_count, 2)
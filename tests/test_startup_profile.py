@@ -0,0 +1,82 @@
+"""Tests for the startup_profile module."""
+
+
+from unittest.mock import patch
+import contextlib
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import unittest
+
+from extensible_celery_worker.__main__ import main
+from extensible_celery_worker.startup_profile import phase, plugin_import, profiling
+
+
+class StartupProfileTest(unittest.TestCase):
+    """Test for startup profiles."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        (pathlib.Path(tmp_dir.name) / 'excewo_profiled_plugin.py').write_text(
+            'import excewo_profiled_dependency  # noqa\n'
+        )
+        (pathlib.Path(tmp_dir.name) / 'excewo_profiled_dependency.py').write_text('')
+        sys.path.insert(0, tmp_dir.name)
+        self.addCleanup(sys.path.remove, tmp_dir.name)
+        for module_name in ('excewo_profiled_plugin', 'excewo_profiled_dependency'):
+            self.addCleanup(sys.modules.pop, module_name, None)
+
+    def test_phases(self):
+        """Check that phases are recorded in order."""
+        with profiling() as profile:
+            with phase('first'):
+                pass
+            with phase('second'):
+                pass
+        self.assertEqual([entry['name'] for entry in profile.phases], ['first', 'second'])
+        self.assertGreaterEqual(profile.total_seconds,
+                                sum(entry['seconds'] for entry in profile.phases))
+
+    def test_no_active_profile(self):
+        """Check that phases are not recorded when no profile is active."""
+        with phase('ignored'):
+            pass
+        with profiling() as profile:
+            pass
+        self.assertEqual(profile.phases, [])
+
+    def test_plugin_import_tree(self):
+        """Check that modules imported by a plugin are recorded as a tree."""
+        with profiling() as profile:
+            with plugin_import('profiled', 'excewo_profiled_plugin'):
+                __import__('excewo_profiled_plugin')
+        imports = profile.plugins[0]['imports']
+        self.assertEqual([node['module'] for node in imports], ['excewo_profiled_plugin'])
+        self.assertEqual([node['module'] for node in imports[0]['imports']],
+                         ['excewo_profiled_dependency'])
+        self.assertGreaterEqual(imports[0]['cumulative_us'], imports[0]['self_us'])
+        self.assertIn('excewo_profiled_dependency', profile.as_text())
+        # The loader wrapper is not left behind
+        self.assertNotIn('_TimedLoader', type(sys.modules['excewo_profiled_plugin'].__loader__)
+                         .__name__)
+
+
+class ProfileStartupCommandTest(unittest.TestCase):
+    """Test for the ``profile-startup`` command."""
+
+    def test_json_output(self):
+        """Check that the ``profile-startup`` command outputs expected JSON."""
+        output = io.StringIO()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        with patch.object(sys, 'argv', ['excewo', 'profile-startup', '--format', 'json']), \
+                patch('extensible_celery_worker.__main__.user_cache_dir',
+                      return_value=pathlib.Path(cache_dir.name)), \
+                contextlib.redirect_stdout(output):
+            main()
+        profile = json.loads(output.getvalue())
+        self.assertEqual(profile['app_name'], 'default_extensible_celery_worker_app')
+        self.assertIn('config file discovery', [entry['name'] for entry in profile['phases']])
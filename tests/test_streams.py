@@ -0,0 +1,136 @@
+"""Tests for the streams module."""
+
+
+from unittest.mock import patch
+import os
+import tempfile
+import threading
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.blobs import BlobStore, configure_blob_store
+from extensible_celery_worker.streams import STREAM_KEY, StreamTask, _chunk_key
+
+
+_consumed = threading.Event()
+
+
+def _numbers(count):
+    yield from range(count)
+
+
+def _wait_for_client(count):
+    yield 0
+    # The client gets the first item before the task ends
+    if not _consumed.wait(timeout=10):
+        raise RuntimeError('The first item was not consumed')
+    yield from range(1, count)
+
+
+def _fail():
+    yield 1
+    raise ValueError('Stream broken')
+
+
+def _large():
+    yield 'x' * 2048
+    yield 'y'
+
+
+class StreamTaskTest(unittest.TestCase):
+    """Test for tasks streaming their results."""
+
+    def setUp(self):
+        self.app = Celery('streams_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.numbers = self.app.task(name='streams_test_app.export.numbers', shared=False)(_numbers)
+        _consumed.clear()
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_worker(self):
+        """Check that items are streamed in chunks, and read once."""
+        self.assertIsInstance(self.numbers, StreamTask)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            result = self.numbers.delay(250)
+            self.assertEqual(list(result.stream(timeout=10)), list(range(250)))
+            self.assertEqual(result.get(timeout=10), {STREAM_KEY: result.id, 'chunks': 3,
+                                                      'items': 250})
+        self.assertIsNone(self.app.backend.get(self.app.backend.get_key_for_task(
+            result.id, ':stream:0'
+        )))
+
+    def test_first_items(self):
+        """Check that clients get items while the task still runs."""
+        task = self.app.task(name='streams_test_app.export.wait_for_client',
+                             stream_flush_interval=0, shared=False)(_wait_for_client)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            items = task.delay(3).stream(timeout=10)
+            self.assertEqual(next(items), 0)
+            _consumed.set()
+            self.assertEqual(list(items), [1, 2])
+
+    def test_slow_producer(self):
+        """Check that items are written once the flush interval elapsed, without waiting for the
+        next item."""
+        task = self.app.task(name='streams_test_app.export.slow', stream_flush_interval=0.05,
+                             shared=False)(_wait_for_client)
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            items = task.delay(3).stream(timeout=5)
+            self.assertEqual(next(items), 0)
+            _consumed.set()
+            self.assertEqual(list(items), [1, 2])
+
+    def test_chunk_written_while_reading(self):
+        """Check that a chunk written between a read and the end of the task is found."""
+        backend = self.app.backend
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            result = self.numbers.delay(3)
+            result.get(timeout=10)
+        key = _chunk_key(backend, result.id, 0)
+        backend_get = backend.get
+        reads = []
+
+        def get(read_key):
+            # The first read of the chunk happens before the task writes it and ends
+            reads.append(read_key)
+            if read_key == key and reads.count(key) == 1:
+                return None
+            return backend_get(read_key)
+
+        with patch.object(backend, 'get', side_effect=get):
+            self.assertEqual(list(result.stream(timeout=10)), [0, 1, 2])
+        self.assertEqual(reads.count(key), 2)
+
+    def test_failure(self):
+        """Check that the exception of the task is raised after the items it yielded."""
+        task = self.app.task(name='streams_test_app.export.fail', stream_flush_interval=0,
+                             shared=False)(_fail)
+        items = []
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            with self.assertRaisesRegex(ValueError, 'Stream broken'):
+                for item in task.delay().stream(timeout=10):
+                    items.append(item)
+        self.assertEqual(items, [1])
+
+    def test_blobs(self):
+        """Check that large items are offloaded to the blob store."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = BlobStore(directory.name, threshold=1024)
+        configure_blob_store(store)
+        self.addCleanup(configure_blob_store, None)
+        task = self.app.task(name='streams_test_app.export.large', shared=False)(_large)
+        with patch.object(store, 'put', wraps=store.put) as put, \
+                start_worker(self.app, pool='solo', perform_ping_check=False):
+            self.assertEqual(list(task.delay().stream(timeout=10)), ['x' * 2048, 'y'])
+        put.assert_called_once_with('x' * 2048)
+        self.assertEqual([name for _, _, names in os.walk(directory.name) for name in names], [])
+
+    def test_call(self):
+        """Check that tasks called as functions return their generator."""
+        self.assertEqual(list(self.numbers(3)), [0, 1, 2])
@@ -0,0 +1,83 @@
+"""Tests for the task_profile module."""
+
+
+from unittest.mock import patch
+import pstats
+import tempfile
+import tracemalloc
+import unittest
+
+from celery import signals
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.task_profile import TaskProfiler, dump_task_profiles
+
+
+class TaskProfilerTest(unittest.TestCase):
+    """Test for the sampling profiler of tasks."""
+
+    def setUp(self):
+        self.app = Celery('task_profile_test_app', set_as_current=False)
+        self.cache = []
+
+        @self.app.task(name='task_profile_test_app.reports.build', shared=False)
+        def build(size):
+            self.cache.append([str(i) for i in range(size)])
+
+        @self.app.task(name='task_profile_test_app.reports.other', shared=False)
+        def other(size):
+            self.cache.append([str(i) for i in range(size)])
+
+        self.build = build
+        self.other = other
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _profiler(self, sample_rate):
+        profiler = TaskProfiler([self.build.name], sample_rate, self.directory)
+        for signal, handler in ((signals.task_prerun, profiler.on_task_prerun),
+                                (signals.task_postrun, profiler.on_task_postrun)):
+            signal.connect(handler, weak=False)
+            self.addCleanup(signal.disconnect, handler)
+        return profiler
+
+    def test_dump(self):
+        """Check that allocation sites and call statistics of profiled tasks are dumped."""
+        profiler = self._profiler(1.0)
+        self.build.apply((1000,))
+        self.build.apply((1000,))
+        self.other.apply((1000,))
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(len(list(profiler.raw_directory.iterdir())), 2)
+        output = dump_task_profiles(self.directory, self.directory + '/dump')
+        self.assertEqual(sorted(path.name for path in output.iterdir()), [
+            self.build.name + '.allocations.txt', self.build.name + '.cpu.txt',
+            self.build.name + '.pstats',
+        ])
+        allocations = (output / (self.build.name + '.allocations.txt')).read_text()
+        self.assertTrue(allocations.startswith('Task {}: 2 profiled executions'.format(
+            self.build.name
+        )))
+        self.assertIn('self.cache.append([str(i) for i in range(size)])', allocations)
+        self.assertIn('build', (output / (self.build.name + '.cpu.txt')).read_text())
+        stats = pstats.Stats((output / (self.build.name + '.pstats')).as_posix())
+        self.assertTrue(any(function[2] == 'build' for function in stats.stats))
+
+    def test_sampling(self):
+        """Check that executions are not profiled outside of the sample."""
+        profiler = self._profiler(0.0)
+        self.build.apply((10,))
+        self.assertFalse(profiler.raw_directory.exists())
+
+    def test_use_process(self):
+        """Check that pool processes forget aggregates of their parent process."""
+        profiler = self._profiler(1.0)
+        self.build.apply((10,))
+        profiler.use_process()
+        self.build.apply((10,))
+        allocations = dump_task_profiles(self.directory) / (self.build.name + '.allocations.txt')
+        self.assertIn(': 1 profiled executions', allocations.read_text())
@@ -0,0 +1,128 @@
+"""Tests for the tracing module."""
+
+
+from unittest.mock import patch
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from celery.contrib.testing.worker import start_worker
+
+from extensible_celery_worker import Celery
+from extensible_celery_worker.bench import format_results, run_benchmark
+from extensible_celery_worker.tracing import SpanExporter, configure_task_tracing, task_phase
+
+
+def _double(x):
+    return 2 * x
+
+
+def _spans(lines):
+    """Return spans of the given OTLP JSON lines, by name."""
+    spans = {}
+    for line in lines:
+        for resource_spans in json.loads(line)['resourceSpans']:
+            for scope_spans in resource_spans['scopeSpans']:
+                for span in scope_spans['spans']:
+                    spans.setdefault(span['name'], []).append(span)
+    return spans
+
+
+class TaskTracingTest(unittest.TestCase):
+    """Test for tracing of task executions."""
+
+    def setUp(self):
+        self.app = Celery('tracing_test_app', set_as_current=False)
+        self.app.conf.update(broker_url='memory://', result_backend='cache+memory://',
+                             broker_transport_options={'polling_interval': 0.01})
+        self.double = self.app.task(name='tracing_test_app.math.double', shared=False)(_double)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spans.jsonl')
+        patcher = patch('logging.info')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _trace(self, sample_rate=1.0, batch_size=1):
+        exporter = SpanExporter(self.path, 'tracing_test_app', batch_size)
+        previous = configure_task_tracing(exporter, sample_rate)
+        self.addCleanup(configure_task_tracing, *previous)
+        return exporter
+
+    def _read_spans(self):
+        with open(self.path) as f:
+            return _spans(f)
+
+    def test_worker(self):
+        """Check that task executions and their phases are traced, with links across chains."""
+        self._trace()
+        with start_worker(self.app, pool='solo', perform_ping_check=False):
+            result = (self.double.s(1) | self.double.s()).delay()
+            self.assertEqual(result.get(timeout=10), 4)
+        spans = self._read_spans()
+        first, second = sorted(spans[self.double.name], key=lambda span: span['startTimeUnixNano'])
+        self.assertEqual(first['traceId'], second['traceId'])
+        self.assertNotIn('parentSpanId', first)
+        self.assertEqual(second['parentSpanId'], first['spanId'])
+        self.assertEqual(first['status'], {'code': 1})
+        for name in ('queue', 'wait', 'arguments', 'body', 'result'):
+            self.assertEqual(len(spans[name]), 2)
+            self.assertEqual({span['parentSpanId'] for span in spans[name]},
+                             {first['spanId'], second['spanId']})
+        body = spans['body'][0]
+        self.assertLessEqual(int(body['startTimeUnixNano']), int(body['endTimeUnixNano']))
+
+    def test_sampling(self):
+        """Check that traces outside of the sample are not traced."""
+        exporter = self._trace(sample_rate=0.0)
+        self.double.apply((1,))
+        exporter.flush()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_batches(self):
+        """Check that spans are written in batches."""
+        exporter = self._trace(batch_size=100)
+        self.double.apply((1,))
+        self.double.apply((2,))
+        self.assertFalse(os.path.exists(self.path))
+        exporter.flush()
+        with open(self.path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(len(_spans(lines)[self.double.name]), 2)
+
+    def test_task_phase(self):
+        """Check that phases outside of traced executions are ignored."""
+        self._trace()
+        with task_phase('body'):
+            pass
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket(self):
+        """Check that spans can be sent to a TCP socket."""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        received = []
+
+        def receive():
+            connection, _ = server.accept()
+            with connection, connection.makefile() as lines:
+                received.append(lines.readline())
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        SpanExporter('tcp://127.0.0.1:{}'.format(server.getsockname()[1]))._write([{'name': 'x'}])
+        receiver.join(timeout=10)
+        self.assertEqual(_spans(received), {'x': [{'name': 'x'}]})
+
+    def test_benchmark_overhead(self):
+        """Check that benchmarks show the overhead of tracing."""
+        result = run_benchmark(self.app, self.double.name, 20, args=(1,), trace=True)
+        self.assertIn('tracing_overhead', result)
+        self.assertIn('Tracing', format_results([result]).splitlines()[0])
+        self.assertFalse(os.path.exists(self.path))